@@ -0,0 +1,251 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError
+from urllib3.util.retry import Retry
+
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "16"))
+
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+
+# A keep-alive socket the server has already closed is noticed by urllib3
+# before reuse and replaced, so only connection failures, where the request
+# never reached the server, are retried (once). A read error or read timeout
+# is never resent: the server may already have acted on the request, and a
+# replayed DELETE or history clear would report wrong results.
+STALE_CONNECTION_RETRY = Retry(
+    total=1,
+    connect=1,
+    read=False,
+    status=0,
+    other=0,
+    raise_on_status=False,
+    backoff_factor=0,
+)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of sending a request while the backend's breaker is open."""
+
+
+def is_timeout(error):
+    """True for a read timeout, including one requests wrapped in a ConnectionError."""
+    if isinstance(error, requests.Timeout):
+        return True
+    reason = error.args[0] if isinstance(error, requests.ConnectionError) and error.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, ReadTimeoutError)
+
+
+def parse_replicas(text):
+    """Parse ``"S1=http://host:6001|http://host:7001,S2=..."`` into ``{server_id: [url, ...]}``."""
+    replicas = {}
+    for entry in text.split(","):
+        if "=" not in entry:
+            continue
+        server_id, urls = entry.split("=", 1)
+        urls = [url.strip().rstrip("/") for url in urls.split("|") if url.strip()]
+        if urls:
+            replicas[server_id.strip()] = urls
+    return replicas
+
+
+def _pool_size(server_id):
+    try:
+        return int(os.getenv(f"{server_id}_POOL_SIZE", HTTP_POOL_SIZE))
+    except ValueError:
+        return HTTP_POOL_SIZE
+
+
+class HedgeRace:
+    """Decides the outcome of a hedged GET from its calls as they finish.
+
+    The first answer below 500 wins. Failing that, a 5xx answer is
+    returned, then the primary's error, then the hedge's. Shared by the
+    threaded and asyncio sessions; ``errors`` are the client's exception
+    types.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        self.response = None
+        self.primary_error = None
+        self.hedge_error = None
+
+    def finished(self, future, is_primary):
+        """Record a finished call; returns its response if that settles the race."""
+        try:
+            response = future.result()
+        except self.errors as error:
+            if is_primary:
+                self.primary_error = error
+            else:
+                self.hedge_error = error
+            return None
+        if response.status_code < 500:
+            return response
+        self.response = response
+        return None
+
+    def result(self, timeout_error):
+        if self.response is not None:
+            return self.response
+        raise self.primary_error or self.hedge_error or timeout_error
+
+
+class BackendSessions:
+    """One keep-alive ``requests.Session`` per storage server.
+
+    Each session mounts an adapter sized from ``<SERVER_ID>_POOL_SIZE``
+    (falling back to ``HTTP_POOL_SIZE``) so concurrent fan-outs and routed
+    writes reuse sockets instead of opening a TCP connection per call.
+    When a ``tracker`` is given, every request runs inside
+    ``tracker.track(server_id)`` so load-aware routing sees it. With
+    ``breakers``, a request to a backend whose breaker is open fails at
+    once with CircuitOpenError, and every outcome is fed back to the
+    breaker: connection errors, timeouts and 5xx answers count as failures.
+    ``replicas`` maps a server id to base URLs of other processes serving
+    the same server id, used by ``hedged_get``.
+    """
+
+    def __init__(self, server_urls, tracker=None, breakers=None, replicas=None):
+        self.server_urls = server_urls
+        self.tracker = tracker
+        self.breakers = breakers
+        self.replicas = replicas or {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._replica_turn = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def session(self, server_id):
+        session = self._sessions.get(server_id)
+        if session is not None:
+            return session
+
+        with self._lock:
+            session = self._sessions.get(server_id)
+            if session is None:
+                size = _pool_size(server_id)
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=size,
+                    pool_block=False,
+                    max_retries=STALE_CONNECTION_RETRY,
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[server_id] = session
+        return session
+
+    def request(self, server_id, method, path, use_breaker=True, **kwargs):
+        """``use_breaker=False`` bypasses the breaker, for probes that must reach a sick backend."""
+        breaker = self.breakers[server_id] if self.breakers is not None and use_breaker else None
+        if breaker is None:
+            return self._send(server_id, method, path, kwargs)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit breaker for {server_id} is open")
+
+        started = time.monotonic()
+        failed = True
+        try:
+            response = self._send(server_id, method, path, kwargs)
+            failed = response.status_code >= 500
+            return response
+        finally:
+            breaker.record(failed, time.monotonic() - started)
+
+    def _send(self, server_id, method, path, kwargs):
+        url = f"{self.server_urls[server_id]}{path}"
+        if self.tracker is None:
+            return self.session(server_id).request(method, url, **kwargs)
+        with self.tracker.track(server_id):
+            return self.session(server_id).request(method, url, **kwargs)
+
+    def hedged_get(self, server_id, path, timeout, hedge_after):
+        """GET from the server; if it has not answered after ``hedge_after`` seconds,
+        send the same GET to one of its replicas and return whichever answers first.
+
+        Only for reads that are safe to run twice. Without replicas, or
+        with ``hedge_after`` not below ``timeout``, this is a plain ``get``.
+        """
+        replicas = self.replicas.get(server_id)
+        if not replicas or hedge_after >= timeout:
+            return self.get(server_id, path, timeout=timeout)
+
+        started = time.monotonic()
+        primary = _hedge_executor.submit(self.get, server_id, path, timeout=timeout)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        self._replica_turn += 1
+        index = self._replica_turn % len(replicas)
+        remaining = max(0.001, timeout - (time.monotonic() - started))
+        hedge = _hedge_executor.submit(self._send_replica, server_id, index, path, remaining)
+        self.hedges += 1
+
+        race = HedgeRace(requests.RequestException)
+        pending = {primary, hedge}
+        while pending:
+            left = max(0.0, timeout - (time.monotonic() - started))
+            done, pending = wait(pending, timeout=left, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                response = race.finished(future, future is primary)
+                if response is not None:
+                    if future is hedge:
+                        self.hedge_wins += 1
+                    return response
+
+        return race.result(requests.Timeout(f"{server_id} and its replica did not answer within {timeout:.3f}s"))
+
+    def _send_replica(self, server_id, index, path, timeout):
+        key = f"{server_id}#{index}"
+        return self.session(key).get(f"{self.replicas[server_id][index]}{path}", timeout=timeout)
+
+    def get(self, server_id, path, **kwargs):
+        return self.request(server_id, "GET", path, **kwargs)
+
+    def post(self, server_id, path, **kwargs):
+        return self.request(server_id, "POST", path, **kwargs)
+
+    def put(self, server_id, path, **kwargs):
+        return self.request(server_id, "PUT", path, **kwargs)
+
+    def delete(self, server_id, path, **kwargs):
+        return self.request(server_id, "DELETE", path, **kwargs)
+
+    def stats(self):
+        stats = {}
+        for server_id in self.server_urls:
+            new_connections = 0
+            requests_sent = 0
+            session = self._sessions.get(server_id)
+            if session is not None:
+                adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+                for adapter in adapters.values():
+                    pools = adapter.poolmanager.pools
+                    for key in list(pools.keys()):
+                        pool = pools.get(key)
+                        if pool is None:
+                            continue
+                        new_connections += pool.num_connections
+                        requests_sent += pool.num_requests
+
+            stats[server_id] = {
+                "pool_size": _pool_size(server_id),
+                "new_connections": new_connections,
+                "reused_connections": max(0, requests_sent - new_connections),
+            }
+        return stats
@@ -0,0 +1,155 @@
+import asyncio
+import os
+import time
+import weakref
+
+import httpx
+
+from backend_http import HedgeRace, _pool_size
+
+
+ASYNC_BACKEND_INFLIGHT = int(os.getenv("ASYNC_BACKEND_INFLIGHT", "32"))
+
+
+class AsyncCircuitOpenError(httpx.ConnectError):
+    """Raised instead of sending a request while the backend's breaker is open."""
+
+
+class AsyncBackendSessions:
+    """asyncio counterpart of ``backend_http.BackendSessions``.
+
+    One keep-alive ``httpx.AsyncClient`` per storage server, keeping
+    ``<SERVER_ID>_POOL_SIZE`` idle connections like the synchronous sessions. The tracker,
+    breakers and replicas are the same objects the Flask app uses, so
+    load-aware routing, breaker state and the dashboard see calls from
+    both. At most ``max_inflight`` requests per server are sent at once;
+    the rest wait in the load balancer instead of piling onto a backend
+    that has far fewer threads than the event loop has tasks. Clients are
+    bound to the running event loop; call ``aclose`` on shutdown.
+    """
+
+    def __init__(self, server_urls, tracker=None, breakers=None, replicas=None, max_inflight=ASYNC_BACKEND_INFLIGHT):
+        self.server_urls = server_urls
+        self.max_inflight = max_inflight
+        self.tracker = tracker
+        self.breakers = breakers
+        self.replicas = replicas or {}
+        self._clients = {}
+        self._inflight = {}
+        self._replica_turn = 0
+        # Calls cancelled because the other side of a hedge answered first.
+        self._abandoned = weakref.WeakSet()
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def client(self, server_id):
+        client = self._clients.get(server_id)
+        if client is None:
+            size = _pool_size(server_id)
+            client = self._clients[server_id] = httpx.AsyncClient(
+                # Like pool_block=False: extra connections are opened when
+                # all pooled ones are busy, only ``size`` are kept alive.
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=size),
+                # One connect retry, as STALE_CONNECTION_RETRY does for requests.
+                transport=httpx.AsyncHTTPTransport(retries=1),
+            )
+        return client
+
+    def _slots(self, key):
+        slots = self._inflight.get(key)
+        if slots is None:
+            slots = self._inflight[key] = asyncio.Semaphore(self.max_inflight)
+        return slots
+
+    async def aclose(self):
+        self._inflight = {}
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    async def request(self, server_id, method, path, use_breaker=True, on_sent=None, **kwargs):
+        """Send one request once a slot is free; ``on_sent`` is called when it gets one."""
+        breaker = self.breakers[server_id] if self.breakers is not None and use_breaker else None
+        # Waiting for a slot is the load balancer's own queue; the breaker
+        # and the tracker only time the call itself.
+        async with self._slots(server_id):
+            if on_sent is not None:
+                on_sent()
+            if breaker is None:
+                return await self._send(server_id, method, path, kwargs)
+            if not breaker.allow():
+                raise AsyncCircuitOpenError(f"Circuit breaker for {server_id} is open")
+
+            started = time.monotonic()
+            failed = True
+            try:
+                response = await self._send(server_id, method, path, kwargs)
+                failed = response.status_code >= 500
+                return response
+            except asyncio.CancelledError:
+                # Losing a hedge is not the backend's fault; running into
+                # the fan-out deadline is, like a timeout.
+                failed = asyncio.current_task() not in self._abandoned
+                raise
+            finally:
+                breaker.record(failed, time.monotonic() - started)
+
+    async def _send(self, server_id, method, path, kwargs):
+        url = f"{self.server_urls[server_id]}{path}"
+        if self.tracker is None:
+            return await self.client(server_id).request(method, url, **kwargs)
+        with self.tracker.track(server_id):
+            return await self.client(server_id).request(method, url, **kwargs)
+
+    async def get(self, server_id, path, **kwargs):
+        return await self.request(server_id, "GET", path, **kwargs)
+
+    async def post(self, server_id, path, **kwargs):
+        return await self.request(server_id, "POST", path, **kwargs)
+
+    async def hedged_get(self, server_id, path, timeout, hedge_after, on_sent=None):
+        """Same contract as ``BackendSessions.hedged_get``; ``on_sent`` as for ``request``."""
+        replicas = self.replicas.get(server_id)
+        if not replicas or hedge_after >= timeout:
+            return await self.get(server_id, path, timeout=timeout, on_sent=on_sent)
+
+        started = time.monotonic()
+        primary = asyncio.ensure_future(self.get(server_id, path, timeout=timeout, on_sent=on_sent))
+        done, _ = await asyncio.wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        self._replica_turn += 1
+        index = self._replica_turn % len(replicas)
+        remaining = max(0.001, timeout - (time.monotonic() - started))
+        hedge = asyncio.ensure_future(self._send_replica(server_id, index, path, remaining))
+        self.hedges += 1
+
+        race = HedgeRace(httpx.HTTPError)
+        pending = {primary, hedge}
+        settled = False
+        try:
+            while pending:
+                left = max(0.0, timeout - (time.monotonic() - started))
+                done, pending = await asyncio.wait(pending, timeout=left, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    response = race.finished(future, future is primary)
+                    if response is not None:
+                        if future is hedge:
+                            self.hedge_wins += 1
+                        settled = True
+                        return response
+        finally:
+            for future in pending:
+                if settled:
+                    self._abandoned.add(future)
+                future.cancel()
+
+        return race.result(httpx.ReadTimeout(f"{server_id} and its replica did not answer within {timeout:.3f}s"))
+
+    async def _send_replica(self, server_id, index, path, timeout):
+        key = f"{server_id}#{index}"
+        async with self._slots(key):
+            return await self.client(key).get(f"{self.replicas[server_id][index]}{path}", timeout=timeout)
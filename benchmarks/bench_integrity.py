@@ -0,0 +1,55 @@
+"""CPU cost of inbox verification per checksum algorithm and verify mode.
+
+Usage:
+    python benchmarks/bench_integrity.py [--messages 10000] [--size 2000] [--runs 20]
+
+Builds an in-memory mailbox of N messages of SIZE bytes, all already
+verified once, and times one read's worth of verification (the work
+get_messages does after fetching the rows) for every available algorithm
+under each verify mode. No database is needed.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from integrity import CHECKSUM_ALGORITHMS, VERIFY_MODES, VerifyPolicy, checksum_matches, compute_checksum  # noqa: E402
+
+
+def verify(rows, policy):
+    for content, checksum, algorithm, verified in rows:
+        if policy.should_verify(verified) and not checksum_matches(content, checksum, algorithm):
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--size", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--sample-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    contents = [f"{offset:08d}".ljust(args.size, "x") for offset in range(args.messages)]
+    print(f"{args.messages} messages of {args.size} bytes, median of {args.runs} reads")
+    print(f"{'algorithm':<10}" + "".join(f"{mode:>14}" for mode in VERIFY_MODES))
+    for algorithm in CHECKSUM_ALGORITHMS:
+        rows = [(content, compute_checksum(content, algorithm), algorithm, True) for content in contents]
+        line = f"{algorithm:<10}"
+        for mode in VERIFY_MODES:
+            policy = VerifyPolicy(mode, sample_rate=args.sample_rate)
+            timings = []
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                verify(rows, policy)
+                timings.append((time.perf_counter() - started) * 1000)
+            line += f"{statistics.median(timings):11.2f} ms"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Concurrent inbox loads against the Flask and the ASGI load balancer.
+
+Usage:
+    DATABASE_URL=postgresql://... python benchmarks/bench_lb_concurrency.py \
+        --flask http://127.0.0.1:5000 --asgi http://127.0.0.1:5100 \
+        [--concurrency 50,200,1000] [--seconds 10] [--messages 300] [--limit 50]
+
+Both load balancers must already be running in front of the same storage
+servers. Seeds one throwaway receiver with N messages spread over S1-S3,
+then, for each concurrency level, keeps that many paged inbox reads in
+flight against each load balancer for SECONDS and reports throughput,
+latency percentiles and failed requests (non-200 answers, connection
+errors and partial fan-outs). The rows are deleted afterwards.
+
+Stopping one storage server (kill -STOP) during a run shows how each
+entry point behaves while a backend stalls.
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+import psycopg2  # noqa: E402
+import psycopg2.extras  # noqa: E402
+
+SERVER_IDS = ("S1", "S2", "S3")
+
+
+def seed(connection, username, count):
+    base_id = int(time.time() * 1000) * 1000
+    rows = []
+    for offset in range(count):
+        content = f"bench message {offset}"
+        rows.append(
+            (
+                base_id + offset,
+                "bench-sender",
+                username,
+                content,
+                "READ",
+                hashlib.md5(content.encode()).hexdigest(),
+                SERVER_IDS[offset % len(SERVER_IDS)],
+            )
+        )
+
+    with connection.cursor() as cursor:
+        psycopg2.extras.execute_values(
+            cursor,
+            """
+            INSERT INTO messages (id, sender, receiver, content, status, checksum, server_id)
+            VALUES %s
+            """,
+            rows,
+            page_size=1000,
+        )
+    connection.commit()
+
+
+def cleanup(connection, username):
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM messages WHERE receiver = %s", (username,))
+    connection.commit()
+
+
+async def load(base_url, path, concurrency, seconds):
+    latencies = []
+    failures = 0
+    stop_at = time.monotonic() + seconds
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+
+        async def worker():
+            nonlocal failures
+            while time.monotonic() < stop_at:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    ok = response.status_code == 200 and response.headers.get("X-Fanout-Partial") != "true"
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append((time.perf_counter() - started) * 1000)
+                if not ok:
+                    failures += 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+    return latencies, failures, elapsed
+
+
+def summarize(name, concurrency, latencies, failures, elapsed):
+    ordered = sorted(latencies)
+    if not ordered:
+        print(f"{name:<6} {concurrency:>6}   no requests completed")
+        return
+
+    def percentile(fraction):
+        return ordered[max(0, int(len(ordered) * fraction) - 1)]
+
+    print(
+        f"{name:<6} {concurrency:>6} {len(ordered) / elapsed:9.1f} req/s"
+        f"   p50 {statistics.median(ordered):8.1f} ms   p99 {percentile(0.99):8.1f} ms"
+        f"   failed {failures}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--flask", default="http://127.0.0.1:5000")
+    parser.add_argument("--asgi", default="http://127.0.0.1:5100")
+    parser.add_argument("--concurrency", default="50,200,1000")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    username = f"bench-{uuid.uuid4().hex[:8]}"
+    path = f"/inbox/{username}?limit={args.limit}"
+    connection = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        seed(connection, username, args.messages)
+        print(f"paged inbox reads ({args.limit} of {args.messages} messages), {args.seconds:g} s per run")
+        for concurrency in (int(level) for level in args.concurrency.split(",")):
+            for name, base_url in (("flask", args.flask), ("asgi", args.asgi)):
+                latencies, failures, elapsed = asyncio.run(load(base_url, path, concurrency, args.seconds))
+                summarize(name, concurrency, latencies, failures, elapsed)
+    finally:
+        cleanup(connection, username)
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
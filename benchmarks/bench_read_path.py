@@ -0,0 +1,147 @@
+"""Compare the old three-query inbox read with the single-statement read_inbox.
+
+Usage:
+    DATABASE_URL=postgresql://... python benchmarks/bench_read_path.py [--messages 10000] [--runs 20]
+
+Seeds one throwaway receiver with N messages on S1 (10% UNREAD before
+every run), times both read paths against the same rows and deletes the
+rows afterwards. Both paths roll back instead of committing so every run
+starts from the same state.
+"""
+import argparse
+import hashlib
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2.extras  # noqa: E402
+
+from storage_server import StorageServer  # noqa: E402
+
+server = StorageServer.from_env("S1")
+store = server.store
+
+
+LEGACY_SELECT = """
+    SELECT id, sender, receiver, content, status, timestamp_sent, timestamp_read, checksum, server_id,
+           checksum_algo, verified_at IS NOT NULL,
+           EXISTS (SELECT 1 FROM message_quarantine AS q WHERE q.message_id = messages.id)
+    FROM messages
+    WHERE receiver = %s AND server_id = %s
+    ORDER BY timestamp_sent DESC
+"""
+
+
+def legacy_read(connection, username):
+    with connection.cursor() as cursor:
+        cursor.execute(LEGACY_SELECT, (username, server.server_id))
+        rows = cursor.fetchall()
+
+    if store.verify_rows(rows)[0]:
+        return rows
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE messages
+            SET status='READ', timestamp_read=CURRENT_TIMESTAMP
+            WHERE receiver = %s AND server_id = %s AND status='UNREAD'
+            """,
+            (username, server.server_id),
+        )
+
+    with connection.cursor() as cursor:
+        cursor.execute(LEGACY_SELECT, (username, server.server_id))
+        return cursor.fetchall()
+
+
+def single_statement_read(connection, username):
+    rows = store.read_inbox(connection, username)
+    store.verify_rows(rows)
+    return rows
+
+
+def seed(connection, username, count):
+    base_id = int(time.time() * 1000) * 1000
+    rows = []
+    for offset in range(count):
+        content = f"bench message {offset}"
+        rows.append(
+            (
+                base_id + offset,
+                "bench-sender",
+                username,
+                content,
+                "READ",
+                hashlib.md5(content.encode()).hexdigest(),
+                server.server_id,
+            )
+        )
+
+    with connection.cursor() as cursor:
+        psycopg2.extras.execute_values(
+            cursor,
+            """
+            INSERT INTO messages (id, sender, receiver, content, status, checksum, server_id)
+            VALUES %s
+            """,
+            rows,
+            page_size=1000,
+        )
+        # Give the planner real row counts, as autovacuum would on a live table.
+        cursor.execute("ANALYZE messages")
+    connection.commit()
+
+
+def mark_some_unread(connection, username):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE messages SET status='UNREAD', timestamp_read=NULL WHERE receiver = %s AND id %% 10 = 0",
+            (username,),
+        )
+    connection.commit()
+
+
+def measure(connection, username, read, runs):
+    timings = []
+    for _ in range(runs):
+        mark_some_unread(connection, username)
+        started = time.perf_counter()
+        read(connection, username)
+        timings.append((time.perf_counter() - started) * 1000)
+        connection.rollback()
+    return timings
+
+
+def summarize(name, timings):
+    ordered = sorted(timings)
+    p95 = ordered[max(0, int(len(ordered) * 0.95) - 1)]
+    print(f"{name:<18} median {statistics.median(ordered):8.1f} ms   p95 {p95:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    username = f"bench-{uuid.uuid4().hex[:8]}"
+    with store.connection() as connection:
+        seed(connection, username, args.messages)
+        try:
+            print(f"{args.messages} messages for {username} on {server.server_id}, {args.runs} runs each")
+            summarize("three queries", measure(connection, username, legacy_read, args.runs))
+            summarize("single statement", measure(connection, username, single_statement_read, args.runs))
+        finally:
+            connection.rollback()
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM messages WHERE receiver = %s", (username,))
+            connection.commit()
+
+
+if __name__ == "__main__":
+    main()
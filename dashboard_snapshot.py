@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+
+
+class SnapshotRefresher:
+    """Keeps one periodically refreshed copy of an expensive snapshot.
+
+    A single background thread per process calls ``build()`` every
+    ``interval`` seconds, so the cost of building the snapshot does not
+    grow with the number of readers. The thread stops refreshing when
+    nobody has asked for the snapshot for ``idle_after`` seconds and
+    resumes on the next read.
+    """
+
+    def __init__(self, build, interval=2.0, idle_after=60.0):
+        self._build = build
+        self.interval = interval
+        self.idle_after = idle_after
+
+        self._condition = threading.Condition()
+        self._refresh_lock = threading.Lock()
+        self._resume = threading.Event()
+        self._snapshot = None
+        self._refreshed_at = 0.0
+        self._version = 0
+        self._last_access = time.monotonic()
+        self._thread = None
+        self._pid = None
+        self.refreshes = 0
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._condition:
+            if self._thread is not None and self._pid == pid:
+                return
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name="snapshot-refresher", daemon=True)
+            self._thread.start()
+
+    def _idle(self):
+        return time.monotonic() - self._last_access > self.idle_after
+
+    def _run(self):
+        while True:
+            if self._idle():
+                self._resume.clear()
+                if self._idle():
+                    self._resume.wait()
+            try:
+                self.refresh_now()
+            except Exception as error:
+                print(f"Snapshot refresh failed: {error}", flush=True)
+            time.sleep(self.interval)
+
+    def _touch(self):
+        self._last_access = time.monotonic()
+        self._resume.set()
+        self._ensure_thread()
+
+    def refresh_now(self, force=False):
+        """Rebuild immediately.
+
+        Concurrent callers share a single build unless ``force`` is set,
+        which guarantees the build starts after the call (read-your-writes).
+        """
+        started_version = self._version
+        with self._refresh_lock:
+            if not force and self._version != started_version:
+                return self._snapshot
+            snapshot = self._build()
+            with self._condition:
+                self._snapshot = snapshot
+                self._refreshed_at = time.monotonic()
+                self._version += 1
+                self.refreshes += 1
+                self._condition.notify_all()
+            return snapshot
+
+    def get(self):
+        self._touch()
+        snapshot = self._snapshot
+        # After an idle pause the cached copy can be arbitrarily old.
+        if snapshot is None or time.monotonic() - self._refreshed_at > 2 * self.interval:
+            snapshot = self.refresh_now()
+        return snapshot
+
+    def latest(self):
+        """Like ``get()`` but also returns the snapshot's version."""
+        self.get()
+        with self._condition:
+            return self._version, self._snapshot
+
+    def wait_for_update(self, version, timeout):
+        """Block until a snapshot newer than ``version`` exists or ``timeout`` passes.
+
+        Returns ``(version, snapshot)``; the version is unchanged on timeout.
+        """
+        self._touch()
+        with self._condition:
+            self._condition.wait_for(lambda: self._version != version, timeout)
+            return self._version, self._snapshot
@@ -0,0 +1,309 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+
+class DatabaseConnectionError(Exception):
+    pass
+
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class _PooledConnection:
+    __slots__ = ("connection", "created_at", "last_used")
+
+    def __init__(self, connection):
+        now = time.monotonic()
+        self.connection = connection
+        self.created_at = now
+        self.last_used = now
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool.
+
+    Idle connections are kept in a LIFO stack so the hottest connection is
+    reused first and the rest age out after ``idle_timeout`` seconds (never
+    dropping below ``minconn``). A connection that has been idle for longer
+    than ``healthcheck_after`` seconds is pinged with ``SELECT 1`` before it
+    is handed out; broken connections are closed and replaced.
+    """
+
+    def __init__(
+        self,
+        connect,
+        minconn=1,
+        maxconn=10,
+        idle_timeout=300.0,
+        healthcheck_after=30.0,
+        acquire_timeout=5.0,
+    ):
+        if maxconn < 1:
+            raise ValueError("maxconn must be at least 1")
+
+        self._connect = connect
+        self.minconn = max(0, min(minconn, maxconn))
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.healthcheck_after = healthcheck_after
+        self.acquire_timeout = acquire_timeout
+
+        self._idle = deque()
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self._counters = {
+            "checkouts": 0,
+            "created": 0,
+            "reused": 0,
+            "evicted_broken": 0,
+            "evicted_idle": 0,
+            "healthchecks": 0,
+            "wait_timeouts": 0,
+        }
+
+    def _open(self):
+        connection = self._connect()
+        with self._condition:
+            self._counters["created"] += 1
+        return _PooledConnection(connection)
+
+    def _close(self, pooled):
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, pooled):
+        connection = pooled.connection
+        if connection.closed:
+            return False
+
+        if time.monotonic() - pooled.last_used < self.healthcheck_after:
+            return True
+
+        with self._condition:
+            self._counters["healthchecks"] += 1
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _reap_idle(self):
+        # Caller holds the condition lock. Oldest idle entries sit at the left.
+        now = time.monotonic()
+        reaped = []
+        while (
+            len(self._idle) + self._in_use > self.minconn
+            and self._idle
+            and now - self._idle[0].last_used > self.idle_timeout
+        ):
+            reaped.append(self._idle.popleft())
+            self._counters["evicted_idle"] += 1
+        return reaped
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.acquire_timeout
+
+        while True:
+            pooled = None
+            with self._condition:
+                reaped = self._reap_idle()
+                while not self._idle and self._in_use >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["wait_timeouts"] += 1
+                        raise DatabaseConnectionError("Connection pool exhausted")
+                    self._condition.wait(remaining)
+
+                if self._idle:
+                    pooled = self._idle.pop()
+                self._in_use += 1
+                self._counters["checkouts"] += 1
+
+            for stale in reaped:
+                self._close(stale)
+
+            if pooled is None:
+                try:
+                    return self._open()
+                except Exception:
+                    self._release_slot()
+                    raise
+
+            if self._is_healthy(pooled):
+                with self._condition:
+                    self._counters["reused"] += 1
+                return pooled
+
+            self._close(pooled)
+            with self._condition:
+                self._counters["evicted_broken"] += 1
+            self._release_slot()
+
+    def _release_slot(self):
+        with self._condition:
+            self._in_use -= 1
+            self._condition.notify()
+
+    def _checkin(self, pooled, broken=False):
+        connection = pooled.connection
+
+        if not broken and not connection.closed:
+            try:
+                status = connection.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    broken = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except Exception:
+                broken = True
+
+        if broken or connection.closed:
+            self._close(pooled)
+            with self._condition:
+                self._counters["evicted_broken"] += 1
+                self._in_use -= 1
+                self._condition.notify()
+            return
+
+        pooled.last_used = time.monotonic()
+        with self._condition:
+            self._idle.append(pooled)
+            self._in_use -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of a ``with`` block.
+
+        Uncommitted work is rolled back on exit, so handlers must commit
+        explicitly just as they did with a bare psycopg2 connection.
+        """
+        pooled = self._checkout()
+        broken = False
+        try:
+            yield pooled.connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            try:
+                pooled.connection.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self._checkin(pooled, broken=broken)
+
+    def fill(self):
+        """Open connections until ``minconn`` are open; returns how many were opened."""
+        opened = 0
+        while True:
+            with self._condition:
+                if len(self._idle) + self._in_use >= self.minconn:
+                    return opened
+                self._in_use += 1
+            try:
+                pooled = self._open()
+            except Exception:
+                self._release_slot()
+                raise
+            self._checkin(pooled)
+            opened += 1
+
+    def close_all(self):
+        with self._condition:
+            idle = list(self._idle)
+            self._idle.clear()
+        for pooled in idle:
+            self._close(pooled)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "idle_timeout": self.idle_timeout,
+                **self._counters,
+            }
+
+
+def pool_from_env(connect, **overrides):
+    """Build a ConnectionPool sized from the DB_POOL_* environment variables.
+
+    Keyword arguments that are not None take precedence over the environment.
+    """
+    settings = {
+        "minconn": _env_int("DB_POOL_MIN", 1),
+        "maxconn": _env_int("DB_POOL_MAX", 10),
+        "idle_timeout": _env_float("DB_POOL_IDLE_TIMEOUT", 300.0),
+        "healthcheck_after": _env_float("DB_POOL_HEALTHCHECK_AFTER", 30.0),
+        "acquire_timeout": _env_float("DB_POOL_ACQUIRE_TIMEOUT", 5.0),
+    }
+    settings.update((name, value) for name, value in overrides.items() if value is not None)
+    return ConnectionPool(connect, **settings)
+
+
+class LazyPool:
+    """Create the process-wide pool on first use.
+
+    Gunicorn imports the app before forking workers; creating connections
+    lazily keeps each worker's sockets private to that worker. When a
+    process creates its pool, a background thread opens the pool's
+    ``minconn`` connections so later requests find them ready. ``settings``
+    are passed on to ``pool_from_env``.
+    """
+
+    def __init__(self, connect, **settings):
+        self._connect = connect
+        self._settings = settings
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        pid = os.getpid()
+        if self._pool is None or self._pid != pid:
+            with self._lock:
+                if self._pool is None or self._pid != pid:
+                    self._pool = pool_from_env(self._connect, **self._settings)
+                    self._pid = pid
+                    threading.Thread(target=self._prewarm, args=(self._pool,), name="db-pool-prewarm", daemon=True).start()
+        return self._pool
+
+    @staticmethod
+    def _prewarm(pool):
+        try:
+            pool.fill()
+        except Exception as error:
+            print(f"Database pool prewarm failed: {error}", flush=True)
+
+    def connection(self):
+        return self.get().connection()
+
+    def stats(self):
+        if self._pool is None or self._pid != os.getpid():
+            return {"initialized": False}
+        return {"initialized": True, **self._pool.stats()}
@@ -0,0 +1,124 @@
+import json
+import os
+import queue
+import threading
+import time
+
+
+EVENT_FIELDS = ("seq", "timestamp", "type", "server_id", "message_id", "latency_ms", "message")
+
+
+def make_event(event_type, message, server_id=None, message_id=None, latency_ms=None):
+    return {
+        "timestamp": time.time(),
+        "type": event_type,
+        "server_id": server_id,
+        "message_id": None if message_id is None else str(message_id),
+        "latency_ms": None if latency_ms is None else round(latency_ms, 2),
+        "message": message,
+    }
+
+
+class EventRing:
+    """Fixed-capacity ring buffer of events addressed by sequence number.
+
+    Event ``seq`` lives in slot ``seq % capacity``, so appending never
+    shifts or frees anything and the oldest event is overwritten in place.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._seq = 0
+
+    def append(self, event):
+        self._seq += 1
+        self._slots[self._seq % self.capacity] = dict(event, seq=self._seq)
+        return self._seq
+
+    @property
+    def last_seq(self):
+        return self._seq
+
+    @property
+    def first_seq(self):
+        return max(1, self._seq - self.capacity + 1)
+
+    def query(self, since=0, types=None, limit=None):
+        """Events with ``seq > since``, oldest first, optionally filtered by type."""
+        events = []
+        for seq in range(max(since + 1, self.first_seq), self._seq + 1):
+            event = self._slots[seq % self.capacity]
+            if types and event["type"] not in types:
+                continue
+            events.append(event)
+            if limit is not None and len(events) >= limit:
+                break
+        return events
+
+    def recent(self, count):
+        return self.query(since=self._seq - count)
+
+
+class EventSpill:
+    """Appends events to a JSON Lines file from a background thread.
+
+    The request path only does a non-blocking ``put``; when the writer
+    falls behind and the queue is full, events are dropped from the file
+    (never from the ring buffer) and counted.
+    """
+
+    def __init__(self, path, queue_size=10000, batch_size=500):
+        self.path = path
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.written = 0
+        self.dropped = 0
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid:
+                return
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name="event-spill", daemon=True)
+            self._thread.start()
+
+    def submit(self, event):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # One write per batch of whole lines keeps lines from different
+            # worker processes appending to the same file intact.
+            data = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in batch).encode()
+            try:
+                os.write(fd, data)
+                self.written += len(batch)
+            except OSError as error:
+                self.dropped += len(batch)
+                print(f"Event spill write failed: {error}", flush=True)
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+# Every request thread (LB_THREADS) and the dashboard refresher can have one
+# call per server running at once, so by default nothing waits in the queue.
+# Threads are only started as they are needed.
+_SERVER_COUNT = len([server_id for server_id in os.getenv("SERVERS", "S1,S2,S3").split(",") if server_id.strip()])
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", (int(os.getenv("LB_THREADS", "32")) + 1) * _SERVER_COUNT))
+FANOUT_DEADLINE = float(os.getenv("FANOUT_DEADLINE", "5"))
+
+_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+
+
+class FanoutResult:
+    """Outcome of one scatter-gather call.
+
+    ``results`` holds the value returned for every backend that answered in
+    time; ``status`` has one entry per backend describing what happened so
+    callers can report partial results instead of silently dropping a shard.
+    """
+
+    def __init__(self, results, status):
+        self.results = results
+        self.status = status
+
+    @property
+    def partial(self):
+        return any(entry["status"] != "ok" for entry in self.status.values())
+
+    def ordered(self, server_ids):
+        return [self.results[server_id] for server_id in server_ids if server_id in self.results]
+
+
+def _timed_call(call, server_id, server_url, timeout, started_at):
+    started = started_at[server_id] = time.monotonic()
+    value = call(server_id, server_url, timeout)
+    return value, (time.monotonic() - started) * 1000
+
+
+def scatter_gather(targets, call, deadline=None, executor=None):
+    """Run ``call(server_id, server_url, timeout)`` against every target at once.
+
+    ``targets`` maps server ids to base URLs. Each call's deadline runs
+    from when it starts, not from when it was queued, so a busy pool does
+    not turn a healthy backend into a timeout; a call still queued after a
+    whole deadline is given up as a timeout too. The gather returns as soon
+    as every call has finished or run out of time. A call that raises is
+    recorded as an error for that backend only. ``executor`` defaults to
+    the shared fan-out pool.
+    """
+    deadline = FANOUT_DEADLINE if deadline is None else deadline
+    executor = _executor if executor is None else executor
+    submitted = time.monotonic()
+    started_at = {}
+
+    futures = {
+        executor.submit(_timed_call, call, server_id, server_url, deadline, started_at): server_id
+        for server_id, server_url in targets.items()
+    }
+    pending = set(futures)
+    expired = set()
+    while pending:
+        now = time.monotonic()
+        expiry = {future: started_at.get(futures[future], submitted) + deadline for future in pending}
+        expired.update(future for future in pending if expiry[future] <= now)
+        pending -= expired
+        if not pending:
+            break
+        _, pending = wait(pending, timeout=min(expiry[future] for future in pending) - now, return_when=FIRST_COMPLETED)
+
+    results = {}
+    status = {}
+    for future, server_id in futures.items():
+        if future in expired:
+            future.cancel()
+            status[server_id] = {"status": "timeout", "deadline_ms": round(deadline * 1000)}
+            if server_id not in started_at:
+                status[server_id]["queued"] = True
+            continue
+
+        try:
+            value, latency_ms = future.result()
+        except Exception as error:
+            status[server_id] = {"status": "error", "error": str(error)}
+            continue
+
+        results[server_id] = value
+        status[server_id] = {"status": "ok", "latency_ms": round(latency_ms, 1)}
+
+    return FanoutResult(results, status)
+
+
+async def _timed_call_async(call, server_id, server_url, timeout):
+    started = time.monotonic()
+    value = await call(server_id, server_url, timeout)
+    return value, (time.monotonic() - started) * 1000
+
+
+async def async_scatter_gather(targets, call, deadline=None):
+    """``scatter_gather`` for coroutine calls, run as tasks on the current event loop."""
+    deadline = FANOUT_DEADLINE if deadline is None else deadline
+
+    tasks = {
+        asyncio.ensure_future(_timed_call_async(call, server_id, server_url, deadline)): server_id
+        for server_id, server_url in targets.items()
+    }
+    done = set()
+    if tasks:
+        done, _ = await asyncio.wait(tasks, timeout=deadline)
+
+    results = {}
+    status = {}
+    for task, server_id in tasks.items():
+        if task not in done:
+            task.cancel()
+            status[server_id] = {"status": "timeout", "deadline_ms": round(deadline * 1000)}
+            continue
+
+        try:
+            value, latency_ms = task.result()
+        except Exception as error:
+            status[server_id] = {"status": "error", "error": str(error)}
+            continue
+
+        results[server_id] = value
+        status[server_id] = {"status": "ok", "latency_ms": round(latency_ms, 1)}
+
+    return FanoutResult(results, status)
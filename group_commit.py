@@ -0,0 +1,101 @@
+import threading
+
+
+class _Batch:
+    def __init__(self):
+        self.rows = []
+        self.keys = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.stored = None
+        self.error = None
+        self.row_errors = {}
+
+
+class GroupCommitter:
+    """Coalesces concurrent single-row inserts into one multi-row transaction.
+
+    The first caller to arrive becomes the batch leader: it waits up to
+    ``max_delay`` seconds (or until ``max_batch`` rows have joined), then
+    calls ``flush(rows)``, which must insert the rows in one transaction
+    and return the set of keys actually stored. Every caller gets its own
+    answer: True if its row was stored, False if the key already existed.
+    When a flush fails with one of ``row_errors`` (errors caused by a row's
+    data rather than by the database), the rows are flushed again one at a
+    time so only the offending row's caller sees the error; any other flush
+    error is raised in every caller of that batch.
+    """
+
+    def __init__(self, flush, max_delay=0.002, max_batch=64, row_errors=()):
+        self._flush = flush
+        self.row_errors = tuple(row_errors)
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._open = None
+        self.batches = 0
+        self.rows = 0
+        self.retried_batches = 0
+
+    def submit(self, key, row):
+        key = str(key)
+        with self._lock:
+            batch = self._open
+            leader = batch is None
+            if leader:
+                batch = self._open = _Batch()
+            if key in batch.keys:
+                # The earlier row with this key is stored or rejected in this
+                # batch; either way this one is a duplicate.
+                duplicate = True
+            else:
+                duplicate = False
+                batch.keys.append(key)
+                batch.rows.append(row)
+                if len(batch.rows) >= self.max_batch:
+                    self._open = None
+                    batch.full.set()
+
+        if leader:
+            batch.full.wait(self.max_delay)
+            with self._lock:
+                if self._open is batch:
+                    self._open = None
+            try:
+                batch.stored = {str(stored) for stored in self._flush(batch.rows)}
+            except Exception as error:
+                if isinstance(error, self.row_errors) and len(batch.rows) > 1:
+                    self.retried_batches += 1
+                    self._flush_one_by_one(batch)
+                else:
+                    batch.error = error
+            finally:
+                self.batches += 1
+                self.rows += len(batch.rows)
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        if not duplicate and key in batch.row_errors:
+            raise batch.row_errors[key]
+        return not duplicate and key in batch.stored
+
+    def _flush_one_by_one(self, batch):
+        batch.stored = set()
+        for key, row in zip(batch.keys, batch.rows):
+            try:
+                batch.stored.update(str(stored) for stored in self._flush([row]))
+            except Exception as error:
+                batch.row_errors[key] = error
+
+    def stats(self):
+        return {
+            "max_delay_ms": self.max_delay * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "rows": self.rows,
+            "retried_batches": self.retried_batches,
+            "avg_batch": round(self.rows / self.batches, 2) if self.batches else 0,
+        }
@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fanout import scatter_gather
+
+
+class HealthChecker:
+    """Probes every backend on a fixed interval and reports state changes.
+
+    A server is declared unhealthy after ``fall`` consecutive failed probes
+    and healthy again after ``rise`` consecutive successes. ``probe`` is
+    called as ``probe(server_id, server_url, timeout)`` and must raise or
+    return False on failure; ``on_change(server_id, healthy, detail)`` is
+    called once per transition. A server starts in an unknown state and
+    its first verdict is always reported, so a restarted process corrects
+    state it shares with others. Probes run on the checker's own threads,
+    one per server, so a fan-out pool busy with user requests cannot delay
+    them into failures.
+    """
+
+    def __init__(self, server_urls, probe, on_change, interval=2.0, timeout=1.0, rise=2, fall=1):
+        self.server_urls = server_urls
+        self._probe = probe
+        self._on_change = on_change
+        self.interval = interval
+        self.timeout = timeout
+        self.rise = max(1, rise)
+        self.fall = max(1, fall)
+
+        self._lock = threading.Lock()
+        self._state = {
+            server_id: {
+                "healthy": None,
+                "successes": 0,
+                "failures": 0,
+                "last_error": None,
+                "last_probe": None,
+            }
+            for server_id in server_urls
+        }
+        self._executor = None
+        self._executor_pid = None
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid:
+                return
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name="health-checker", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.check_once()
+            except Exception as error:
+                print(f"Health check round failed: {error}", flush=True)
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def _probe_executor(self):
+        # Threads do not survive a fork, so each process gets its own pool.
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max(1, len(self.server_urls)), thread_name_prefix="health-probe"
+            )
+            self._executor_pid = pid
+        return self._executor
+
+    def _call(self, server_id, server_url, timeout):
+        if not self._probe(server_id, server_url, min(timeout, self.timeout)):
+            raise RuntimeError("probe reported unhealthy")
+        return True
+
+    def check_once(self):
+        """Probe all servers in parallel and apply the rise/fall thresholds."""
+        targets = {server_id: url for server_id, url in self.server_urls.items() if url}
+        result = scatter_gather(targets, self._call, deadline=self.timeout, executor=self._probe_executor())
+
+        transitions = []
+        with self._lock:
+            for server_id, status in result.status.items():
+                if status.get("queued"):
+                    # The previous round's probe is still running; this
+                    # one never reached the server, so it is no verdict.
+                    continue
+                state = self._state[server_id]
+                state["last_probe"] = time.time()
+                if status["status"] == "ok":
+                    state["successes"] += 1
+                    state["failures"] = 0
+                    state["last_error"] = None
+                    if state["healthy"] is None or (not state["healthy"] and state["successes"] >= self.rise):
+                        state["healthy"] = True
+                        transitions.append((server_id, True, "health check passed"))
+                else:
+                    state["failures"] += 1
+                    state["successes"] = 0
+                    state["last_error"] = status.get("error") or status["status"]
+                    if state["healthy"] is not False and state["failures"] >= self.fall:
+                        state["healthy"] = False
+                        transitions.append((server_id, False, state["last_error"]))
+
+        for server_id, healthy, detail in transitions:
+            self._on_change(server_id, healthy, detail)
+
+    def is_healthy(self, server_id):
+        with self._lock:
+            return self._state[server_id]["healthy"] is not False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "interval": self.interval,
+                "timeout": self.timeout,
+                "rise": self.rise,
+                "fall": self.fall,
+                "servers": {server_id: dict(state) for server_id, state in self._state.items()},
+            }
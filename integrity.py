@@ -0,0 +1,286 @@
+import hashlib
+import random
+import threading
+import time
+import zlib
+
+from message_counts import read_message_count
+from message_ids import MESSAGE_ID_MIN
+
+try:
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+
+CHECKSUM_ALGORITHMS = {
+    "md5": lambda data: hashlib.md5(data).hexdigest(),
+    "blake2b": lambda data: hashlib.blake2b(data, digest_size=16).hexdigest(),
+    "crc32": lambda data: format(zlib.crc32(data), "08x"),
+}
+if _crc32c is not None:
+    CHECKSUM_ALGORITHMS["crc32c"] = lambda data: format(_crc32c.crc32c(data), "08x")
+
+VERIFY_MODES = ("full", "unverified", "sample")
+
+
+def checksum_function(algorithm):
+    try:
+        return CHECKSUM_ALGORITHMS[algorithm]
+    except KeyError:
+        hint = " (pip install crc32c)" if algorithm == "crc32c" else ""
+        raise ValueError(
+            f"Unknown checksum algorithm {algorithm!r}{hint}; expected one of {', '.join(CHECKSUM_ALGORITHMS)}"
+        ) from None
+
+
+def compute_checksum(content, algorithm):
+    return checksum_function(algorithm)((content or "").encode())
+
+
+def checksum_matches(content, checksum, algorithm):
+    return compute_checksum(content, algorithm or "md5") == checksum
+
+
+class VerifyPolicy:
+    """Decides which rows a read re-hashes.
+
+    - ``full``: every row on every read.
+    - ``unverified``: only rows not verified since their last write.
+    - ``sample``: unverified rows plus a random ``sample_rate`` share of
+      the verified ones, so corruption at rest is still caught eventually.
+    """
+
+    def __init__(self, mode="full", sample_rate=0.05):
+        if mode not in VERIFY_MODES:
+            raise ValueError(f"Unknown verify mode {mode!r}; expected one of {', '.join(VERIFY_MODES)}")
+        self.mode = mode
+        self.sample_rate = sample_rate
+
+    def should_verify(self, verified):
+        if self.mode == "full" or not verified:
+            return True
+        return self.mode == "sample" and random.random() < self.sample_rate
+
+    def describe(self):
+        description = {"mode": self.mode}
+        if self.mode == "sample":
+            description["sample_rate"] = self.sample_rate
+        return description
+
+
+def mark_verified(cursor, server_id, verified):
+    """Record ``(id, checksum)`` pairs as verified.
+
+    A row whose checksum changed since it was read (an edit in between)
+    is left unverified.
+    """
+    if not verified:
+        return
+    ids, checksums = zip(*verified)
+    cursor.execute(
+        """
+        UPDATE messages AS m
+        SET verified_at = CURRENT_TIMESTAMP
+        FROM unnest(%s::bigint[], %s::text[]) AS v(id, checksum)
+        WHERE m.id = v.id AND m.checksum = v.checksum AND m.server_id = %s AND m.verified_at IS NULL
+        """,
+        (list(ids), list(checksums), server_id),
+    )
+
+
+def quarantine_messages(cursor, server_id, corrupted, detected_by):
+    """Quarantine ``(id, checksum)`` pairs found not to match their content.
+
+    As in ``mark_verified``, a row edited since it was read is left alone.
+    """
+    if not corrupted:
+        return
+    ids, checksums = zip(*corrupted)
+    cursor.execute(
+        """
+        INSERT INTO message_quarantine (message_id, detected_by)
+        SELECT m.id, %s
+        FROM messages AS m
+        JOIN unnest(%s::bigint[], %s::text[]) AS v(id, checksum) ON m.id = v.id AND m.checksum = v.checksum
+        WHERE m.server_id = %s
+        ON CONFLICT (message_id) DO NOTHING
+        """,
+        (detected_by, list(ids), list(checksums), server_id),
+    )
+
+
+def quarantine_summary(connection, server_id, recent=20):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT q.message_id, q.detected_at, q.detected_by
+            FROM message_quarantine AS q
+            JOIN messages AS m ON m.id = q.message_id
+            WHERE m.server_id = %s
+            ORDER BY q.detected_at DESC
+            """,
+            (server_id,),
+        )
+        rows = cursor.fetchall()
+    return {
+        "count": len(rows),
+        "recent": [
+            {"message_id": message_id, "detected_at": detected_at.isoformat(), "detected_by": detected_by}
+            for message_id, detected_at, detected_by in rows[:recent]
+        ],
+    }
+
+
+SCRUB_CHUNK_SQL = """
+    SELECT id, content, checksum, checksum_algo, verified_at IS NOT NULL,
+           EXISTS (SELECT 1 FROM message_quarantine AS q WHERE q.message_id = messages.id)
+    FROM messages
+    WHERE server_id = %s AND id > %s
+    ORDER BY id
+    LIMIT %s
+"""
+
+
+class Scrubber:
+    """Walks one server's messages in id order, verifying every checksum.
+
+    Each chunk of ``batch_size`` rows is fetched with keyset pagination
+    (``id > last id seen``) in its own short transaction, and the walk
+    sleeps between chunks to stay under ``rows_per_sec`` (0 means no
+    limit). Mismatching rows are quarantined, quarantined rows that match
+    again are released, and unverified rows that match are marked
+    verified. After a full pass it rests ``interval`` seconds.
+    """
+
+    def __init__(self, get_connection, server_id, rows_per_sec=1000, batch_size=500, interval=60.0):
+        self._get_connection = get_connection
+        self.server_id = server_id
+        self.rows_per_sec = rows_per_sec
+        self.batch_size = batch_size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.state = "idle"
+        self.position = 0
+        self.pass_total = 0
+        self.passes = 0
+        self.pass_rows = 0
+        self.pass_started = None
+        self.last_pass = None
+        self.rows_checked = 0
+        self.corrupted_found = 0
+        self.released = 0
+        self.errors = 0
+
+    def start(self):
+        """Run in a daemon thread; ``interval`` 0 disables it."""
+        if self.interval <= 0:
+            return None
+        self._thread = threading.Thread(target=self._run, name="integrity-scrubber", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def scrub_chunk(self, connection, after_id):
+        """Verify the next chunk after ``after_id``; returns ``(rows_checked, last_id, corrupted_ids)``."""
+        with connection.cursor() as cursor:
+            cursor.execute(SCRUB_CHUNK_SQL, (self.server_id, after_id, self.batch_size))
+            rows = cursor.fetchall()
+            verified = []
+            corrupted = []
+            released = []
+            for message_id, content, checksum, algorithm, is_verified, quarantined in rows:
+                if not checksum_matches(content, checksum, algorithm):
+                    if not quarantined:
+                        corrupted.append((message_id, checksum))
+                    continue
+                if quarantined:
+                    released.append(message_id)
+                if not is_verified:
+                    verified.append((message_id, checksum))
+            quarantine_messages(cursor, self.server_id, corrupted, "scrub")
+            mark_verified(cursor, self.server_id, verified)
+            if released:
+                cursor.execute("DELETE FROM message_quarantine WHERE message_id = ANY(%s)", (released,))
+        connection.commit()
+
+        with self._lock:
+            self.rows_checked += len(rows)
+            self.corrupted_found += len(corrupted)
+            self.released += len(released)
+        return len(rows), rows[-1][0] if rows else after_id, [message_id for message_id, _ in corrupted]
+
+    def run_pass(self):
+        with self._get_connection() as connection:
+            total = read_message_count(connection, self.server_id)
+        with self._lock:
+            self.state = "scanning"
+            self.position = 0
+            self.pass_total = total
+            self.pass_rows = 0
+            self.pass_started = time.time()
+
+        # Ids can be any BIGINT, negative ones included.
+        after_id = MESSAGE_ID_MIN - 1
+        while True:
+            started = time.monotonic()
+            with self._get_connection() as connection:
+                checked, after_id, corrupted = self.scrub_chunk(connection, after_id)
+            with self._lock:
+                self.position = after_id
+                self.pass_rows += checked
+            if corrupted:
+                print(f"Integrity scrub on {self.server_id} quarantined messages {corrupted}", flush=True)
+            if checked < self.batch_size:
+                break
+            if self.rows_per_sec > 0:
+                time.sleep(max(0.0, checked / self.rows_per_sec - (time.monotonic() - started)))
+
+        with self._lock:
+            duration = time.time() - self.pass_started
+            self.passes += 1
+            self.state = "idle"
+            self.last_pass = {
+                "finished_at": time.time(),
+                "rows": self.pass_rows,
+                "seconds": round(duration, 3),
+                "rows_per_sec": round(self.pass_rows / duration, 1) if duration > 0 else None,
+            }
+
+    def _run(self):
+        while True:
+            try:
+                self.run_pass()
+            except Exception as error:
+                with self._lock:
+                    self.errors += 1
+                    self.state = "idle"
+                print(f"Integrity scrub failed: {error}", flush=True)
+            time.sleep(self.interval)
+
+    def status(self):
+        with self._lock:
+            status = {
+                "running": self._thread is not None,
+                "state": self.state,
+                "rows_per_sec_limit": self.rows_per_sec,
+                "batch_size": self.batch_size,
+                "interval": self.interval,
+                "passes": self.passes,
+                "rows_checked": self.rows_checked,
+                "corrupted_found": self.corrupted_found,
+                "released": self.released,
+                "errors": self.errors,
+                "last_pass": self.last_pass,
+            }
+            if self.state == "scanning":
+                elapsed = time.time() - self.pass_started
+                status["current_pass"] = {
+                    "position": self.position,
+                    "rows": self.pass_rows,
+                    "total": self.pass_total,
+                    "progress": round(min(1.0, self.pass_rows / self.pass_total), 3) if self.pass_total else 1.0,
+                    "rows_per_sec": round(self.pass_rows / elapsed, 1) if elapsed > 0 else None,
+                }
+        return status
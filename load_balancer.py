@@ -1,61 +1,318 @@
-from flask import Flask, jsonify, request, render_template, redirect, url_for
+from flask import Flask, Response, jsonify, request, render_template, redirect, stream_with_context, url_for
+import asyncio
 import requests
+import json
 import os
 import psycopg2
+import threading
+import time
+
+from backend_http import BackendSessions, is_timeout, parse_replicas
+from dashboard_snapshot import SnapshotRefresher
+from db_pool import DatabaseConnectionError, LazyPool
+from event_log import EventSpill, make_event
+from fanout import scatter_gather
+from health_checker import HealthChecker
+from message_ids import MessageIdError, invalid_text_field, parse_message_id
+from message_index import MessageLocationIndex
+from message_reads import BackendStatusError, MessageReads, fanout_headers
+from migrations import migrate_on_startup
+from pagination import PaginationError, parse_limit
+from resilience import AdaptiveTimeouts, CircuitBreakers, RetryBudget
+from routing import BackendLoad, Router, RoutingError, is_keyed, parse_weights
+from routing_state import routing_state_from_env
+from sharding import HashRing, note_displaced, rebalance, set_rebalancing, shard_state, single_shard_allowed
+from spool import DeliveryError, Spool, generate_message_id
+from user_cache import UserBloomFilter, UserExistenceCache
 
 
 app = Flask(__name__)
 
-server_status = {
-    "S1": "UP",
-    "S2": "UP",
-    "S3": "UP",
-}
-
-available_servers = ["S1", "S2", "S3"]
-current_index = 0
-last_routed = None
-event_logs = []
-
+# Storage server ids in routing order; each one's base URL is <ID>_URL.
 server_urls = {
-    "S1": os.getenv("S1_URL", ""),
-    "S2": os.getenv("S2_URL", ""),
-    "S3": os.getenv("S3_URL", ""),
+    server_id.strip(): os.getenv(f"{server_id.strip()}_URL", "")
+    for server_id in os.getenv("SERVERS", "S1,S2,S3").split(",")
+    if server_id.strip()
 }
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+backend_load = BackendLoad(server_urls, decay=float(os.getenv("ROUTING_EWMA_DECAY", "10")))
+circuit_breakers = None
+if os.getenv("CIRCUIT_BREAKER_ENABLED", "1") == "1":
+    circuit_breakers = CircuitBreakers(
+        server_urls,
+        on_change=lambda server_id, before, after: on_breaker_change(server_id, before, after),
+        window_size=int(os.getenv("CIRCUIT_BREAKER_WINDOW", "20")),
+        min_calls=int(os.getenv("CIRCUIT_BREAKER_MIN_CALLS", "5")),
+        failure_rate=float(os.getenv("CIRCUIT_BREAKER_FAILURE_RATE", "0.5")),
+        slow_call_rate=float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_RATE", "0.8")),
+        slow_call_seconds=float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_MS", "2000")) / 1000,
+        open_seconds=float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "5")),
+        half_open_calls=int(os.getenv("CIRCUIT_BREAKER_HALF_OPEN_CALLS", "2")),
+    )
+http_pool = BackendSessions(
+    server_urls,
+    tracker=backend_load,
+    breakers=circuit_breakers,
+    replicas=parse_replicas(os.getenv("SERVER_REPLICAS", "")),
+)
+ADAPTIVE_TIMEOUTS = os.getenv("ADAPTIVE_TIMEOUTS", "1") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+read_timeouts = AdaptiveTimeouts(
+    factor=float(os.getenv("READ_TIMEOUT_FACTOR", "3")),
+    percentile=float(os.getenv("READ_TIMEOUT_PERCENTILE", "0.99")),
+    floor=float(os.getenv("READ_TIMEOUT_MIN_MS", "250")) / 1000,
+    ceiling=float(os.getenv("READ_TIMEOUT_MAX_MS", "5000")) / 1000,
+    min_samples=int(os.getenv("READ_TIMEOUT_MIN_SAMPLES", "50")),
+)
+routing_state = routing_state_from_env(server_urls)
+event_spill = EventSpill(os.environ["EVENT_SPILL_PATH"]) if os.getenv("EVENT_SPILL_PATH") else None
+shard_ring = HashRing(
+    [server_id.strip() for server_id in os.getenv("SHARD_SERVERS", ",".join(server_urls)).split(",") if server_id.strip()],
+    vnodes=int(os.getenv("SHARD_VNODES", "160")),
+)
+router = Router(
+    server_urls,
+    backend_load,
+    algorithm=os.getenv("ROUTING_ALGORITHM", "round_robin"),
+    weights=parse_weights(os.getenv("ROUTING_WEIGHTS", "")),
+    ring=shard_ring,
+    state=routing_state,
+)
+
+ROUTE_BATCH_MAX = int(os.getenv("ROUTE_BATCH_MAX", "1000"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+DASHBOARD_STREAM_MAX_SECONDS = float(os.getenv("DASHBOARD_STREAM_MAX_SECONDS", "300"))
+DASHBOARD_HEARTBEAT = float(os.getenv("DASHBOARD_HEARTBEAT", "15"))
+# Each open stream holds a request thread; leave most of them for /route.
+DASHBOARD_MAX_STREAMS = int(os.getenv("DASHBOARD_MAX_STREAMS", max(1, int(os.getenv("LB_THREADS", "32")) // 4)))
+dashboard_streams = threading.BoundedSemaphore(DASHBOARD_MAX_STREAMS)
+EVENTS_PAGE_SIZE = int(os.getenv("EVENTS_PAGE_SIZE", "1000"))
+ROUTE_MODE = os.getenv("ROUTE_MODE", "sync")
+ROUTE_RETRY_ATTEMPTS = int(os.getenv("ROUTE_RETRY_ATTEMPTS", "2"))
+
+retry_budget = RetryBudget(
+    ratio=float(os.getenv("ROUTE_RETRY_RATIO", "0.2")),
+    min_per_sec=float(os.getenv("ROUTE_RETRY_MIN_PER_SEC", "1")),
+    capacity=float(os.getenv("ROUTE_RETRY_BURST", "10")),
+)
+
+
+def _connect():
+    try:
+        return psycopg2.connect(DATABASE_URL)
+    except psycopg2.OperationalError as error:
+        raise DatabaseConnectionError(str(error)) from error
+
+
+db_pool = LazyPool(_connect)
+
 
 def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
+    return db_pool.connection()
+
+
+message_index = MessageLocationIndex(
+    get_db_connection,
+    capacity=int(os.getenv("MESSAGE_INDEX_CACHE_SIZE", "100000")),
+)
+
+user_cache = UserExistenceCache(
+    positive_ttl=float(os.getenv("USER_CACHE_POSITIVE_TTL", "300")),
+    negative_ttl=float(os.getenv("USER_CACHE_NEGATIVE_TTL", "5")),
+    max_entries=int(os.getenv("USER_CACHE_SIZE", "50000")),
+)
+
+USER_BLOOM_FILTER = os.getenv("USER_BLOOM_FILTER", "0") == "1"
+
+
+def load_usernames():
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT username FROM users")
+        usernames = [username for (username,) in cursor]
+        cursor.close()
+    return usernames
+
+
+user_bloom = UserBloomFilter(load_usernames, refresh_interval=float(os.getenv("USER_BLOOM_REFRESH", "60")))
+
+
+def current_user_bloom():
+    if not USER_BLOOM_FILTER:
+        return None
+    return user_bloom.current()
+
+
+def receiver_exists(username):
+    cached = user_cache.get(username)
+    if cached is not None:
+        return cached
+
+    bloom = current_user_bloom()
+    if bloom is not None and not bloom.might_contain(username):
+        user_cache.put(username, False)
+        return False
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM users WHERE username = %s", (username,))
+        exists = cursor.fetchone() is not None
+        cursor.close()
 
+    user_cache.put(username, exists)
+    return exists
 
-def add_log(message: str) -> None:
-    event_logs.append(message)
-    if len(event_logs) > 20:
-        event_logs.pop(0)
 
+def add_log(message: str, event_type="info", server_id=None, message_id=None, latency_ms=None) -> None:
+    event = make_event(event_type, message, server_id, message_id, latency_ms)
+    seq = routing_state.append_event(event)
+    if event_spill is not None:
+        event_spill.submit(dict(event, seq=seq))
 
-def get_next_server():
-    global current_index
 
-    if not available_servers:
+def on_breaker_change(server_id, before, after):
+    message = f"Circuit breaker for {server_id} {before} -> {after}"
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        add_log(message, "breaker", server_id)
+        return
+    # Breakers also trip on the ASGI app's event loop (load_balancer_asgi.py),
+    # where the log write, SQLite with ROUTING_STATE=sqlite, must not block.
+    loop.run_in_executor(None, add_log, message, "breaker", server_id)
+
+
+def server_statuses():
+    return routing_state.statuses()
+
+
+def available_servers(statuses=None):
+    statuses = server_statuses() if statuses is None else statuses
+    return [server_id for server_id, status in statuses.items() if status == "UP"]
+
+
+def probe_health(server_id, server_url, timeout):
+    # Probes bypass the breaker: they are how a DOWN server comes back.
+    response = http_pool.get(server_id, "/health", timeout=timeout, use_breaker=False)
+    return response.status_code == 200
+
+
+def on_health_change(server_id, healthy, detail):
+    # Every worker runs its own checker; only the one that flips the
+    # shared state logs it.
+    before, after = routing_state.set_down(server_id, "health", not healthy)
+    if before == after:
+        return
+    if healthy:
+        add_log(f"Server {server_id} passed health checks, marked {after}", "health", server_id)
+    else:
+        add_log(f"Server {server_id} failed health check ({detail}), marked DOWN", "health", server_id)
+
+
+health_checker = HealthChecker(
+    server_urls,
+    probe_health,
+    on_health_change,
+    interval=float(os.getenv("HEALTH_CHECK_INTERVAL", "2")),
+    timeout=float(os.getenv("HEALTH_CHECK_TIMEOUT", "1")),
+    rise=int(os.getenv("HEALTH_CHECK_RISE", "2")),
+    fall=int(os.getenv("HEALTH_CHECK_FALL", "1")),
+)
+
+HEALTH_CHECK_ENABLED = os.getenv("HEALTH_CHECK_ENABLED", "1") == "1"
+
+
+@app.before_request
+def start_background_jobs():
+    if HEALTH_CHECK_ENABLED:
+        health_checker.ensure_started()
+    if USER_BLOOM_FILTER:
+        user_bloom.ensure_started()
+    if ROUTE_MODE == "async":
+        # Starting early also adopts spool segments left by dead workers.
+        spool.ensure_started()
+
+
+def get_next_server(key=None, exclude=()):
+    candidates = [
+        server_id
+        for server_id in available_servers()
+        if server_id not in exclude and (circuit_breakers is None or circuit_breakers.available(server_id))
+    ]
+    if not candidates:
         raise ValueError("No available servers")
 
-    total_servers = len(available_servers)
-    checked = 0
+    return router.choose(candidates, key)
+
+
+def record_placement(receiver, server_id):
+    """Flag receivers whose message had to be stored away from their home shard."""
+    home = router.home(receiver)
+    if home is None or home == server_id:
+        return
+    try:
+        with get_db_connection() as connection:
+            note_displaced(connection, receiver, server_id)
+    except Exception as error:
+        add_log(f"Could not record displaced receiver {receiver} on {server_id}: {error}", "error", server_id)
+        return
+    add_log(f"Receiver {receiver} displaced from {home} to {server_id}", "displaced", server_id)
+
+
+message_reads = MessageReads(
+    server_urls,
+    router,
+    server_statuses,
+    read_timeouts,
+    adaptive=ADAPTIVE_TIMEOUTS,
+    hedge_percentile=HEDGE_PERCENTILE,
+)
+
+
+def inbox_targets(username):
+    """Servers an inbox read must ask: the home shard alone when that is safe."""
+    home = message_reads.home(username)
+    if home is None:
+        return server_urls
+    try:
+        with get_db_connection() as connection:
+            single_shard = single_shard_allowed(connection, username)
+    except Exception:
+        single_shard = False
+    return message_reads.inbox_targets(home, single_shard)
 
-    while checked < total_servers:
-        index = current_index % total_servers
-        server_id = available_servers[index]
-        current_index = (index + 1) % total_servers
 
-        if server_status.get(server_id) == "UP":
-            return server_id
+def _fetch_json(method, path):
+    def call(server_id, server_url, timeout):
+        response = http_pool.request(server_id, method, path, timeout=timeout)
+        if response.status_code != 200:
+            raise BackendStatusError(f"HTTP {response.status_code}")
+        return response.json()
 
-        checked += 1
+    return call
 
-    raise ValueError("No UP servers found")
+
+def _fetch_read(endpoint, path):
+    """Like ``_fetch_json("GET", path)`` for bounded reads that are safe to repeat,
+    with the timeout and hedging of ``MessageReads.read_limits``."""
+
+    def call(server_id, server_url, timeout):
+        timeout, hedge_after = message_reads.read_limits(server_id, endpoint, timeout)
+        started = time.monotonic()
+        try:
+            response = http_pool.hedged_get(server_id, path, timeout=timeout, hedge_after=hedge_after)
+        except requests.RequestException as error:
+            if is_timeout(error):
+                message_reads.observe_read(server_id, endpoint, timeout)
+            raise
+        message_reads.observe_read(server_id, endpoint, time.monotonic() - started)
+        if response.status_code != 200:
+            raise BackendStatusError(f"HTTP {response.status_code}")
+        return response.json()
+
+    return call
 
 
 @app.get("/")
@@ -69,6 +326,7 @@ def health():
         {
             "message": "Load Balancer is running",
             "port": os.getenv("PORT", ""),
+            "db_pool": db_pool.stats(),
         }
     )
 
@@ -96,103 +354,511 @@ def dashboard():
 
 @app.get("/servers")
 def get_servers():
-    return jsonify(server_status)
+    return jsonify(server_statuses())
+
+
+def build_backend_snapshot():
+    server_load = {server_id: 0 for server_id in server_urls}
+
+    result = scatter_gather(server_urls, _fetch_read("stats", "/stats"))
+    for server_id, data in result.results.items():
+        server_load[server_id] = int(data.get("message_count", 0))
+
+    return {
+        "server_load": server_load,
+        "total_messages": sum(server_load.values()),
+        "backend_status": result.status,
+        "refreshed_at": time.time(),
+    }
+
+
+backend_snapshot = SnapshotRefresher(
+    build_backend_snapshot,
+    interval=float(os.getenv("DASHBOARD_REFRESH_INTERVAL", "2")),
+    idle_after=float(os.getenv("DASHBOARD_IDLE_AFTER", "60")),
+)
+
+
+def dashboard_payload(snapshot):
+    statuses = server_statuses()
+    available = available_servers(statuses)
+
+    return {
+        "server_status": statuses,
+        "available_servers": available,
+        "current_index": router.cursor % len(available) if available else 0,
+        "server_load": snapshot["server_load"],
+        "total_messages": snapshot["total_messages"],
+        "algorithm": router.strategy.label,
+        "routing": router.stats(),
+        "logs": [event["message"] for event in routing_state.recent_events(20)],
+        "last_routed": routing_state.get("last_routed"),
+        "routing_state": routing_state.describe(),
+        "backend_status": snapshot["backend_status"],
+        "snapshot_refreshed_at": snapshot["refreshed_at"],
+        "http_connections": http_pool.stats(),
+        "message_index": message_index.stats(),
+        "user_cache": user_cache.stats(),
+        "health_checks": health_checker.stats(),
+        "spool": spool.stats(),
+        "retry_budget": retry_budget.stats(),
+        "circuit_breakers": circuit_breakers.stats() if circuit_breakers is not None else None,
+        "read_timeouts": {
+            "adaptive": ADAPTIVE_TIMEOUTS,
+            "servers": read_timeouts.stats(),
+            "replicas": http_pool.replicas,
+            "hedges": http_pool.hedges,
+            "hedge_wins": http_pool.hedge_wins,
+        },
+    }
 
 
 @app.get("/dashboard-data")
 def dashboard_data():
-    server_load = {"S1": 0, "S2": 0, "S3": 0}
+    if request.args.get("fresh") == "1":
+        snapshot = backend_snapshot.refresh_now(force=True)
+    else:
+        snapshot = backend_snapshot.get()
+
+    return jsonify(dashboard_payload(snapshot))
+
+
+@app.get("/dashboard-stream")
+def dashboard_stream():
+    if not dashboard_streams.acquire(blocking=False):
+        return (
+            jsonify({"error": "Too many dashboard streams; poll /dashboard-data instead"}),
+            503,
+            {"Retry-After": str(int(DASHBOARD_HEARTBEAT))},
+        )
+
+    def events():
+        started = time.monotonic()
+        version, snapshot = backend_snapshot.latest()
+        while time.monotonic() - started < DASHBOARD_STREAM_MAX_SECONDS:
+            yield f"data: {json.dumps(dashboard_payload(snapshot), default=str)}\n\n"
+            new_version, snapshot = backend_snapshot.wait_for_update(version, DASHBOARD_HEARTBEAT)
+            if new_version == version:
+                yield ": keep-alive\n\n"
+            version = new_version
+        # Ending the stream makes EventSource reconnect, which frees the
+        # worker thread periodically.
+        yield "retry: 1000\n\n"
+
+    response = Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(dashboard_streams.release)
+    return response
 
-    for server_id, server_url in server_urls.items():
-        try:
-            response = requests.get(f"{server_url}/stats", timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                server_load[server_id] = int(data.get("message_count", 0))
-        except requests.RequestException:
-            continue
 
-    total_messages = sum(server_load.values())
-    logs = event_logs
+@app.get("/events")
+def get_events():
+    try:
+        since = int(request.args.get("since") or 0)
+        limit = min(int(request.args.get("limit") or EVENTS_PAGE_SIZE), EVENTS_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "since and limit must be integers"}), 400
+    types = [item for item in (request.args.get("type") or "").split(",") if item] or None
 
+    events, first_seq, last_seq = routing_state.events(since, types, limit)
     return jsonify(
         {
-            "server_status": server_status,
-            "available_servers": available_servers,
-            "current_index": current_index,
-            "server_load": server_load,
-            "total_messages": total_messages,
-            "algorithm": "Round Robin",
-            "logs": logs,
-            "last_routed": last_routed,
+            "events": events,
+            "next_since": events[-1]["seq"] if len(events) == limit else last_seq,
+            "first_seq": first_seq,
+            "last_seq": last_seq,
+            # Events between ``since`` and ``first_seq`` were overwritten.
+            "truncated": since + 1 < first_seq,
+            "spill": event_spill.stats() if event_spill is not None else None,
         }
     )
 
 
 @app.post("/fail/<server_id>")
 def fail_server(server_id):
-    if server_id not in server_status:
+    if server_id not in server_urls:
         return jsonify({"error": "Invalid server_id"}), 400
 
-    server_status[server_id] = "DOWN"
-    if server_id in available_servers:
-        available_servers.remove(server_id)
-    add_log(f"Server {server_id} marked DOWN")
+    routing_state.set_down(server_id, "manual", True)
+    add_log(f"Server {server_id} marked DOWN", "failover", server_id)
 
-    return jsonify(server_status)
+    return jsonify(server_statuses())
 
 
 @app.post("/restore/<server_id>")
 def restore_server(server_id):
-    if server_id not in server_status:
+    if server_id not in server_urls:
         return jsonify({"error": "Invalid server_id"}), 400
 
-    server_status[server_id] = "UP"
-    if server_id not in available_servers:
-        available_servers.append(server_id)
-    add_log(f"Server {server_id} restored")
+    routing_state.set_down(server_id, "manual", False)
+    if "health" in routing_state.down_reasons(server_id):
+        add_log(f"Server {server_id} restored but still failing health checks", "failover", server_id)
+    else:
+        add_log(f"Server {server_id} restored", "failover", server_id)
+
+    return jsonify(server_statuses())
+
 
-    return jsonify(server_status)
+@app.get("/algorithm")
+def get_algorithm():
+    return jsonify(router.stats())
+
+
+@app.post("/algorithm")
+def set_algorithm():
+    payload = request.get_json(silent=True) or {}
+    algorithm = payload.get("algorithm", router.strategy.name)
+    weights = payload.get("weights")
+    if weights is not None and not isinstance(weights, dict):
+        return jsonify({"error": "weights must be an object"}), 400
+
+    try:
+        router.validate(algorithm, weights)
+    except RoutingError as error:
+        return jsonify({"error": str(error)}), 400
+
+    # Messages placed by a key-blind algorithm are not on their receiver's
+    # home shard, so inbox reads must keep asking every server until
+    # /shards/rebalance has moved them home. Set before switching, so no
+    # read ever trusts the home shard early; only once the request is known
+    # to be valid, so a rejected switch leaves the flag alone.
+    entering_keyed = is_keyed(algorithm) and not router.keyed
+    if entering_keyed:
+        with get_db_connection() as connection:
+            set_rebalancing(connection, True)
+
+    router.set_algorithm(algorithm, weights)
+
+    add_log(f"Routing algorithm set to {router.strategy.label} (weights {router.weights})", "config")
+    if entering_keyed:
+        add_log("Shard rebalancing started; run /shards/rebalance to move existing messages home", "shards")
+    return jsonify(router.stats())
 
 
 @app.post("/route")
 def route_request():
-    global last_routed
-
     payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return jsonify({"error": "message must be an object"}), 400
+    field_error = invalid_text_field(payload)
+    if field_error:
+        return jsonify({"error": field_error}), 400
     receiver = (payload.get("receiver") or "").strip()
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM users WHERE username = %s", (receiver,))
-    matched_receiver = cursor.fetchone()
-    cursor.close()
-    conn.close()
-
-    if matched_receiver is None:
+    if not receiver_exists(receiver):
         return jsonify({"error": "Receiver does not exist"}), 400
 
+    if ROUTE_MODE == "async" or "respond-async" in request.headers.get("Prefer", ""):
+        return enqueue_message(payload)
+
     try:
-        server_id = get_next_server()
+        server_id = get_next_server(receiver)
     except ValueError as error:
         return jsonify({"error": str(error)}), 503
 
+    try:
+        server_id, response, attempts, latency_ms = post_with_failover(payload, receiver, server_id)
+    except RouteFailed as error:
+        return jsonify({"error": str(error), "attempts": error.attempts}), 502
+
+    record_delivery(payload, server_id, latency_ms)
+
+    return jsonify(
+        {
+            "routed_to": server_id,
+            "server_response": response.json(),
+            "attempts": attempts,
+        }
+    )
+
+
+class RouteFailed(Exception):
+    def __init__(self, message, attempts):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+def post_with_failover(payload, receiver, server_id):
+    """POST /receive, moving on to the next UP server after a connect error, timeout or 5xx.
+
+    At most ROUTE_RETRY_ATTEMPTS retries per message, each paid for from
+    the shared retry budget. Resending is safe because the message id is
+    unique: a retry answered "already exists" means an earlier attempt
+    stored it. Returns ``(server_id, response, attempts, latency_ms)``.
+    """
+    retry_budget.record_request()
+    attempts = []
+    while True:
+        attempts.append(server_id)
+        started = time.monotonic()
+        try:
+            response = http_pool.post(server_id, "/receive", json=payload, timeout=5)
+            if response.status_code < 500:
+                response.raise_for_status()
+                return server_id, response, attempts, (time.monotonic() - started) * 1000
+            failure = f"HTTP {response.status_code} from {server_id}"
+        except (requests.ConnectionError, requests.Timeout) as error:
+            failure = f"{server_id}: {error}"
+        except requests.RequestException as error:
+            if len(attempts) > 1 and error.response is not None and "already exists" in error.response.text:
+                stored_on = stored_location(payload.get("id")) or attempts[-2]
+                return stored_on, error.response, attempts, (time.monotonic() - started) * 1000
+            raise RouteFailed(str(error), attempts) from error
+
+        next_server = None
+        if len(attempts) <= ROUTE_RETRY_ATTEMPTS:
+            try:
+                next_server = get_next_server(receiver, exclude=attempts)
+            except ValueError:
+                pass
+        if next_server is None or not retry_budget.try_spend():
+            raise RouteFailed(failure, attempts)
+        add_log(
+            f"Message {payload.get('id')} retrying on {next_server}: {failure}",
+            "retry",
+            server_id,
+            payload.get("id"),
+        )
+        server_id = next_server
+
+
+def stored_location(message_id):
+    if message_id is None:
+        return None
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT server_id FROM messages WHERE id = %s", (message_id,))
+            row = cursor.fetchone()
+            cursor.close()
+    except Exception:
+        return None
+    return row[0] if row else None
+
+
+def record_delivery(payload, server_id, latency_ms):
     message_id = payload.get("id")
-    target_url = f"{server_urls[server_id]}/receive"
+    routing_state.set("last_routed", server_id)
+    if message_id is not None:
+        message_index.record_later(message_id, server_id)
+    record_placement((payload.get("receiver") or "").strip(), server_id)
+    add_log(f"Message {message_id} routed to {server_id}", "route", server_id, message_id, latency_ms)
+
+
+def enqueue_message(payload):
+    """Accept-and-enqueue: spool the message durably and answer 202 before delivery."""
+    if payload.get("id") is None:
+        payload = dict(payload, id=generate_message_id())
+    try:
+        spool_seq = spool.append(payload)
+    except OSError as error:
+        return jsonify({"error": f"Spool unavailable: {error}"}), 503
+
+    return jsonify(
+        {
+            "status": "queued",
+            "id": payload["id"],
+            "spool_seq": spool_seq,
+            "routed_to": None,
+        }
+    ), 202
+
 
+def deliver_spooled(payload):
     try:
-        response = requests.post(target_url, json=payload, timeout=5)
-        response.raise_for_status()
+        server_id = get_next_server((payload.get("receiver") or "").strip())
+    except ValueError as error:
+        raise DeliveryError(str(error)) from error
+
+    started = time.monotonic()
+    try:
+        response = http_pool.post(server_id, "/receive", json=payload, timeout=5)
     except requests.RequestException as error:
-        return jsonify({"error": str(error)}), 502
+        raise DeliveryError(f"{server_id}: {error}") from error
+
+    if response.status_code == 400 and "already exists" in response.text:
+        return  # stored by an earlier attempt whose answer was lost
+    if 400 <= response.status_code < 500:
+        raise DeliveryError(f"{server_id}: HTTP {response.status_code} {response.text[:200]}", retryable=False)
+    if response.status_code != 200:
+        raise DeliveryError(f"{server_id}: HTTP {response.status_code}")
+
+    record_delivery(payload, server_id, (time.monotonic() - started) * 1000)
 
-    last_routed = server_id
-    add_log(f"Message {message_id} routed to {server_id}")
+
+def on_spool_dead_letter(payload, error, attempts):
+    message_id = payload.get("id")
+    add_log(
+        f"Spooled message {message_id} dropped after {attempts} attempts: {error}",
+        "dead_letter",
+        message_id=message_id,
+    )
+
+
+spool = Spool(
+    os.getenv("SPOOL_DIR", "/tmp/mail_lb_spool"),
+    deliver_spooled,
+    on_dead=on_spool_dead_letter,
+    workers=int(os.getenv("SPOOL_WORKERS", "4")),
+    fsync_interval=float(os.getenv("SPOOL_FSYNC_INTERVAL_MS", "5")) / 1000,
+    max_attempts=int(os.getenv("SPOOL_MAX_ATTEMPTS", "10")),
+    backoff_base=float(os.getenv("SPOOL_BACKOFF_BASE", "0.2")),
+    backoff_max=float(os.getenv("SPOOL_BACKOFF_MAX", "30")),
+)
+
+
+def existing_receivers(usernames):
+    """Return the subset of ``usernames`` that exist, with one query for cache misses."""
+    found = set()
+    unknown = []
+    bloom = current_user_bloom()
+
+    for username in set(usernames):
+        cached = user_cache.get(username)
+        if cached is not None:
+            if cached:
+                found.add(username)
+        elif bloom is not None and not bloom.might_contain(username):
+            user_cache.put(username, False)
+        else:
+            unknown.append(username)
+
+    if unknown:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT username FROM users WHERE username = ANY(%s)", (unknown,))
+            matched = {row[0] for row in cursor.fetchall()}
+            cursor.close()
+
+        for username in unknown:
+            user_cache.put(username, username in matched)
+        found |= matched
+
+    return found
+
+
+@app.post("/route/batch")
+def route_batch():
+    payload = request.get_json(silent=True) or {}
+    messages = payload.get("messages") if isinstance(payload, dict) else payload
+    if not isinstance(messages, list):
+        return jsonify({"error": "messages must be a list"}), 400
+    if len(messages) > ROUTE_BATCH_MAX:
+        return jsonify({"error": f"batch exceeds {ROUTE_BATCH_MAX} messages"}), 413
+
+    messages = [message if isinstance(message, dict) else {} for message in messages]
+    field_errors = [invalid_text_field(message) for message in messages]
+    receivers = [
+        "" if field_error else (message.get("receiver") or "").strip()
+        for message, field_error in zip(messages, field_errors)
+    ]
+    valid_receivers = existing_receivers(receivers)
+
+    results = [None] * len(messages)
+    partitions = {}
+    batch_ids = set()
+    for position, (message, receiver) in enumerate(zip(messages, receivers)):
+        if field_errors[position]:
+            results[position] = {"id": message.get("id"), "status": "rejected", "error": field_errors[position]}
+            continue
+        if receiver not in valid_receivers:
+            results[position] = {
+                "id": message.get("id"),
+                "status": "rejected",
+                "error": "Receiver does not exist",
+            }
+            continue
+
+        try:
+            message_id = parse_message_id(message.get("id"))
+        except MessageIdError as error:
+            results[position] = {"id": message.get("id"), "status": "rejected", "error": str(error)}
+            continue
+
+        # Duplicates inside one batch could land on different servers, where
+        # the unique constraint would race; keep the first occurrence only.
+        if message_id in batch_ids:
+            results[position] = {"id": message_id, "status": "rejected", "error": "Message id already exists"}
+            continue
+        batch_ids.add(message_id)
+        messages[position] = {**message, "id": message_id}
+
+        try:
+            server_id = get_next_server(receiver)
+        except ValueError as error:
+            results[position] = {"id": message.get("id"), "status": "rejected", "error": str(error)}
+            continue
+
+        partitions.setdefault(server_id, []).append(position)
+
+    timed_out = set()
+
+    def forward(server_id, server_url, timeout):
+        batch = [messages[position] for position in partitions[server_id]]
+        try:
+            response = http_pool.post(
+                server_id, "/receive/batch", json={"messages": batch}, timeout=timeout
+            )
+        except requests.RequestException as error:
+            if is_timeout(error):
+                timed_out.add(server_id)
+            raise
+        if response.status_code != 200:
+            raise BackendStatusError(f"HTTP {response.status_code}")
+        return response.json().get("results", [])
+
+    result = scatter_gather({server_id: server_urls[server_id] for server_id in partitions}, forward)
+
+    locations = []
+    placements = set()
+    for server_id, positions in partitions.items():
+        server_results = result.results.get(server_id)
+        if server_results is None:
+            status = result.status[server_id]
+            # A batch that was sent but not answered may have been committed;
+            # the client has to check before resending those ids.
+            if server_id in timed_out or (status["status"] == "timeout" and not status.get("queued")):
+                outcome, error = "unknown", "Backend timed out; the messages may have been stored"
+            else:
+                outcome, error = "rejected", f"Backend unavailable: {status.get('error') or status['status']}"
+            for position in positions:
+                results[position] = {
+                    "id": messages[position].get("id"),
+                    "status": outcome,
+                    "routed_to": server_id,
+                    "error": error,
+                }
+            continue
+
+        for position, server_result in zip(positions, server_results):
+            results[position] = {"routed_to": server_id, **server_result}
+            if server_result.get("status") == "stored":
+                locations.append((server_result.get("id"), server_id))
+                placements.add((receivers[position], server_id))
+
+    if locations:
+        try:
+            message_index.record_many(locations)
+        except Exception:
+            pass
+        routing_state.set("last_routed", locations[-1][1])
+    for receiver, server_id in placements:
+        record_placement(receiver, server_id)
+
+    stored = len(locations)
+    unknown = sum(1 for result in results if result["status"] == "unknown")
+    add_log(f"Batch of {len(messages)} messages routed ({stored} stored)", "route_batch")
 
     return jsonify(
         {
-            "routed_to": server_id,
-            "server_response": response.json(),
+            "stored": stored,
+            "rejected": len(messages) - stored - unknown,
+            "unknown": unknown,
+            "results": results,
+            "servers": result.status,
         }
     )
 
@@ -206,24 +872,26 @@ def register_user():
     if not username or not password:
         return jsonify({"error": "username and password are required"}), 400
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT INTO users (username, password)
-        VALUES (%s, %s)
-        ON CONFLICT (username) DO NOTHING
-        """,
-        (username, password),
-    )
-    inserted = cursor.rowcount
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            INSERT INTO users (username, password)
+            VALUES (%s, %s)
+            ON CONFLICT (username) DO NOTHING
+            """,
+            (username, password),
+        )
+        inserted = cursor.rowcount
+        conn.commit()
+        cursor.close()
 
     if inserted == 0:
         return jsonify({"error": "Username already exists"}), 400
 
+    user_cache.invalidate(username)
+    user_bloom.add(username)
+
     if request.is_json:
         return jsonify({"message": "registered", "username": username}), 201
 
@@ -236,12 +904,11 @@ def login_user():
     username = (payload.get("username") or "").strip()
     password = (payload.get("password") or "").strip()
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT password FROM users WHERE username = %s", (username,))
-    row = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT password FROM users WHERE username = %s", (username,))
+        row = cursor.fetchone()
+        cursor.close()
 
     matched = row is not None and row[0] == password
 
@@ -256,82 +923,156 @@ def login_user():
     return redirect(url_for("user_home_page", username=username))
 
 
+def _mark_page_read(username, page):
+    unread = message_reads.unread_by_server(page)
+    if not unread:
+        return
+
+    def mark(server_id, server_url, timeout):
+        response = http_pool.post(
+            server_id, f"/mark-read/{username}", json={"ids": unread[server_id]}, timeout=timeout
+        )
+        if response.status_code != 200:
+            raise BackendStatusError(f"HTTP {response.status_code}")
+        return response.json().get("marked", [])
+
+    result = scatter_gather({server_id: server_urls[server_id] for server_id in unread}, mark)
+    message_reads.apply_read_marks(page, result)
+
+
+def _paged_fanout(username, path, limit, mark_read=False, targets=None):
+    endpoint, page_path = message_reads.page_request(path, limit, request.args.get("before") or None)
+    targets = server_urls if targets is None else targets
+    result = scatter_gather(targets, _fetch_read(endpoint, page_path))
+    page, next_before = message_reads.merge_pages(result, limit)
+    if mark_read:
+        _mark_page_read(username, page)
+
+    return jsonify({"messages": page, "next_before": next_before}), 200, fanout_headers(result)
+
+
+@app.errorhandler(PaginationError)
+def handle_pagination_error(error):
+    return jsonify({"error": str(error)}), 400
+
+
+@app.errorhandler(DatabaseConnectionError)
+def handle_db_connection_error(error):
+    return jsonify({"error": "Database unavailable", "details": str(error)}), 503
+
+
 @app.get("/inbox/<username>")
 def get_inbox(username):
-    merged_messages = []
-    seen_ids = set()
-
-    for _, server_url in server_urls.items():
-        try:
-            response = requests.get(f"{server_url}/messages/{username}", timeout=5)
-            if response.status_code == 200:
-                server_messages = response.json()
-                if isinstance(server_messages, list):
-                    visible_messages = [
-                        message
-                        for message in server_messages
-                    ]
-                    for message in visible_messages:
-                        message_id = message.get("id")
-                        if message_id in seen_ids:
-                            continue
-                        seen_ids.add(message_id)
-                        merged_messages.append(message)
-        except requests.RequestException:
-            continue
+    limit = parse_limit(request.args.get("limit"), MAX_PAGE_SIZE)
+    if limit is not None:
+        return _paged_fanout(
+            username, f"/messages/{username}", limit, mark_read=True, targets=inbox_targets(username)
+        )
 
-    merged_messages.sort(key=lambda item: item.get("timestamp_sent", ""), reverse=True)
-    return jsonify(merged_messages)
+    targets = inbox_targets(username)
+    result = scatter_gather(targets, _fetch_json("GET", f"/messages/{username}"))
+    return jsonify(message_reads.merge_inbox(result, targets)), 200, fanout_headers(result)
 
 
 @app.get("/sent/<username>")
 def get_sent_messages(username):
-    sent_messages = []
-    for _, server_url in server_urls.items():
-        try:
-            response = requests.get(f"{server_url}/sent/{username}", timeout=5)
-            if response.status_code == 200:
-                server_messages = response.json()
-                if isinstance(server_messages, list):
-                    sent_messages.extend(server_messages)
-        except requests.RequestException:
-            continue
+    limit = parse_limit(request.args.get("limit"), MAX_PAGE_SIZE)
+    if limit is not None:
+        return _paged_fanout(username, f"/sent/{username}", limit)
+
+    result = scatter_gather(server_urls, _fetch_json("GET", f"/sent/{username}"))
+    return jsonify(message_reads.merge_sent(result)), 200, fanout_headers(result)
+
 
-    sent_messages.sort(key=lambda item: item.get("timestamp_sent", ""), reverse=True)
+def _sum_deleted(result):
+    return sum(int(data.get("deleted", 0)) for data in result.results.values())
 
-    return jsonify(sent_messages)
+
+def _forget_deleted(result):
+    deleted_ids = [message_id for data in result.results.values() for message_id in data.get("ids", [])]
+    try:
+        message_index.forget_many(deleted_ids)
+    except Exception:
+        pass
 
 
 @app.delete("/sent-history/<username>")
 def clear_sent_history(username):
-    hidden_count = 0
-    for _, server_url in server_urls.items():
-        try:
-            response = requests.delete(f"{server_url}/sent-history/{username}", timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                hidden_count += int(data.get("deleted", 0))
-        except requests.RequestException:
-            continue
+    result = scatter_gather(server_urls, _fetch_json("DELETE", f"/sent-history/{username}"))
+    hidden_count = _sum_deleted(result)
+    _forget_deleted(result)
 
-    add_log(f"Cleared sent history for {username} ({hidden_count} messages hidden)")
-    return jsonify({"message": "Sent history cleared", "deleted": hidden_count})
+    add_log(f"Cleared sent history for {username} ({hidden_count} messages hidden)", "history")
+    return jsonify(
+        {
+            "message": "Sent history cleared",
+            "deleted": hidden_count,
+            "partial": result.partial,
+            "servers": result.status,
+        }
+    )
 
 
 @app.delete("/inbox-history/<username>")
 def clear_inbox_history(username):
-    hidden_count = 0
-    for _, server_url in server_urls.items():
+    result = scatter_gather(server_urls, _fetch_json("DELETE", f"/inbox-history/{username}"))
+    hidden_count = _sum_deleted(result)
+    _forget_deleted(result)
+
+    add_log(f"Cleared inbox history for {username} ({hidden_count} messages hidden)", "history")
+    return jsonify(
+        {
+            "message": "Inbox history cleared",
+            "deleted": hidden_count,
+            "partial": result.partial,
+            "servers": result.status,
+        }
+    )
+
+
+def _locate_message(message_id):
+    try:
+        return message_index.lookup(message_id)
+    except Exception:
+        return None
+
+
+def _send_to_owner(message_id, method, path, **kwargs):
+    """Send a single-message request to the server that stores it.
+
+    The location index is consulted first; on a miss, or when the indexed
+    server no longer has the message, the remaining servers are probed in
+    order as before. The indexed server's 200 or 400 answer is final; from
+    any other server only a 200 stops the probe, and its first 400 is
+    returned if nobody accepts the request. Returns ``(server_id,
+    response)``, or ``(None, None)`` when no server owns the message.
+    """
+    owner = _locate_message(message_id)
+    candidates = list(server_urls)
+    if owner in server_urls:
+        candidates.remove(owner)
+        candidates.insert(0, owner)
+
+    rejected = (None, None)
+    for server_id in candidates:
         try:
-            response = requests.delete(f"{server_url}/inbox-history/{username}", timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                hidden_count += int(data.get("deleted", 0))
+            response = http_pool.request(server_id, method, path, timeout=5, **kwargs)
         except requests.RequestException:
             continue
 
-    add_log(f"Cleared inbox history for {username} ({hidden_count} messages hidden)")
-    return jsonify({"message": "Inbox history cleared", "deleted": hidden_count})
+        if response.status_code == 200 or (response.status_code == 400 and server_id == owner):
+            return server_id, response
+
+        if response.status_code == 400 and rejected[1] is None:
+            rejected = (server_id, response)
+
+        if server_id == owner and response.status_code == 404:
+            try:
+                message_index.forget(message_id)
+            except Exception:
+                pass
+
+    return rejected
 
 
 @app.put("/edit-message/<message_id>")
@@ -339,44 +1080,93 @@ def edit_message(message_id):
     payload = request.get_json(silent=True) or {}
     content = payload.get("content", "")
 
-    for server_id, server_url in server_urls.items():
-        try:
-            response = requests.put(
-                f"{server_url}/edit/{message_id}",
-                json={"content": content},
-                timeout=5,
-            )
+    server_id, response = _send_to_owner(
+        message_id, "PUT", f"/edit/{message_id}", json={"content": content}
+    )
 
-            if response.status_code == 200:
-                add_log(f"Message {message_id} edited on {server_id}")
-                return jsonify({"server": server_id, **response.json()})
+    if response is None:
+        return jsonify({"error": "Message not found"}), 404
 
-            if response.status_code == 400:
-                return jsonify(response.json()), 400
-        except requests.RequestException:
-            continue
+    if response.status_code == 400:
+        return jsonify(response.json()), 400
 
-    return jsonify({"error": "Message not found"}), 404
+    try:
+        message_index.record(message_id, server_id)
+    except Exception:
+        pass
+    add_log(f"Message {message_id} edited on {server_id}", "edit", server_id, message_id)
+    return jsonify({"server": server_id, **response.json()})
 
 
 @app.delete("/delete-message/<message_id>")
 def delete_message(message_id):
-    for server_id, server_url in server_urls.items():
-        try:
-            response = requests.delete(f"{server_url}/delete/{message_id}", timeout=5)
+    server_id, response = _send_to_owner(message_id, "DELETE", f"/delete/{message_id}")
 
-            if response.status_code == 200:
-                add_log(f"Message {message_id} deleted on {server_id}")
-                return jsonify({"server": server_id, **response.json()})
+    if response is None:
+        return jsonify({"error": "Message not found"}), 404
 
-            if response.status_code == 400:
-                return jsonify(response.json()), 400
-        except requests.RequestException:
-            continue
+    if response.status_code == 400:
+        return jsonify(response.json()), 400
+
+    try:
+        message_index.forget(message_id)
+    except Exception:
+        pass
+    add_log(f"Message {message_id} deleted on {server_id}", "delete", server_id, message_id)
+    return jsonify({"server": server_id, **response.json()})
+
+
+@app.post("/message-index/rebuild")
+def rebuild_message_index():
+    indexed = message_index.rebuild()
+    add_log(f"Message location index rebuilt ({indexed} messages)", "index")
+    return jsonify({"message": "Message index rebuilt", "indexed": indexed})
+
+
+@app.get("/shards")
+def get_shards():
+    with get_db_connection() as connection:
+        state = shard_state(connection)
+    return jsonify({"routing_key_mode": router.keyed, **state, "ring": router.stats()["ring"]})
+
+
+@app.post("/shards")
+def update_shards():
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload.get("rebalancing"), bool):
+        return jsonify({"error": "rebalancing must be true or false"}), 400
+
+    with get_db_connection() as connection:
+        set_rebalancing(connection, payload["rebalancing"])
+        state = shard_state(connection)
+    add_log(f"Shard rebalancing {'started' if payload['rebalancing'] else 'finished'}", "shards")
+    return jsonify(state)
+
+
+@app.post("/shards/rebalance")
+def rebalance_shards():
+    up_servers = set(available_servers())
+    with get_db_connection() as connection:
+        moved, skipped = rebalance(connection, shard_ring, up_servers)
+        rebalancing = shard_state(connection)["rebalancing"]
+        # Every receiver is home now, so reads may trust the home shard again.
+        finished = rebalancing and not skipped
+        if finished:
+            set_rebalancing(connection, False)
+            rebalancing = False
+    try:
+        message_index.record_many(moved)
+    except Exception:
+        pass
+    add_log(f"Shards rebalanced ({len(moved)} messages moved, {len(skipped)} receivers waiting)", "shards")
+    if finished:
+        add_log("Shard rebalancing finished", "shards")
+    return jsonify({"moved": len(moved), "still_displaced": skipped, "rebalancing": rebalancing})
 
-    return jsonify({"error": "Message not found"}), 404
 
 if __name__ == "__main__":
     import os
     port = int(os.environ.get("PORT", 8080))
+    migrate_on_startup(get_db_connection)
+    start_background_jobs()
     app.run(host="0.0.0.0", port=port)
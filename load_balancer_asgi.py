@@ -0,0 +1,162 @@
+"""ASGI entry point for the load balancer.
+
+Inbox and sent reads, the fan-outs that park a Flask worker thread for up
+to the whole fan-out deadline, are served natively on the event loop with
+httpx. Target selection, timeouts and merging are the Flask app's
+``message_reads``, and the shard lookup, which reads routing state and the
+database, runs in a worker thread. Every other route is the Flask app from
+load_balancer.py, run in a thread pool behind a2wsgi, so templates, JSON
+contracts and shared state (routing, breakers, timeouts, event log) are
+the same whichever entry point is used.
+
+Run with: uvicorn load_balancer_asgi:app --port 5000
+"""
+import asyncio
+import contextlib
+import os
+import time
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+import load_balancer as lb
+from backend_http_async import AsyncBackendSessions
+from fanout import async_scatter_gather
+from message_reads import BackendStatusError, fanout_headers
+from migrations import migrate_on_startup
+from pagination import PaginationError, parse_limit
+
+
+LB_THREADS = int(os.getenv("LB_THREADS", "32"))
+
+http_pool = AsyncBackendSessions(
+    lb.server_urls,
+    tracker=lb.backend_load,
+    breakers=lb.circuit_breakers,
+    replicas=lb.http_pool.replicas,
+)
+
+
+async def inbox_targets(username):
+    """``load_balancer.inbox_targets`` off the event loop: it reads routing state and the database."""
+    return await asyncio.to_thread(lb.inbox_targets, username)
+
+
+def _fetch_json(method, path):
+    async def call(server_id, server_url, timeout):
+        response = await http_pool.request(server_id, method, path, timeout=timeout)
+        if response.status_code != 200:
+            raise BackendStatusError(f"HTTP {response.status_code}")
+        return response.json()
+
+    return call
+
+
+def _fetch_read(endpoint, path):
+    """Async ``load_balancer._fetch_read``, feeding the same latency histograms."""
+
+    async def call(server_id, server_url, timeout):
+        timeout, hedge_after = lb.message_reads.read_limits(server_id, endpoint, timeout)
+        # Timed from when the request gets a slot, not while it queues for one.
+        sent = []
+        try:
+            response = await http_pool.hedged_get(
+                server_id, path, timeout=timeout, hedge_after=hedge_after, on_sent=lambda: sent.append(time.monotonic())
+            )
+        except httpx.TimeoutException:
+            lb.message_reads.observe_read(server_id, endpoint, timeout)
+            raise
+        except asyncio.CancelledError:
+            # Cut off by the fan-out deadline: it took at least that long.
+            if sent:
+                lb.message_reads.observe_read(server_id, endpoint, timeout)
+            raise
+        lb.message_reads.observe_read(server_id, endpoint, time.monotonic() - sent[0])
+        if response.status_code != 200:
+            raise BackendStatusError(f"HTTP {response.status_code}")
+        return response.json()
+
+    return call
+
+
+async def _mark_page_read(username, page):
+    unread = lb.message_reads.unread_by_server(page)
+    if not unread:
+        return
+
+    async def mark(server_id, server_url, timeout):
+        response = await http_pool.post(
+            server_id, f"/mark-read/{username}", json={"ids": unread[server_id]}, timeout=timeout
+        )
+        if response.status_code != 200:
+            raise BackendStatusError(f"HTTP {response.status_code}")
+        return response.json().get("marked", [])
+
+    result = await async_scatter_gather({server_id: lb.server_urls[server_id] for server_id in unread}, mark)
+    lb.message_reads.apply_read_marks(page, result)
+
+
+async def _paged_fanout(request, username, path, limit, mark_read=False, targets=None):
+    endpoint, page_path = lb.message_reads.page_request(path, limit, request.query_params.get("before") or None)
+    targets = lb.server_urls if targets is None else targets
+    result = await async_scatter_gather(targets, _fetch_read(endpoint, page_path))
+    page, next_before = lb.message_reads.merge_pages(result, limit)
+    if mark_read:
+        await _mark_page_read(username, page)
+
+    return JSONResponse({"messages": page, "next_before": next_before}, headers=fanout_headers(result))
+
+
+async def get_inbox(request):
+    username = request.path_params["username"]
+    limit = parse_limit(request.query_params.get("limit"), lb.MAX_PAGE_SIZE)
+    targets = await inbox_targets(username)
+    if limit is not None:
+        return await _paged_fanout(request, username, f"/messages/{username}", limit, mark_read=True, targets=targets)
+
+    result = await async_scatter_gather(targets, _fetch_json("GET", f"/messages/{username}"))
+    return JSONResponse(lb.message_reads.merge_inbox(result, targets), headers=fanout_headers(result))
+
+
+async def get_sent_messages(request):
+    username = request.path_params["username"]
+    limit = parse_limit(request.query_params.get("limit"), lb.MAX_PAGE_SIZE)
+    if limit is not None:
+        return await _paged_fanout(request, username, f"/sent/{username}", limit)
+
+    result = await async_scatter_gather(lb.server_urls, _fetch_json("GET", f"/sent/{username}"))
+    return JSONResponse(lb.message_reads.merge_sent(result), headers=fanout_headers(result))
+
+
+async def handle_pagination_error(request, error):
+    return JSONResponse({"error": str(error)}, status_code=400)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    migrate_on_startup(lb.get_db_connection)
+    lb.start_background_jobs()
+    try:
+        yield
+    finally:
+        await http_pool.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route("/inbox/{username}", get_inbox, methods=["GET"]),
+        Route("/sent/{username}", get_sent_messages, methods=["GET"]),
+        Mount("/", app=WSGIMiddleware(lb.app, workers=LB_THREADS)),
+    ],
+    exception_handlers={PaginationError: handle_pagination_error},
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,71 @@
+import threading
+import time
+
+
+def read_message_count(connection, server_id):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT message_count FROM server_message_counts WHERE server_id = %s",
+            (server_id,),
+        )
+        row = cursor.fetchone()
+    return int(row[0]) if row else 0
+
+
+def reconcile_message_count(connection, server_id):
+    """Recount ``server_id``'s messages and correct the summary row.
+
+    The summary row is locked before counting. A concurrent insert or
+    delete then either committed before the lock (and is included in the
+    count) or waits for it in its trigger (and is applied on top of the
+    corrected value). Returns ``(counted, drift)``.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO server_message_counts (server_id, message_count)
+            VALUES (%s, 0)
+            ON CONFLICT (server_id) DO NOTHING
+            """,
+            (server_id,),
+        )
+        connection.commit()
+
+        cursor.execute(
+            "SELECT message_count FROM server_message_counts WHERE server_id = %s FOR UPDATE",
+            (server_id,),
+        )
+        maintained = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM messages WHERE server_id = %s", (server_id,))
+        counted = cursor.fetchone()[0]
+        cursor.execute(
+            """
+            UPDATE server_message_counts
+            SET message_count = %s, reconciled_at = CURRENT_TIMESTAMP
+            WHERE server_id = %s
+            """,
+            (counted, server_id),
+        )
+    connection.commit()
+    return counted, counted - maintained
+
+
+def start_count_reconciler(get_connection, server_id, interval):
+    """Recount in a daemon thread every ``interval`` seconds; 0 disables it."""
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with get_connection() as connection:
+                    counted, drift = reconcile_message_count(connection, server_id)
+                if drift:
+                    print(f"Reconciled {server_id} message count to {counted} (drift {drift})", flush=True)
+            except Exception as error:
+                print(f"Message count reconciliation failed: {error}", flush=True)
+
+    thread = threading.Thread(target=run, name="count-reconciler", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,39 @@
+# messages.id is a BIGINT.
+MESSAGE_ID_MIN = -(2**63)
+MESSAGE_ID_MAX = 2**63 - 1
+
+
+class MessageIdError(ValueError):
+    pass
+
+
+def parse_message_id(raw_id):
+    """Coerce a client-supplied message id to the int the messages table stores.
+
+    Integers and their decimal string forms are accepted; anything else,
+    including bools, floats and ids outside the BIGINT range, raises
+    MessageIdError, so one bad id is rejected before it reaches a
+    multi-row INSERT.
+    """
+    if raw_id is None:
+        raise MessageIdError("id is required")
+    if isinstance(raw_id, bool) or not isinstance(raw_id, (int, str)):
+        raise MessageIdError("id must be an integer")
+    try:
+        message_id = int(raw_id)
+    except ValueError as error:
+        raise MessageIdError("id must be an integer") from error
+    if not MESSAGE_ID_MIN <= message_id <= MESSAGE_ID_MAX:
+        raise MessageIdError("id is out of range")
+    return message_id
+
+
+TEXT_FIELDS = ("sender", "receiver", "content")
+
+
+def invalid_text_field(message):
+    """Error for the first of sender, receiver and content given as something other than a string, else None."""
+    for field in TEXT_FIELDS:
+        if field in message and not isinstance(message[field], str):
+            return f"{field} must be a string"
+    return None
@@ -0,0 +1,225 @@
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+import psycopg2.extras
+
+from message_ids import MessageIdError, parse_message_id
+
+
+UPSERT_LOCATIONS_SQL = """
+    INSERT INTO message_locations (message_id, server_id)
+    VALUES %s
+    ON CONFLICT (message_id) DO UPDATE SET server_id = EXCLUDED.server_id
+"""
+
+
+class MessageLocationIndex:
+    """Maps message ids to the server that stores them.
+
+    Lookups go to an in-memory LRU first and then to the
+    ``message_locations`` table (created by migrations.py), which every load
+    balancer process shares.
+    The table can be rebuilt at any time from ``messages.server_id``, and a
+    lookup that misses it falls back to that column, so entries written by
+    ``record_later`` that are still queued (or were dropped) are still found.
+    Ids are stored as text because they arrive as URL path segments.
+    """
+
+    def __init__(self, get_connection, capacity=100_000, queue_size=10000, batch_size=500):
+        self._get_connection = get_connection
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = queue.Queue(maxsize=queue_size)
+        self._writer = None
+        self._writer_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self.dropped = 0
+
+    def _remember(self, message_id, server_id):
+        with self._lock:
+            self._cache[message_id] = server_id
+            self._cache.move_to_end(message_id)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def lookup(self, message_id):
+        message_id = str(message_id)
+        with self._lock:
+            server_id = self._cache.get(message_id)
+            if server_id is not None:
+                self._cache.move_to_end(message_id)
+                self.hits += 1
+                return server_id
+
+        with self._get_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT server_id FROM message_locations WHERE message_id = %s",
+                    (message_id,),
+                )
+                row = cursor.fetchone()
+                if row is None:
+                    row = self._stored_location(cursor, message_id)
+
+        if row is None or row[0] is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        self._remember(message_id, row[0])
+        return row[0]
+
+    @staticmethod
+    def _stored_location(cursor, message_id):
+        try:
+            message_id = parse_message_id(message_id)
+        except MessageIdError:
+            return None
+        cursor.execute("SELECT server_id FROM messages WHERE id = %s", (message_id,))
+        return cursor.fetchone()
+
+    def record(self, message_id, server_id):
+        message_id = str(message_id)
+        self._remember(message_id, server_id)
+
+        with self._get_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO message_locations (message_id, server_id)
+                    VALUES (%s, %s)
+                    ON CONFLICT (message_id) DO UPDATE SET server_id = EXCLUDED.server_id
+                    """,
+                    (message_id, server_id),
+                )
+            connection.commit()
+
+    def record_many(self, locations):
+        """Record ``(message_id, server_id)`` pairs in one statement."""
+        rows = [(str(message_id), server_id) for message_id, server_id in locations]
+        if not rows:
+            return
+
+        for message_id, server_id in rows:
+            self._remember(message_id, server_id)
+        self._upsert(rows)
+
+    def _upsert(self, rows):
+        with self._get_connection() as connection:
+            with connection.cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, UPSERT_LOCATIONS_SQL, rows, page_size=len(rows))
+            connection.commit()
+
+    def record_later(self, message_id, server_id):
+        """Like ``record``, but the table is written in batches from a background thread.
+
+        The LRU is updated at once. When the writer falls behind and its
+        queue is full the entry only lives in the LRU and is counted as
+        dropped; lookups still find it through ``messages.server_id``.
+        """
+        message_id = str(message_id)
+        self._remember(message_id, server_id)
+        self._ensure_writer()
+        try:
+            self._writes.put_nowait((message_id, server_id))
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_writer(self):
+        pid = os.getpid()
+        if self._writer is not None and self._writer_pid == pid:
+            return
+        with self._lock:
+            if self._writer is not None and self._writer_pid == pid:
+                return
+            self._writer_pid = pid
+            self._writer = threading.Thread(target=self._write_loop, name="message-index-writer", daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            batch = {}
+            message_id, server_id = self._writes.get()
+            batch[message_id] = server_id
+            while len(batch) < self.batch_size:
+                try:
+                    message_id, server_id = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                batch[message_id] = server_id
+            try:
+                self._upsert(list(batch.items()))
+                self.written += len(batch)
+            except Exception as error:
+                self.dropped += len(batch)
+                print(f"Message index write failed: {error}", flush=True)
+
+    def forget(self, message_id):
+        message_id = str(message_id)
+        with self._lock:
+            self._cache.pop(message_id, None)
+
+        with self._get_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM message_locations WHERE message_id = %s",
+                    (message_id,),
+                )
+            connection.commit()
+
+    def forget_many(self, message_ids):
+        """Forget several ids in one statement."""
+        message_ids = [str(message_id) for message_id in message_ids]
+        if not message_ids:
+            return
+
+        with self._lock:
+            for message_id in message_ids:
+                self._cache.pop(message_id, None)
+
+        with self._get_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM message_locations WHERE message_id = ANY(%s)",
+                    (message_ids,),
+                )
+            connection.commit()
+
+    def rebuild(self):
+        """Repopulate the table from ``messages.server_id``; returns the row count."""
+        with self._get_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM message_locations")
+                cursor.execute(
+                    """
+                    INSERT INTO message_locations (message_id, server_id)
+                    SELECT id::text, server_id FROM messages
+                    WHERE server_id IS NOT NULL
+                    """
+                )
+                indexed = cursor.rowcount
+            connection.commit()
+
+        with self._lock:
+            self._cache.clear()
+        return indexed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cached": len(self._cache),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "queued": self._writes.qsize(),
+                "written": self.written,
+                "dropped": self.dropped,
+            }
@@ -0,0 +1,148 @@
+import heapq
+import json
+from urllib.parse import urlencode
+
+from pagination import cursor_key
+
+
+class BackendStatusError(Exception):
+    pass
+
+
+def fanout_headers(result):
+    return {
+        "X-Fanout-Status": json.dumps(result.status, separators=(",", ":")),
+        "X-Fanout-Partial": "true" if result.partial else "false",
+    }
+
+
+class MessageReads:
+    """Inbox and sent fan-out logic shared by the Flask and ASGI load balancers.
+
+    Nothing here talks to a backend: each entry point sends the requests
+    with its own client (requests in threads, httpx on the event loop) and
+    uses these methods to pick targets and timeouts and to merge the
+    answers, so both return the same thing. ``home`` reads routing state,
+    which can be SQLite, so the ASGI app calls it in a worker thread.
+    """
+
+    def __init__(self, server_urls, router, server_statuses, read_timeouts, adaptive=True, hedge_percentile=0.95):
+        self.server_urls = server_urls
+        self.router = router
+        self.server_statuses = server_statuses
+        self.read_timeouts = read_timeouts
+        self.adaptive = adaptive
+        self.hedge_percentile = hedge_percentile
+
+    def home(self, username):
+        """The server holding all of ``username``'s inbox if it is keyed and UP, else None."""
+        home = self.router.home(username)
+        if home is None or self.server_statuses().get(home) != "UP":
+            return None
+        return home
+
+    def inbox_targets(self, home, single_shard):
+        """Servers an inbox read must ask: the home shard alone when that is safe."""
+        if home is None or not single_shard:
+            return self.server_urls
+        return {home: self.server_urls[home]}
+
+    def read_limits(self, server_id, endpoint, timeout):
+        """``(timeout, hedge_after)`` for one bounded, repeatable read.
+
+        The timeout comes from the server's own recent latency on
+        ``endpoint`` instead of the whole fan-out deadline, and a server
+        with replicas is hedged once it is slower than its
+        ``hedge_percentile`` latency.
+        """
+        if self.adaptive:
+            timeout = min(timeout, self.read_timeouts.timeout(server_id, endpoint))
+        hedge_after = self.read_timeouts.quantile(server_id, endpoint, self.hedge_percentile) or timeout
+        return timeout, hedge_after
+
+    def observe_read(self, server_id, endpoint, seconds):
+        self.read_timeouts.observe(server_id, endpoint, seconds)
+
+    @staticmethod
+    def page_request(path, limit, before):
+        """``(endpoint, backend path)`` for one page of ``path``; rejects a malformed cursor."""
+        if before:
+            cursor_key(before)
+        query = {"limit": limit, "peek": 1}
+        if before:
+            query["before"] = before
+        endpoint = path.strip("/").split("/")[0] + "_page"
+        return endpoint, f"{path}?{urlencode(query)}"
+
+    def merge_pages(self, result, limit):
+        """k-way merge of per-server pages that are each sorted newest first.
+
+        Only as many items as the page needs are pulled from the heap; the
+        returned cursor is the position of the last item handed out.
+        """
+        pages = []
+        for server_page in result.ordered(self.server_urls):
+            if isinstance(server_page, dict) and isinstance(server_page.get("messages"), list):
+                pages.append(server_page["messages"])
+
+        merged = heapq.merge(*pages, key=lambda message: cursor_key(message["cursor"]), reverse=True)
+
+        page = []
+        seen_ids = set()
+        for message in merged:
+            if message.get("id") in seen_ids:
+                continue
+            seen_ids.add(message.get("id"))
+            page.append(message)
+            if len(page) == limit:
+                break
+
+        next_before = page[-1]["cursor"] if len(page) == limit else None
+        return page, next_before
+
+    @staticmethod
+    def merge_inbox(result, targets):
+        merged_messages = []
+        seen_ids = set()
+        for server_messages in result.ordered(targets):
+            if not isinstance(server_messages, list):
+                continue
+            for message in server_messages:
+                message_id = message.get("id")
+                if message_id in seen_ids:
+                    continue
+                seen_ids.add(message_id)
+                merged_messages.append(message)
+
+        merged_messages.sort(key=lambda item: item.get("timestamp_sent", ""), reverse=True)
+        return merged_messages
+
+    def merge_sent(self, result):
+        sent_messages = []
+        for server_messages in result.ordered(self.server_urls):
+            if isinstance(server_messages, list):
+                sent_messages.extend(server_messages)
+
+        sent_messages.sort(key=lambda item: item.get("timestamp_sent", ""), reverse=True)
+        return sent_messages
+
+    def unread_by_server(self, page):
+        """Ids of the page's UNREAD messages, grouped by the server that holds them."""
+        unread = {}
+        for message in page:
+            if message.get("status") == "UNREAD" and message.get("server_id") in self.server_urls:
+                unread.setdefault(message["server_id"], []).append(message["id"])
+        return unread
+
+    @staticmethod
+    def apply_read_marks(page, result):
+        """Copy the READ marks the servers confirmed in ``result`` onto the page."""
+        read_at = {}
+        for marked in result.results.values():
+            for entry in marked:
+                read_at[entry["id"]] = entry["timestamp_read"]
+
+        for message in page:
+            if message.get("id") in read_at:
+                message["status"] = "READ"
+                message["timestamp_read"] = read_at[message["id"]]
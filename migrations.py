@@ -0,0 +1,382 @@
+"""Versioned schema migrations for the shared PostgreSQL database.
+
+Every process runs ``migrate()`` on startup. Migrations are applied in
+version order inside one transaction guarded by an advisory lock, so the
+load balancer and all storage servers can start at the same time. Each
+migration must be safe to run against a database that already has the
+objects (the original tables were created by hand), hence IF NOT EXISTS.
+
+Run manually with:
+    python migrations.py           apply pending migrations and check plans
+    python migrations.py --check   only check query plans
+"""
+import json
+import os
+import sys
+
+
+MIGRATION_LOCK_ID = 72_410_001
+
+MIGRATIONS = [
+    (
+        1,
+        "create users and messages",
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS messages (
+            id BIGINT PRIMARY KEY,
+            sender TEXT,
+            receiver TEXT,
+            content TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL DEFAULT 'UNREAD',
+            timestamp_sent TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            timestamp_read TIMESTAMP,
+            checksum TEXT,
+            server_id TEXT NOT NULL
+        );
+        """,
+    ),
+    (
+        2,
+        "message access path indexes",
+        """
+        CREATE INDEX IF NOT EXISTS messages_inbox_idx
+            ON messages (receiver, server_id, timestamp_sent DESC, id DESC)
+            INCLUDE (status);
+
+        CREATE INDEX IF NOT EXISTS messages_sent_idx
+            ON messages (sender, server_id, timestamp_sent DESC, id DESC)
+            INCLUDE (status);
+
+        CREATE INDEX IF NOT EXISTS messages_server_idx
+            ON messages (server_id);
+
+        ANALYZE messages;
+        """,
+    ),
+    (
+        3,
+        "message location index table",
+        """
+        CREATE TABLE IF NOT EXISTS message_locations (
+            message_id TEXT PRIMARY KEY,
+            server_id TEXT NOT NULL
+        );
+        """,
+    ),
+    (
+        4,
+        "trigger-maintained per-server message counts",
+        """
+        CREATE TABLE IF NOT EXISTS server_message_counts (
+            server_id TEXT PRIMARY KEY,
+            message_count BIGINT NOT NULL DEFAULT 0,
+            reconciled_at TIMESTAMP
+        );
+
+        CREATE OR REPLACE FUNCTION messages_count_inserted() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO server_message_counts (server_id, message_count)
+            SELECT server_id, COUNT(*) FROM inserted_rows GROUP BY server_id
+            ON CONFLICT (server_id) DO UPDATE
+            SET message_count = server_message_counts.message_count + EXCLUDED.message_count;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION messages_count_deleted() RETURNS trigger AS $$
+        BEGIN
+            UPDATE server_message_counts AS counts
+            SET message_count = counts.message_count - deleted.total
+            FROM (SELECT server_id, COUNT(*) AS total FROM deleted_rows GROUP BY server_id) AS deleted
+            WHERE counts.server_id = deleted.server_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS messages_count_insert ON messages;
+        CREATE TRIGGER messages_count_insert
+            AFTER INSERT ON messages
+            REFERENCING NEW TABLE AS inserted_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION messages_count_inserted();
+
+        DROP TRIGGER IF EXISTS messages_count_delete ON messages;
+        CREATE TRIGGER messages_count_delete
+            AFTER DELETE ON messages
+            REFERENCING OLD TABLE AS deleted_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION messages_count_deleted();
+
+        INSERT INTO server_message_counts (server_id, message_count, reconciled_at)
+        SELECT server_id, COUNT(*), CURRENT_TIMESTAMP FROM messages GROUP BY server_id
+        ON CONFLICT (server_id) DO UPDATE
+        SET message_count = EXCLUDED.message_count, reconciled_at = EXCLUDED.reconciled_at;
+        """,
+    ),
+    (
+        5,
+        "receiver sharding state",
+        """
+        CREATE TABLE IF NOT EXISTS displaced_receivers (
+            receiver TEXT NOT NULL,
+            server_id TEXT NOT NULL,
+            noted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (receiver, server_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS shard_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            rebalancing BOOLEAN NOT NULL DEFAULT FALSE,
+            changed_at TIMESTAMP
+        );
+        """,
+    ),
+    (
+        6,
+        "checksum algorithm tag and verification marks",
+        """
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS checksum_algo TEXT NOT NULL DEFAULT 'md5';
+        ALTER TABLE messages ADD COLUMN IF NOT EXISTS verified_at TIMESTAMP;
+
+        CREATE INDEX IF NOT EXISTS messages_unverified_idx
+            ON messages (server_id, id)
+            WHERE verified_at IS NULL;
+        """,
+    ),
+    (
+        7,
+        "integrity quarantine",
+        """
+        CREATE TABLE IF NOT EXISTS message_quarantine (
+            message_id BIGINT PRIMARY KEY REFERENCES messages (id) ON DELETE CASCADE,
+            detected_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            detected_by TEXT NOT NULL
+        );
+
+        DROP INDEX IF EXISTS messages_unverified_idx;
+        """,
+    ),
+    (
+        8,
+        "server index keyed by id for the scrubber",
+        """
+        DROP INDEX IF EXISTS messages_server_idx;
+
+        CREATE INDEX messages_server_idx
+            ON messages (server_id, id);
+
+        ANALYZE messages;
+        """,
+    ),
+]
+
+# Representative forms of the statements on the request path, with the
+# index each one is expected to use.
+HOT_QUERIES = {
+    "inbox": (
+        """
+        SELECT id, status, timestamp_sent FROM messages
+        WHERE receiver = %s AND server_id = %s
+        ORDER BY timestamp_sent DESC, id DESC LIMIT 50
+        """,
+        ("user", "S1"),
+        "messages_inbox_idx",
+    ),
+    "inbox_unread": (
+        "SELECT id FROM messages WHERE receiver = %s AND server_id = %s AND status = 'UNREAD'",
+        ("user", "S1"),
+        "messages_inbox_idx",
+    ),
+    "sent": (
+        """
+        SELECT id, status, timestamp_sent FROM messages
+        WHERE sender = %s AND server_id = %s
+        ORDER BY timestamp_sent DESC, id DESC LIMIT 50
+        """,
+        ("user", "S1"),
+        "messages_sent_idx",
+    ),
+    "stats": (
+        "SELECT COUNT(*) FROM messages WHERE server_id = %s",
+        ("S1",),
+        "messages_server_idx",
+    ),
+    "scrub_chunk": (
+        "SELECT id, content FROM messages WHERE server_id = %s AND id > %s ORDER BY id LIMIT 500",
+        ("S1", 0),
+        "messages_server_idx",
+    ),
+    "server_count": (
+        "SELECT message_count FROM server_message_counts WHERE server_id = %s",
+        ("S1",),
+        "server_message_counts_pkey",
+    ),
+    "message_by_id": (
+        "SELECT status FROM messages WHERE id = %s AND server_id = %s",
+        (1, "S1"),
+        "messages_pkey",
+    ),
+    "message_location": (
+        "SELECT server_id FROM message_locations WHERE message_id = %s",
+        ("1",),
+        "message_locations_pkey",
+    ),
+    "displaced_receiver": (
+        "SELECT 1 FROM displaced_receivers WHERE receiver = %s",
+        ("user",),
+        "displaced_receivers_pkey",
+    ),
+    "quarantined": (
+        "SELECT 1 FROM message_quarantine WHERE message_id = %s",
+        (1,),
+        "message_quarantine_pkey",
+    ),
+    "receiver_exists": (
+        "SELECT 1 FROM users WHERE username = %s",
+        ("user",),
+        "users_pkey",
+    ),
+}
+
+
+class MigrationError(Exception):
+    pass
+
+
+def applied_versions(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cursor.execute("SELECT version FROM schema_migrations")
+        return {row[0] for row in cursor.fetchall()}
+
+
+def apply_migrations(connection):
+    """Apply pending migrations; returns the list of versions applied."""
+    applied = []
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+
+    done = applied_versions(connection)
+    for version, name, sql in MIGRATIONS:
+        if version in done:
+            continue
+        with connection.cursor() as cursor:
+            cursor.execute(sql)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (version, name),
+            )
+        applied.append(version)
+
+    connection.commit()
+    return applied
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def _estimated_rows(cursor, table):
+    cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", (table,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def check_query_plans(connection, queries=None, min_rows=None):
+    """EXPLAIN every hot query and raise if it would scan its table.
+
+    ``enable_seqscan`` is switched off for the check so small development
+    tables don't trigger false alarms: the planner then only picks a
+    sequential scan when no index can serve the query at all. Once a table
+    holds at least ``min_rows`` rows a plan that uses another index than the
+    query's own is printed as a warning: the planner may have good reasons
+    for its pick, so only a sequential scan stops startup. Returns the
+    warnings.
+    """
+    queries = HOT_QUERIES if queries is None else queries
+    if min_rows is None:
+        min_rows = int(os.getenv("PLAN_CHECK_MIN_ROWS", "1000"))
+    failures = {}
+    warnings = {}
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            for name, (sql, params, expected_index) in queries.items():
+                cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                nodes = list(_plan_nodes(plan[0]["Plan"]))
+                seq_scans = [node.get("Relation Name") for node in nodes if node["Node Type"] == "Seq Scan"]
+                if seq_scans:
+                    failures[name] = f"sequential scan on {', '.join(seq_scans)}"
+                    continue
+
+                indexes = {node["Index Name"] for node in nodes if "Index Name" in node}
+                tables = {node["Relation Name"] for node in nodes if "Relation Name" in node}
+                large = any(_estimated_rows(cursor, table) >= min_rows for table in tables)
+                if large and expected_index not in indexes:
+                    warnings[name] = f"expected {expected_index}, planner used {sorted(indexes) or 'no index'}"
+    finally:
+        connection.rollback()
+
+    for name, reason in sorted(warnings.items()):
+        print(f"Query plan warning: {name}: {reason}", flush=True)
+
+    if failures:
+        details = "; ".join(f"{name}: {reason}" for name, reason in sorted(failures.items()))
+        raise MigrationError(f"Hot queries are not using their indexes: {details}")
+    return warnings
+
+
+def migrate(get_connection, check_plans=None):
+    """Apply pending migrations and verify query plans, failing loudly on problems."""
+    if check_plans is None:
+        check_plans = os.getenv("CHECK_QUERY_PLANS", "1") == "1"
+
+    with get_connection() as connection:
+        applied = apply_migrations(connection)
+        if check_plans:
+            check_query_plans(connection)
+    return applied
+
+
+def migrate_on_startup(get_connection):
+    if os.getenv("RUN_MIGRATIONS", "1") != "1":
+        return
+    applied = migrate(get_connection)
+    if applied:
+        print(f"Applied migrations: {applied}", flush=True)
+
+
+if __name__ == "__main__":
+    import psycopg2
+
+    def connect():
+        return psycopg2.connect(os.environ["DATABASE_URL"])
+
+    connection = connect()
+    try:
+        if "--check" in sys.argv[1:]:
+            check_query_plans(connection)
+            print("Query plans OK")
+        else:
+            print(f"Applied migrations: {apply_migrations(connection) or 'none'}")
+            check_query_plans(connection)
+            print("Query plans OK")
+    finally:
+        connection.close()
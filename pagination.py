@@ -0,0 +1,46 @@
+import base64
+import json
+from datetime import datetime
+
+
+CURSOR_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+class PaginationError(ValueError):
+    pass
+
+
+def encode_cursor(timestamp_sent, message_id):
+    """Opaque keyset cursor for a message's (timestamp_sent, id) position."""
+    raw = json.dumps([timestamp_sent.strftime(CURSOR_TIME_FORMAT), message_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def cursor_key(cursor):
+    """Sortable (timestamp string, id) pair; the fixed-width timestamp sorts correctly as text."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp_text, message_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        datetime.strptime(timestamp_text, CURSOR_TIME_FORMAT)
+    except (ValueError, TypeError, AttributeError) as error:
+        raise PaginationError("Invalid cursor") from error
+    return timestamp_text, message_id
+
+
+def decode_cursor(cursor):
+    """Return (timestamp_sent, id) for use as SQL parameters."""
+    timestamp_text, message_id = cursor_key(cursor)
+    return datetime.strptime(timestamp_text, CURSOR_TIME_FORMAT), message_id
+
+
+def parse_limit(raw_limit, maximum):
+    """Parse a ``limit`` query argument; None means "no pagination requested"."""
+    if raw_limit in (None, ""):
+        return None
+    try:
+        limit = int(raw_limit)
+    except ValueError as error:
+        raise PaginationError("limit must be an integer") from error
+    if limit < 1:
+        raise PaginationError("limit must be positive")
+    return min(limit, maximum)
@@ -0,0 +1,336 @@
+import bisect
+import threading
+import time
+from collections import deque
+
+
+class RetryBudget:
+    """Token bucket that caps retries at a share of first attempts.
+
+    Every first attempt deposits ``ratio`` tokens and every retry spends
+    one, so during a brownout retries add at most ``ratio`` extra load on
+    top of the original traffic instead of doubling it. ``min_per_sec``
+    tokens trickle in regardless, so a quiet load balancer can still
+    retry now and then. The bucket never holds more than ``capacity``.
+    """
+
+    def __init__(self, ratio=0.2, min_per_sec=1.0, capacity=100.0):
+        self.ratio = ratio
+        self.min_per_sec = min_per_sec
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._refilled_at = time.monotonic()
+        self.requests = 0
+        self.retries = 0
+        self.denied = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._refilled_at) * self.min_per_sec)
+        self._refilled_at = now
+
+    def record_request(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+            self.requests += 1
+
+    def try_spend(self):
+        """Take one token for a retry; False means the retry must not be sent."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens < 1:
+                self.denied += 1
+                return False
+            self._tokens -= 1
+            self.retries += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "ratio": self.ratio,
+                "min_per_sec": self.min_per_sec,
+                "capacity": self.capacity,
+                "tokens": round(self._tokens, 2),
+                "requests": self.requests,
+                "retries": self.retries,
+                "denied": self.denied,
+            }
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker for one backend.
+
+    While closed, the outcomes of the last ``window_size`` calls are kept.
+    Once at least ``min_calls`` are in the window, the breaker opens if the
+    share of failures reaches ``failure_rate`` or the share of calls slower
+    than ``slow_call_seconds`` reaches ``slow_call_rate``. An open breaker
+    rejects calls for ``open_seconds``, then goes half-open and lets
+    ``half_open_calls`` trial calls through: one failure (or slow call)
+    reopens it, all of them succeeding closes it with an empty window.
+    ``on_change(before, after)`` is called after every state change.
+    """
+
+    def __init__(
+        self,
+        window_size=20,
+        min_calls=5,
+        failure_rate=0.5,
+        slow_call_rate=0.8,
+        slow_call_seconds=2.0,
+        open_seconds=5.0,
+        half_open_calls=2,
+        on_change=None,
+    ):
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._window = deque(maxlen=window_size)
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._trials = 0
+        self._trial_successes = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def _cooled_down(self, now):
+        return self.state == OPEN and now - self._opened_at >= self.open_seconds
+
+    def available(self):
+        """Whether a call would be let through right now, without claiming it."""
+        with self._lock:
+            if self.state == CLOSED or self._cooled_down(time.monotonic()):
+                return True
+            return self.state == HALF_OPEN and self._trials < self.half_open_calls
+
+    def allow(self):
+        """Claim permission for one call; every allowed call must be followed by ``record``."""
+        with self._lock:
+            before = self.state
+            if self._cooled_down(time.monotonic()):
+                self.state = HALF_OPEN
+                self._trials = 0
+                self._trial_successes = 0
+            if self.state == CLOSED:
+                allowed = True
+            elif self.state == HALF_OPEN and self._trials < self.half_open_calls:
+                self._trials += 1
+                allowed = True
+            else:
+                self.rejected += 1
+                allowed = False
+            after = self.state
+        self._notify(before, after)
+        return allowed
+
+    def record(self, failed, seconds):
+        slow = seconds >= self.slow_call_seconds
+        with self._lock:
+            before = self.state
+            self._record(failed, slow)
+            after = self.state
+        self._notify(before, after)
+
+    def _record(self, failed, slow):
+        if self.state == HALF_OPEN:
+            if failed or slow:
+                self._open()
+            else:
+                self._trial_successes += 1
+                if self._trial_successes >= self.half_open_calls:
+                    self.state = CLOSED
+                    self._window.clear()
+            return
+        if self.state == OPEN:
+            return  # a call that started before the breaker opened
+
+        self._window.append((failed, slow))
+        if len(self._window) < self.min_calls:
+            return
+        calls = len(self._window)
+        failures = sum(1 for call_failed, _ in self._window if call_failed)
+        slow_calls = sum(1 for _, call_slow in self._window if call_slow)
+        if failures >= self.failure_rate * calls or slow_calls >= self.slow_call_rate * calls:
+            self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self.opened += 1
+        self._window.clear()
+
+    def _notify(self, before, after):
+        if before != after and self._on_change is not None:
+            self._on_change(before, after)
+
+    def stats(self):
+        with self._lock:
+            calls = len(self._window)
+            stats = {
+                "state": self.state,
+                "calls": calls,
+                "failures": sum(1 for failed, _ in self._window if failed),
+                "slow_calls": sum(1 for _, slow in self._window if slow),
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+            if self.state == OPEN:
+                stats["retry_in"] = round(max(0.0, self.open_seconds - (time.monotonic() - self._opened_at)), 2)
+            return stats
+
+
+class CircuitBreakers:
+    """One CircuitBreaker per backend, built with shared settings.
+
+    ``on_change(server_id, before, after)`` is called on every state change.
+    """
+
+    def __init__(self, server_ids, on_change=None, **settings):
+        self.settings = settings
+        self._breakers = {
+            server_id: CircuitBreaker(
+                on_change=None if on_change is None else self._bind(on_change, server_id), **settings
+            )
+            for server_id in server_ids
+        }
+
+    @staticmethod
+    def _bind(on_change, server_id):
+        return lambda before, after: on_change(server_id, before, after)
+
+    def __getitem__(self, server_id):
+        return self._breakers[server_id]
+
+    def available(self, server_id):
+        return self._breakers[server_id].available()
+
+    def stats(self):
+        return {server_id: breaker.stats() for server_id, breaker in self._breakers.items()}
+
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram over a sliding window.
+
+    Bucket ``i`` holds samples up to ``first_bucket * growth ** i``
+    seconds, so quantiles are accurate to one bucket (``growth`` - 1,
+    20% by default) at any scale. Two halves rotate every ``window / 2``
+    seconds and quantiles read both, so old samples age out after one to
+    one and a half windows.
+    """
+
+    def __init__(self, window=60.0, first_bucket=0.001, growth=1.2, buckets=70):
+        self.window = window
+        self.first_bucket = first_bucket
+        self.growth = growth
+        self.bounds = [first_bucket * growth**index for index in range(buckets)]
+        self._halves = [[0] * (buckets + 1), [0] * (buckets + 1)]
+        self._rotated_at = time.monotonic()
+
+    def _rotate(self, now):
+        elapsed = now - self._rotated_at
+        if elapsed < self.window / 2:
+            return
+        empty = [0] * (len(self.bounds) + 1)
+        # After a full window of silence the current half is stale too.
+        self._halves = [empty, list(empty) if elapsed >= self.window else self._halves[0]]
+        self._rotated_at = now
+
+    def observe(self, seconds):
+        self._rotate(time.monotonic())
+        self._halves[0][bisect.bisect_left(self.bounds, seconds)] += 1
+
+    def count(self):
+        self._rotate(time.monotonic())
+        return sum(self._halves[0]) + sum(self._halves[1])
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the ``fraction`` quantile, or None when empty."""
+        self._rotate(time.monotonic())
+        counts = [current + previous for current, previous in zip(*self._halves)]
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = fraction * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else self.bounds[-1] * self.growth
+        return self.bounds[-1] * self.growth
+
+
+class AdaptiveTimeouts:
+    """Per-server, per-endpoint timeouts derived from recent latency.
+
+    The timeout is the ``percentile`` latency times ``factor``, clamped to
+    ``[floor, ceiling]``. Until ``min_samples`` calls have been seen it is
+    ``ceiling``. Callers record a timed-out call at its timeout, so a
+    server that really got slower raises its own timeout instead of being
+    cut off forever.
+    """
+
+    def __init__(self, factor=3.0, percentile=0.99, floor=0.25, ceiling=5.0, min_samples=50, window=60.0):
+        self.factor = factor
+        self.percentile = percentile
+        self.floor = floor
+        self.ceiling = ceiling
+        self.min_samples = min_samples
+        self.window = window
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def _histogram(self, server_id, endpoint):
+        key = (server_id, endpoint)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = LatencyHistogram(window=self.window)
+        return histogram
+
+    def observe(self, server_id, endpoint, seconds):
+        with self._lock:
+            self._histogram(server_id, endpoint).observe(seconds)
+
+    def quantile(self, server_id, endpoint, fraction):
+        """The ``fraction`` latency quantile, or None until ``min_samples`` calls were seen."""
+        with self._lock:
+            histogram = self._histogram(server_id, endpoint)
+            if histogram.count() < self.min_samples:
+                return None
+            return histogram.quantile(fraction)
+
+    def timeout(self, server_id, endpoint):
+        latency = self.quantile(server_id, endpoint, self.percentile)
+        if latency is None:
+            return self.ceiling
+        return min(self.ceiling, max(self.floor, latency * self.factor))
+
+    def stats(self):
+        stats = {}
+        with self._lock:
+            keys = list(self._histograms)
+        for server_id, endpoint in keys:
+            with self._lock:
+                histogram = self._histograms[(server_id, endpoint)]
+                count = histogram.count()
+                p50 = histogram.quantile(0.5)
+                p99 = histogram.quantile(self.percentile)
+            stats.setdefault(server_id, {})[endpoint] = {
+                "samples": count,
+                "p50_ms": None if p50 is None else round(p50 * 1000, 1),
+                f"p{round(self.percentile * 100)}_ms": None if p99 is None else round(p99 * 1000, 1),
+                "timeout_ms": round(self.timeout(server_id, endpoint) * 1000),
+            }
+        return stats
@@ -0,0 +1,322 @@
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+class RoutingError(ValueError):
+    pass
+
+
+class BackendLoad:
+    """Outstanding requests and peak-EWMA latency for every backend.
+
+    Latency samples above the current average replace it outright ("peak"),
+    lower samples are blended in with a weight that decays over ``decay``
+    seconds, so a backend that slows down is penalised at once and
+    recovers gradually.
+    """
+
+    def __init__(self, server_ids, decay=10.0):
+        self.decay = decay
+        self._lock = threading.Lock()
+        self._outstanding = {server_id: 0 for server_id in server_ids}
+        self._completed = {server_id: 0 for server_id in server_ids}
+        self._ewma = {server_id: 0.0 for server_id in server_ids}
+        self._updated = {server_id: None for server_id in server_ids}
+
+    @contextmanager
+    def track(self, server_id):
+        with self._lock:
+            self._outstanding[server_id] += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                self._outstanding[server_id] -= 1
+                self._completed[server_id] += 1
+                self._observe(server_id, finished - started, finished)
+
+    def _observe(self, server_id, latency, now):
+        ewma = self._ewma[server_id]
+        last = self._updated[server_id]
+        if last is None or latency > ewma:
+            ewma = latency
+        else:
+            weight = math.exp(-(now - last) / self.decay) if self.decay > 0 else 0.0
+            ewma = ewma * weight + latency * (1 - weight)
+        self._ewma[server_id] = ewma
+        self._updated[server_id] = now
+
+    def outstanding(self, server_id):
+        return self._outstanding[server_id]
+
+    def peak_ewma_cost(self, server_id):
+        # An unmeasured backend costs nothing so it gets tried first.
+        return self._ewma[server_id] * (self._outstanding[server_id] + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                server_id: {
+                    "outstanding": self._outstanding[server_id],
+                    "completed": self._completed[server_id],
+                    "ewma_ms": round(self._ewma[server_id] * 1000, 2),
+                }
+                for server_id in self._outstanding
+            }
+
+
+def parse_weights(text):
+    """Parse ``"S1=3,S2=1"`` into ``{"S1": 3.0, "S2": 1.0}``."""
+    weights = {}
+    for part in (text or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        server_id, _, value = part.partition("=")
+        try:
+            weights[server_id.strip()] = float(value)
+        except ValueError as error:
+            raise RoutingError(f"Invalid weight for {server_id.strip()}: {value!r}") from error
+    return weights
+
+
+class RoundRobin:
+    name = "round_robin"
+    label = "Round Robin"
+
+    def choose(self, router, candidates):
+        return candidates[router.advance(len(candidates))]
+
+
+class LeastOutstanding:
+    name = "least_outstanding"
+    label = "Least Outstanding Requests"
+
+    def choose(self, router, candidates):
+        # Rotating the starting point spreads ties, so an idle system
+        # still distributes like round robin.
+        return min(
+            router.rotated(candidates),
+            key=lambda server_id: router.load.outstanding(server_id) / router.weight(server_id),
+        )
+
+
+class PeakEwma:
+    name = "peak_ewma"
+    label = "Peak EWMA"
+
+    def choose(self, router, candidates):
+        return min(
+            router.rotated(candidates),
+            key=lambda server_id: router.load.peak_ewma_cost(server_id) / router.weight(server_id),
+        )
+
+
+class WeightedRoundRobin:
+    """Smooth weighted round robin: picks interleave instead of bursting."""
+
+    name = "weighted_round_robin"
+    label = "Weighted Round Robin"
+
+    def __init__(self):
+        self.current = {}
+
+    def choose(self, router, candidates):
+        total = 0.0
+        for server_id in candidates:
+            weight = router.weight(server_id)
+            self.current[server_id] = self.current.get(server_id, 0.0) + weight
+            total += weight
+        chosen = max(candidates, key=lambda server_id: self.current[server_id])
+        self.current[chosen] -= total
+        router.advance(len(candidates))
+        return chosen
+
+
+class PowerOfTwoChoices:
+    name = "power_of_two"
+    label = "Power of Two Choices"
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+
+    def choose(self, router, candidates):
+        if len(candidates) == 1:
+            return candidates[0]
+        router.advance(len(candidates))
+        first, second = self.rng.sample(candidates, 2)
+        return min(
+            (first, second),
+            key=lambda server_id: (
+                router.load.outstanding(server_id) / router.weight(server_id),
+                router.load.peak_ewma_cost(server_id),
+            ),
+        )
+
+
+class ConsistentHash:
+    """Places each message on the ring owner of its routing key (the receiver).
+
+    When the owner is unavailable the next server clockwise takes the
+    message; calls without a key fall back to round robin.
+    """
+
+    name = "consistent_hash"
+    label = "Consistent Hash (receiver)"
+
+    def choose(self, router, candidates, key=None):
+        if key is None or router.ring is None:
+            return candidates[router.advance(len(candidates))]
+        return router.ring.owner(key, allowed=set(candidates)) or candidates[router.advance(len(candidates))]
+
+
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (RoundRobin, LeastOutstanding, PeakEwma, WeightedRoundRobin, PowerOfTwoChoices, ConsistentHash)
+}
+
+
+def is_keyed(algorithm):
+    """True when ``algorithm`` places messages by routing key."""
+    return STRATEGIES.get(algorithm) is ConsistentHash
+
+
+class Router:
+    """Picks a backend for each write using the active strategy.
+
+    ``weights`` default to 1 per server. Weighted round robin uses them as
+    shares; the load-aware strategies divide each backend's cost by its
+    weight. ``ring`` is only used by the consistent hash strategy.
+
+    With a shared ``state`` (see routing_state.py) the round robin cursor
+    and the selected algorithm are kept there, so every load balancer
+    process follows the same rotation and sees POST /algorithm changes.
+    A configuration already present in the state wins over the arguments.
+    """
+
+    def __init__(self, server_ids, load, algorithm="round_robin", weights=None, ring=None, state=None):
+        self.server_ids = list(server_ids)
+        self.load = load
+        self.ring = ring
+        self.state = state
+        self._cursor = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self.weights = {}
+        self.strategy = None
+
+        config = state.get("routing") if state is not None else None
+        if config is None:
+            self.set_algorithm(algorithm, weights)
+        else:
+            self._sync()
+
+    def validate(self, algorithm, weights):
+        """The full weights map ``set_algorithm`` would switch to; raises RoutingError."""
+        if algorithm not in STRATEGIES:
+            raise RoutingError(f"Unknown algorithm {algorithm!r}; expected one of {', '.join(STRATEGIES)}")
+        new_weights = dict(self.weights) if weights is None else {server_id: 1.0 for server_id in self.server_ids}
+        for server_id, weight in (weights or {}).items():
+            if server_id not in self.server_ids:
+                raise RoutingError(f"Unknown server {server_id!r}")
+            try:
+                weight = float(weight)
+            except (TypeError, ValueError) as error:
+                raise RoutingError(f"Invalid weight for {server_id}: {weight!r}") from error
+            if weight <= 0:
+                raise RoutingError(f"Weight for {server_id} must be positive")
+            new_weights[server_id] = weight
+        for server_id in self.server_ids:
+            new_weights.setdefault(server_id, 1.0)
+        return new_weights
+
+    def _apply(self, algorithm, weights):
+        new_weights = self.validate(algorithm, weights)
+        with self._lock:
+            self.strategy = STRATEGIES[algorithm]()
+            self.weights = new_weights
+
+    def set_algorithm(self, algorithm, weights=None):
+        self._apply(algorithm, weights)
+        if self.state is not None:
+            self.state.set("routing", {"algorithm": self.strategy.name, "weights": self.weights})
+            self._version = self.state.increment("routing_version")
+
+    def _sync(self):
+        """Pick up an algorithm change made by another process."""
+        if self.state is None:
+            return
+        version = self.state.counter("routing_version")
+        if version == self._version:
+            return
+        config = self.state.get("routing")
+        if config is not None:
+            # Saved by a process that may have had more servers (SERVERS shrank
+            # since); weights for servers this one does not know are dropped.
+            weights = {
+                server_id: weight for server_id, weight in config["weights"].items() if server_id in self.server_ids
+            }
+            self._apply(config["algorithm"], weights)
+        self._version = version
+
+    def weight(self, server_id):
+        return self.weights.get(server_id, 1.0)
+
+    @property
+    def cursor(self):
+        if self.state is not None:
+            return self.state.counter("route_cursor")
+        return self._cursor
+
+    def advance(self, count):
+        if self.state is not None:
+            return (self.state.increment("route_cursor") - 1) % count
+        ticket = self._cursor
+        self._cursor += 1
+        return ticket % count
+
+    def rotated(self, candidates):
+        start = self.advance(len(candidates))
+        return candidates[start:] + candidates[:start]
+
+    @property
+    def keyed(self):
+        """True when placement depends on the routing key."""
+        return isinstance(self.strategy, ConsistentHash)
+
+    def home(self, key):
+        """The server ``key`` belongs to when every server is up, or None when not keyed."""
+        self._sync()
+        if not self.keyed or self.ring is None:
+            return None
+        return self.ring.owner(key)
+
+    def choose(self, candidates, key=None):
+        if not candidates:
+            raise ValueError("No UP servers found")
+        self._sync()
+        with self._lock:
+            if self.keyed:
+                return self.strategy.choose(self, list(candidates), key)
+            return self.strategy.choose(self, list(candidates))
+
+    def stats(self):
+        self._sync()
+        return {
+            "algorithm": self.strategy.name,
+            "label": self.strategy.label,
+            "available": list(STRATEGIES),
+            "weights": dict(self.weights),
+            "cursor": self.cursor,
+            "backends": self.load.stats(),
+            "ring": None if self.ring is None else {
+                "nodes": self.ring.nodes,
+                "vnodes": self.ring.vnodes,
+                "shares": self.ring.shares(),
+            },
+        }
@@ -0,0 +1,263 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from event_log import EventRing
+
+
+DOWN_REASONS = ("manual", "health")
+
+
+class MemoryRoutingState:
+    """Routing state for a single load balancer process.
+
+    Every read and write takes one lock, so request threads never see a
+    half-applied change. Use SQLiteRoutingState when several gunicorn
+    workers must agree on it.
+    """
+
+    def __init__(self, server_ids, event_capacity=5000):
+        self.server_ids = list(server_ids)
+        self.event_capacity = event_capacity
+        self._lock = threading.Lock()
+        self._down = {server_id: set() for server_id in self.server_ids}
+        self._counters = {}
+        self._values = {}
+        self._events = EventRing(event_capacity)
+
+    def statuses(self):
+        with self._lock:
+            return {server_id: "DOWN" if self._down[server_id] else "UP" for server_id in self.server_ids}
+
+    def down_reasons(self, server_id):
+        with self._lock:
+            return set(self._down[server_id])
+
+    def set_down(self, server_id, reason, down):
+        """Set or clear one reason for ``server_id`` being DOWN; returns (before, after)."""
+        with self._lock:
+            reasons = self._down[server_id]
+            before = "DOWN" if reasons else "UP"
+            if down:
+                reasons.add(reason)
+            else:
+                reasons.discard(reason)
+            return before, "DOWN" if reasons else "UP"
+
+    def increment(self, name):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+            return self._counters[name]
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._values.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def append_event(self, event):
+        with self._lock:
+            return self._events.append(event)
+
+    def events(self, since=0, types=None, limit=None):
+        with self._lock:
+            return self._events.query(since, types, limit), self._events.first_seq, self._events.last_seq
+
+    def recent_events(self, count):
+        with self._lock:
+            return self._events.recent(count)
+
+    def describe(self):
+        return {"backend": "memory", "event_capacity": self.event_capacity}
+
+
+class SQLiteRoutingState:
+    """Routing state shared by every process on the host through one SQLite file.
+
+    WAL mode lets readers proceed while a writer commits. Writes that read
+    and then change state run in ``BEGIN IMMEDIATE`` transactions, which
+    take SQLite's write lock up front, so counters and status changes are
+    atomic across processes. Connections are per thread and per process.
+    """
+
+    def __init__(self, path, server_ids, event_capacity=5000, busy_timeout=30.0):
+        self.path = path
+        self.server_ids = list(server_ids)
+        self.event_capacity = event_capacity
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+        with self._transaction() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS servers (
+                    server_id TEXT PRIMARY KEY,
+                    position INTEGER NOT NULL,
+                    manual_down INTEGER NOT NULL DEFAULT 0,
+                    health_down INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            # The event ring buffer: event ``seq`` is stored in row
+            # ``seq % capacity`` and overwrites the event it replaces.
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS events (
+                    slot INTEGER PRIMARY KEY,
+                    seq INTEGER NOT NULL UNIQUE,
+                    event TEXT NOT NULL,
+                    type TEXT NOT NULL
+                )
+                """
+            )
+            capacity = db.execute("SELECT value FROM kv WHERE key = 'event_capacity'").fetchone()
+            if capacity is None or json.loads(capacity[0]) != event_capacity:
+                db.execute("DELETE FROM events")
+                db.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES ('event_capacity', ?)",
+                    (json.dumps(event_capacity),),
+                )
+            db.executemany(
+                "INSERT OR IGNORE INTO servers (server_id, position) VALUES (?, ?)",
+                [(server_id, position) for position, server_id in enumerate(self.server_ids)],
+            )
+
+    def _db(self):
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            db = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = pid
+        return self._local.db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def statuses(self):
+        rows = self._db().execute(
+            "SELECT server_id, manual_down OR health_down FROM servers ORDER BY position"
+        ).fetchall()
+        # The file outlives restarts; servers since dropped from SERVERS keep their rows.
+        return {server_id: "DOWN" if down else "UP" for server_id, down in rows if server_id in self.server_ids}
+
+    def down_reasons(self, server_id):
+        row = self._db().execute(
+            "SELECT manual_down, health_down FROM servers WHERE server_id = ?", (server_id,)
+        ).fetchone()
+        return {reason for reason, flag in zip(DOWN_REASONS, row or (0, 0)) if flag}
+
+    def set_down(self, server_id, reason, down):
+        if reason not in DOWN_REASONS:
+            raise ValueError(f"Unknown reason {reason!r}")
+        column = f"{reason}_down"
+        with self._transaction() as db:
+            before = db.execute(
+                "SELECT manual_down OR health_down FROM servers WHERE server_id = ?", (server_id,)
+            ).fetchone()[0]
+            after = db.execute(
+                f"UPDATE servers SET {column} = ? WHERE server_id = ? RETURNING manual_down OR health_down",
+                (int(down), server_id),
+            ).fetchone()[0]
+        return "DOWN" if before else "UP", "DOWN" if after else "UP"
+
+    def increment(self, name):
+        with self._transaction() as db:
+            return db.execute(
+                """
+                INSERT INTO counters (name, value) VALUES (?, 1)
+                ON CONFLICT (name) DO UPDATE SET value = value + 1
+                RETURNING value
+                """,
+                (name,),
+            ).fetchone()[0]
+
+    def counter(self, name):
+        row = self._db().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def get(self, key, default=None):
+        row = self._db().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        self._db().execute(
+            "INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value)),
+        )
+
+    def append_event(self, event):
+        with self._transaction() as db:
+            seq = db.execute(
+                """
+                INSERT INTO counters (name, value) VALUES ('event_seq', 1)
+                ON CONFLICT (name) DO UPDATE SET value = value + 1
+                RETURNING value
+                """
+            ).fetchone()[0]
+            db.execute(
+                "INSERT OR REPLACE INTO events (slot, seq, event, type) VALUES (?, ?, ?, ?)",
+                (seq % self.event_capacity, seq, json.dumps(dict(event, seq=seq)), event["type"]),
+            )
+        return seq
+
+    def events(self, since=0, types=None, limit=None):
+        sql = "SELECT event FROM events WHERE seq > ?"
+        params = [since]
+        if types:
+            sql += f" AND type IN ({', '.join('?' for _ in types)})"
+            params.extend(types)
+        sql += " ORDER BY seq"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        db = self._db()
+        db.execute("BEGIN")
+        try:
+            rows = db.execute(sql, params).fetchall()
+            last_seq = self.counter("event_seq")
+        finally:
+            db.execute("COMMIT")
+        first_seq = max(1, last_seq - self.event_capacity + 1)
+        return [json.loads(row[0]) for row in rows], first_seq, last_seq
+
+    def recent_events(self, count):
+        rows = self._db().execute(
+            "SELECT event FROM (SELECT seq, event FROM events ORDER BY seq DESC LIMIT ?) ORDER BY seq",
+            (count,),
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def describe(self):
+        return {"backend": "sqlite", "path": self.path, "event_capacity": self.event_capacity}
+
+
+def routing_state_from_env(server_ids):
+    backend = os.getenv("ROUTING_STATE", "memory")
+    event_capacity = int(os.getenv("EVENT_LOG_SIZE", "5000"))
+    if backend == "memory":
+        return MemoryRoutingState(server_ids, event_capacity=event_capacity)
+    if backend == "sqlite":
+        path = os.getenv("ROUTING_STATE_PATH", "/tmp/mail_lb_routing_state.sqlite3")
+        return SQLiteRoutingState(path, server_ids, event_capacity=event_capacity)
+    raise ValueError(f"Unknown ROUTING_STATE {backend!r}; expected memory or sqlite")
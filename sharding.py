@@ -0,0 +1,171 @@
+import bisect
+import hashlib
+
+
+class HashRing:
+    """Consistent hash ring with ``vnodes`` virtual nodes per server.
+
+    Adding or removing a server only moves the keys on the arcs it gains
+    or loses (about 1/N of them) instead of reshuffling every key.
+    """
+
+    def __init__(self, nodes, vnodes=160):
+        self.nodes = list(nodes)
+        self.vnodes = vnodes
+        points = sorted(
+            (self._hash(f"{node}#{replica}"), node)
+            for node in self.nodes
+            for replica in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(text):
+        return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big")
+
+    def owner(self, key, allowed=None):
+        """First node clockwise from ``key``, skipping nodes not in ``allowed``."""
+        if not self._hashes:
+            return None
+        start = bisect.bisect(self._hashes, self._hash(key))
+        for offset in range(len(self._owners)):
+            node = self._owners[(start + offset) % len(self._owners)]
+            if allowed is None or node in allowed:
+                return node
+        return None
+
+    def shares(self):
+        """Fraction of the hash space owned by each node."""
+        space = 1 << 64
+        shares = {node: 0 for node in self.nodes}
+        for index, point in enumerate(self._hashes):
+            previous = self._hashes[index - 1] if index else self._hashes[-1] - space
+            shares[self._owners[index]] += point - previous
+        return {node: round(owned / space, 4) for node, owned in shares.items()}
+
+
+def note_displaced(connection, receiver, server_id):
+    """Remember that ``receiver`` has messages outside its home shard."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO displaced_receivers (receiver, server_id)
+            VALUES (%s, %s)
+            ON CONFLICT (receiver, server_id) DO UPDATE SET noted_at = EXCLUDED.noted_at
+            """,
+            (receiver, server_id),
+        )
+    connection.commit()
+
+
+def single_shard_allowed(connection, receiver):
+    """True unless a rebalance is in progress or ``receiver`` has displaced messages."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT
+                COALESCE((SELECT rebalancing FROM shard_state WHERE id = 1), FALSE),
+                EXISTS (SELECT 1 FROM displaced_receivers WHERE receiver = %s)
+            """,
+            (receiver,),
+        )
+        rebalancing, displaced = cursor.fetchone()
+    connection.commit()
+    return not rebalancing and not displaced
+
+
+def set_rebalancing(connection, rebalancing):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO shard_state (id, rebalancing, changed_at)
+            VALUES (1, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (id) DO UPDATE
+            SET rebalancing = EXCLUDED.rebalancing, changed_at = EXCLUDED.changed_at
+            """,
+            (rebalancing,),
+        )
+    connection.commit()
+
+
+def shard_state(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT rebalancing, changed_at FROM shard_state WHERE id = 1")
+        row = cursor.fetchone()
+        cursor.execute("SELECT COUNT(DISTINCT receiver) FROM displaced_receivers")
+        displaced = cursor.fetchone()[0]
+    connection.commit()
+    return {
+        "rebalancing": bool(row and row[0]),
+        "rebalancing_changed_at": row[1].isoformat() if row and row[1] else None,
+        "displaced_receivers": displaced,
+    }
+
+
+def rebalance(connection, ring, up_servers):
+    """Move every receiver's messages onto its home shard.
+
+    All servers share one database, so a move only rewrites
+    ``messages.server_id``; the per-server counters are adjusted in the
+    same transaction. Receivers whose home shard is not in ``up_servers``
+    are left alone and stay marked as displaced. Returns the moved
+    ``(message_id, server_id)`` pairs and the receivers still displaced.
+    """
+    moved = []
+    skipped = set()
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT receiver, server_id FROM messages GROUP BY receiver, server_id")
+        by_owner = {}
+        for receiver, server_id in cursor.fetchall():
+            owner = ring.owner(receiver)
+            if owner is None or owner == server_id:
+                continue
+            if owner not in up_servers:
+                skipped.add(receiver)
+                continue
+            by_owner.setdefault(owner, set()).add(receiver)
+
+        for owner, receivers in by_owner.items():
+            cursor.execute(
+                """
+                UPDATE messages AS m
+                SET server_id = %s
+                FROM (
+                    SELECT id, server_id FROM messages
+                    WHERE receiver = ANY(%s) AND server_id <> %s
+                    FOR UPDATE
+                ) AS previous
+                WHERE m.id = previous.id
+                RETURNING m.id, previous.server_id
+                """,
+                (owner, sorted(receivers), owner),
+            )
+            deltas = {owner: 0}
+            for message_id, previous in cursor.fetchall():
+                deltas[owner] += 1
+                deltas[previous] = deltas.get(previous, 0) - 1
+                moved.append((message_id, owner))
+            for server_id, count in deltas.items():
+                cursor.execute(
+                    """
+                    INSERT INTO server_message_counts (server_id, message_count)
+                    VALUES (%s, %s)
+                    ON CONFLICT (server_id) DO UPDATE
+                    SET message_count = server_message_counts.message_count + EXCLUDED.message_count
+                    """,
+                    (server_id, count),
+                )
+
+        # Rows noted after this transaction started belong to writes this
+        # pass may not have seen; keep them for the next rebalance.
+        cursor.execute(
+            """
+            DELETE FROM displaced_receivers
+            WHERE noted_at < CURRENT_TIMESTAMP AND NOT (receiver = ANY(%s))
+            """,
+            (sorted(skipped),),
+        )
+    connection.commit()
+    return moved, sorted(skipped)
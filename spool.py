@@ -0,0 +1,342 @@
+import fcntl
+import glob
+import heapq
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+
+class DeliveryError(Exception):
+    """Raised by ``deliver``; ``retryable=False`` sends the message straight to the dead letters."""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def generate_message_id():
+    """Time-ordered 63-bit id for messages accepted without one."""
+    return (time.time_ns() // 1_000_000) << 20 | random.getrandbits(20)
+
+
+class _Segment:
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.size = 0
+        self.outstanding = 0
+        self.sealed = False
+        self.dirty = False
+
+
+class Spool:
+    """Durable write-behind queue: an append-only log drained by worker threads.
+
+    ``append()`` writes an ``add`` record to the current segment file and
+    returns once an fsync covers it. A flusher thread batches those fsyncs:
+    every appender arriving within ``fsync_interval`` shares one. Dispatcher
+    threads hand messages to ``deliver(message)``; retryable failures are
+    rescheduled with exponential backoff and jitter, and every outcome is
+    written as an ``ack`` record. Nothing waits for acks to reach the disk:
+    after a crash a delivered message may be sent again, so ``deliver``
+    must treat an already-stored id as success.
+
+    Each process writes its own ``spool-<pid>-<n>.log`` segments and holds
+    an flock on them. Segments whose lock is free belong to a process that
+    died; they are adopted (pending messages re-appended, file removed) on
+    start and every ``adopt_interval`` seconds.
+    """
+
+    def __init__(
+        self,
+        directory,
+        deliver,
+        on_dead=None,
+        workers=4,
+        fsync_interval=0.005,
+        segment_bytes=16 * 1024 * 1024,
+        max_attempts=10,
+        backoff_base=0.2,
+        backoff_max=30.0,
+        adopt_interval=60.0,
+    ):
+        self.directory = directory
+        self._deliver = deliver
+        self._on_dead = on_dead
+        self.workers = workers
+        self.fsync_interval = fsync_interval
+        self.segment_bytes = segment_bytes
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.adopt_interval = adopt_interval
+
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _reset(self):
+        self._write_lock = threading.Lock()
+        self._synced = threading.Condition()
+        self._segment = None
+        self._segments = {}
+        self._seq = 0
+        self._written = 0
+        self._durable = 0
+        self._fsyncs = 0
+
+        self._ready = threading.Condition()
+        self._schedule = []
+        self._inflight = 0
+
+        self.accepted = 0
+        self.delivered = 0
+        self.dead = 0
+        self.retries = 0
+        self.adopted = 0
+        self._delivery_buckets = deque()
+
+    def ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            self._reset()
+            os.makedirs(self.directory, exist_ok=True)
+            self._rotate()
+            self._pid = pid
+            threading.Thread(target=self._flush_loop, name="spool-flusher", daemon=True).start()
+            for number in range(self.workers):
+                threading.Thread(target=self._dispatch_loop, name=f"spool-dispatch-{number}", daemon=True).start()
+            self._adopt_orphans()
+
+    # Writing -----------------------------------------------------------
+
+    def _rotate(self):
+        path = os.path.join(self.directory, f"spool-{os.getpid()}-{time.time_ns()}.log")
+        previous = self._segment
+        self._segment = _Segment(path)
+        self._segments[path] = self._segment
+        if previous is not None:
+            previous.sealed = True
+            self._maybe_remove(previous)
+
+    def _maybe_remove(self, segment):
+        if segment.sealed and segment.outstanding == 0:
+            self._segments.pop(segment.path, None)
+            os.unlink(segment.path)
+            os.close(segment.fd)
+
+    def _write(self, segment, record):
+        data = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+        os.write(segment.fd, data)
+        segment.size += len(data)
+        segment.dirty = True
+        self._written += 1
+        return self._written
+
+    def _append_records(self, messages, wait=True):
+        entries = []
+        with self._write_lock:
+            if self._segment.size >= self.segment_bytes:
+                self._rotate()
+            segment = self._segment
+            for message in messages:
+                self._seq += 1
+                mark = self._write(segment, {"add": self._seq, "message": message})
+                segment.outstanding += 1
+                entries.append({"seq": self._seq, "segment": segment, "message": message, "attempts": 0})
+        if not wait:
+            return entries
+        with self._synced:
+            self._synced.notify_all()
+            while self._durable < mark:
+                self._synced.wait()
+        return entries
+
+    def append(self, message):
+        """Durably spool ``message`` and queue it for delivery; returns its spool sequence number."""
+        self.ensure_started()
+        entry = self._append_records([message])[0]
+        self.accepted += 1
+        self._enqueue(entry, time.monotonic())
+        return entry["seq"]
+
+    def _flush_loop(self):
+        next_adopt = time.monotonic() + self.adopt_interval
+        while True:
+            with self._synced:
+                self._synced.wait_for(lambda: self._written > self._durable, timeout=1.0)
+                pending = self._written > self._durable
+            if pending and self.fsync_interval > 0:
+                # Let more appenders join this fsync.
+                time.sleep(self.fsync_interval)
+            if pending:
+                with self._write_lock:
+                    mark = self._written
+                    dirty = [segment for segment in self._segments.values() if segment.dirty]
+                    for segment in dirty:
+                        segment.dirty = False
+                for segment in dirty:
+                    try:
+                        os.fsync(segment.fd)
+                    except OSError:
+                        pass  # removed after its last ack; nothing left to protect
+                with self._synced:
+                    self._durable = mark
+                    self._fsyncs += 1
+                    self._synced.notify_all()
+            if time.monotonic() >= next_adopt:
+                next_adopt = time.monotonic() + self.adopt_interval
+                try:
+                    self._adopt_orphans()
+                except Exception as error:
+                    print(f"Spool adoption failed: {error}", flush=True)
+
+    def _ack(self, entry, outcome):
+        with self._write_lock:
+            segment = entry["segment"]
+            self._write(segment, {"ack": entry["seq"], "outcome": outcome})
+            segment.outstanding -= 1
+            self._maybe_remove(segment)
+
+    # Adopting segments of dead processes ---------------------------------
+
+    def _adopt_orphans(self):
+        for path in sorted(glob.glob(os.path.join(self.directory, "spool-*.log"))):
+            if path in self._segments:
+                continue
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # its owner is alive
+                if os.fstat(fd).st_nlink == 0:
+                    continue  # another process adopted it first
+
+                pending = self._read_pending(path)
+                if pending:
+                    # Runs on the flusher thread too, so sync directly
+                    # instead of waiting for the flusher.
+                    entries = self._append_records(pending, wait=False)
+                    os.fsync(entries[0]["segment"].fd)
+                    now = time.monotonic()
+                    for entry in entries:
+                        self._enqueue(entry, now)
+                    self.adopted += len(pending)
+                    print(f"Adopted {len(pending)} spooled messages from {os.path.basename(path)}", flush=True)
+                os.unlink(path)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _read_pending(path):
+        pending = {}
+        with open(path, "rb") as handle:
+            for line in handle:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn final line from a crash mid-write
+                if "add" in record:
+                    pending[record["add"]] = record["message"]
+                elif "ack" in record:
+                    pending.pop(record["ack"], None)
+        return [pending[seq] for seq in sorted(pending)]
+
+    # Dispatching ---------------------------------------------------------
+
+    def _enqueue(self, entry, due):
+        with self._ready:
+            heapq.heappush(self._schedule, (due, entry["seq"], entry))
+            self._ready.notify()
+
+    def _next_entry(self):
+        with self._ready:
+            while True:
+                if self._schedule:
+                    wait = self._schedule[0][0] - time.monotonic()
+                    if wait <= 0:
+                        self._inflight += 1
+                        return heapq.heappop(self._schedule)[2]
+                    self._ready.wait(wait)
+                else:
+                    self._ready.wait()
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.5, 1.5)
+
+    def _dispatch_loop(self):
+        while True:
+            entry = self._next_entry()
+            try:
+                self._dispatch(entry)
+            except Exception as error:
+                print(f"Spool dispatch failed: {error}", flush=True)
+            finally:
+                with self._ready:
+                    self._inflight -= 1
+
+    def _dispatch(self, entry):
+        entry["attempts"] += 1
+        try:
+            self._deliver(entry["message"])
+        except Exception as error:
+            retryable = getattr(error, "retryable", True)
+            if retryable and entry["attempts"] < self.max_attempts:
+                self.retries += 1
+                self._enqueue(entry, time.monotonic() + self._backoff(entry["attempts"]))
+                return
+            self.dead += 1
+            self._ack(entry, "dead")
+            if self._on_dead is not None:
+                self._on_dead(entry["message"], error, entry["attempts"])
+            return
+
+        self.delivered += 1
+        self._count_delivery()
+        self._ack(entry, "delivered")
+
+    def _count_delivery(self):
+        second = int(time.monotonic())
+        with self._ready:
+            if self._delivery_buckets and self._delivery_buckets[-1][0] == second:
+                self._delivery_buckets[-1][1] += 1
+            else:
+                self._delivery_buckets.append([second, 1])
+            while self._delivery_buckets and self._delivery_buckets[0][0] <= second - 60:
+                self._delivery_buckets.popleft()
+
+    def stats(self):
+        if self._pid != os.getpid():
+            return {"started": False}
+        now = int(time.monotonic())
+        with self._ready:
+            depth = len(self._schedule) + self._inflight
+            delivered_last_minute = sum(count for second, count in self._delivery_buckets if second > now - 60)
+            oldest_due = min((due for due, _, _ in self._schedule), default=None)
+        return {
+            "started": True,
+            "directory": self.directory,
+            "depth": depth,
+            "inflight": self._inflight,
+            "drain_rate_per_sec": round(delivered_last_minute / 60, 2),
+            "accepted": self.accepted,
+            "delivered": self.delivered,
+            "retries": self.retries,
+            "dead": self.dead,
+            "adopted": self.adopted,
+            "fsyncs": self._fsyncs,
+            "segments": len(self._segments),
+            "next_attempt_in": None if oldest_due is None else round(max(0.0, oldest_due - time.monotonic()), 3),
+        }
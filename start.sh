@@ -1,6 +1,17 @@
 #!/bin/bash
 
+python migrations.py || exit 1
+
 python server1.py &
 python server2.py &
 python server3.py &
-gunicorn load_balancer:app --bind 0.0.0.0:$PORT
+LB_WORKERS=${LB_WORKERS:-1}
+# Several workers must share failover flags, the round robin cursor and logs.
+if [ "$LB_WORKERS" -gt 1 ]; then
+  export ROUTING_STATE=${ROUTING_STATE:-sqlite}
+fi
+# LB_SERVER=asgi serves inbox/sent fan-outs on an event loop (load_balancer_asgi.py).
+if [ "${LB_SERVER:-flask}" = "asgi" ]; then
+  exec uvicorn load_balancer_asgi:app --host 0.0.0.0 --port $PORT --workers $LB_WORKERS
+fi
+gunicorn load_balancer:app --bind 0.0.0.0:$PORT --workers $LB_WORKERS --worker-class gthread --threads ${LB_THREADS:-32}
@@ -0,0 +1,17 @@
+"""Storage server package: one parametrized server instead of a copy per shard.
+
+    python -m storage_server --server-id S4 --port 5004
+
+or, from a WSGI server, ``storage_server:create_app("S4")``.
+"""
+from storage_server.server import StorageServer
+from storage_server.settings import ServerSettings
+from storage_server.store import MessageStore
+
+
+def create_app(server_id=None, **overrides):
+    """Flask app for one storage server; settings not given come from the environment."""
+    return StorageServer.from_env(server_id, **overrides).app
+
+
+__all__ = ["MessageStore", "ServerSettings", "StorageServer", "create_app"]
@@ -0,0 +1,37 @@
+import argparse
+
+from storage_server.server import StorageServer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m storage_server",
+        description="Run one storage server. Options left out fall back to the environment variables.",
+    )
+    parser.add_argument("--server-id", help="shard id such as S4 (default: SERVER_ID)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, help="default: PORT, then 8080")
+    parser.add_argument("--database-url", help="default: DATABASE_URL")
+    parser.add_argument("--pool-min", type=int, help="default: DB_POOL_MIN, then 1")
+    parser.add_argument("--pool-max", type=int, help="default: DB_POOL_MAX, then 10")
+    parser.add_argument("--pool-acquire-timeout", type=float, help="default: DB_POOL_ACQUIRE_TIMEOUT, then 5")
+    args = parser.parse_args(argv)
+
+    try:
+        server = StorageServer.from_env(
+            args.server_id,
+            port=args.port,
+            database_url=args.database_url,
+            pool={
+                "minconn": args.pool_min,
+                "maxconn": args.pool_max,
+                "acquire_timeout": args.pool_acquire_timeout,
+            },
+        )
+    except ValueError as error:
+        parser.error(str(error))
+    server.serve(host=args.host)
+
+
+if __name__ == "__main__":
+    main()
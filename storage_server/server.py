@@ -0,0 +1,499 @@
+import os
+import threading
+
+import psycopg2
+from flask import Flask, jsonify, request
+from werkzeug.serving import WSGIRequestHandler
+
+from db_pool import DatabaseConnectionError
+from group_commit import GroupCommitter
+from integrity import Scrubber, VerifyPolicy, checksum_function, mark_verified, quarantine_messages, quarantine_summary
+from message_counts import read_message_count, reconcile_message_count, start_count_reconciler
+from message_ids import MessageIdError, invalid_text_field, parse_message_id
+from migrations import MigrationError, migrate_on_startup
+from pagination import PaginationError, decode_cursor, encode_cursor, parse_limit
+from storage_server.settings import ServerSettings
+from storage_server.store import MessageStore
+
+# Errors caused by one row's data, not by the database: a group commit
+# retries its rows one at a time on these, and the caller gets a 400.
+# psycopg2 raises ValueError itself for strings containing NUL.
+ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError, ValueError)
+
+
+def _row_to_message(row, with_cursor=False):
+    message = {
+        "id": row[0],
+        "sender": row[1],
+        "receiver": row[2],
+        "content": row[3],
+        "status": row[4],
+        "timestamp_sent": row[5],
+        "timestamp_read": row[6],
+        "checksum": row[7],
+        "server_id": row[8],
+        "checksum_algo": row[9],
+    }
+    if row[11]:
+        message["quarantined"] = True
+    if with_cursor:
+        message["cursor"] = encode_cursor(row[5], row[0])
+    return message
+
+
+def _page_response(rows, limit):
+    next_before = None
+    if len(rows) == limit:
+        next_before = encode_cursor(rows[-1][5], rows[-1][0])
+    return jsonify(
+        {
+            "messages": [_row_to_message(row, with_cursor=True) for row in rows],
+            "next_before": next_before,
+        }
+    )
+
+
+class StorageServer:
+    """One storage server: its Flask app, database pool and background jobs.
+
+    Any number of servers can run side by side, one process each, as long
+    as every one has its own ``server_id``; they all share the messages
+    table and only ever touch their own rows.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.server_id = settings.server_id
+        self.make_checksum = checksum_function(settings.checksum_algorithm)
+        self.verify_policy = VerifyPolicy(settings.verify_mode, sample_rate=settings.sample_rate)
+        self.store = MessageStore(settings.server_id, settings.database_url, self.verify_policy, settings.pool)
+        self.scrubber = Scrubber(
+            self.store.connection,
+            settings.server_id,
+            rows_per_sec=settings.scrub_rate,
+            batch_size=settings.scrub_batch,
+            interval=settings.scrub_interval,
+        )
+        self.group_committer = GroupCommitter(
+            self.store.insert_messages,
+            max_delay=settings.group_commit_max_delay,
+            max_batch=settings.group_commit_max_batch,
+            row_errors=ROW_ERRORS,
+        )
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._start_error = None
+        self.app = self._create_app()
+
+    @classmethod
+    def from_env(cls, server_id=None, **overrides):
+        return cls(ServerSettings.from_env(server_id, **overrides))
+
+    def _create_app(self):
+        app = Flask(__name__)
+        app.extensions["storage_server"] = self
+        app.register_error_handler(DatabaseConnectionError, self.handle_db_connection_error)
+        app.register_error_handler(PaginationError, self.handle_pagination_error)
+        app.before_request(self.ensure_started)
+
+        routes = [
+            ("/", "GET", self.home),
+            ("/health", "GET", self.health),
+            ("/receive", "POST", self.receive_message),
+            ("/receive/batch", "POST", self.receive_batch),
+            ("/messages/<username>", "GET", self.get_messages),
+            ("/mark-read/<username>", "POST", self.mark_read),
+            ("/edit/<message_id>", "PUT", self.edit_message),
+            ("/delete/<message_id>", "DELETE", self.delete_message),
+            ("/corrupt/<message_id>", "POST", self.corrupt_message),
+            ("/sent/<username>", "GET", self.get_sent_messages),
+            ("/sent-history/<username>", "DELETE", self.clear_sent_history),
+            ("/inbox-history/<username>", "DELETE", self.clear_inbox_history),
+            ("/stats", "GET", self.get_stats),
+            ("/scrub/status", "GET", self.scrub_status),
+            ("/stats/reconcile", "POST", self.reconcile_stats),
+        ]
+        for rule, method, view in routes:
+            app.add_url_rule(rule, view.__name__, view, methods=[method])
+        return app
+
+    def start_background_jobs(self):
+        start_count_reconciler(self.store.connection, self.server_id, self.settings.stats_reconcile_interval)
+        self.scrubber.start()
+
+    def ensure_started(self):
+        """Migrate and start the background jobs once per process.
+
+        Also runs before every request, so a WSGI server that only imports
+        ``create_app`` (gunicorn) gets them in each worker, which ``serve``
+        is never called in. Threads do not survive a fork, hence per pid.
+        A failed migration or plan check is raised once; later requests get
+        a 503 instead of running it again. Other errors (the database being
+        down) are retried on the next request.
+        """
+        pid = os.getpid()
+        if self._started_pid != pid:
+            with self._start_lock:
+                if self._started_pid != pid:
+                    try:
+                        migrate_on_startup(self.store.connection)
+                    except MigrationError as error:
+                        self._start_error = error
+                        self._started_pid = pid
+                        raise
+                    self._start_error = None
+                    self.start_background_jobs()
+                    self._started_pid = pid
+                    return
+        if self._start_error is not None:
+            return jsonify({"error": "Server failed to start", "details": str(self._start_error)}), 503
+
+    def serve(self, host="0.0.0.0"):
+        """Migrate, start the background jobs and run the development server."""
+        # HTTP/1.1 lets the load balancer keep connections open between calls.
+        WSGIRequestHandler.protocol_version = "HTTP/1.1"
+        self.ensure_started()
+        self.app.run(host=host, port=self.settings.port)
+
+    # Errors --------------------------------------------------------------
+
+    def handle_db_connection_error(self, error):
+        return jsonify({"error": "Database unavailable", "details": str(error)}), 503
+
+    def handle_pagination_error(self, error):
+        return jsonify({"error": str(error)}), 400
+
+    # Writes --------------------------------------------------------------
+
+    def _message_row(self, message_id, message):
+        content = message.get("content", "")
+        return (
+            message_id,
+            message.get("sender"),
+            message.get("receiver"),
+            content,
+            "UNREAD",
+            self.make_checksum(content.encode()),
+            self.settings.checksum_algorithm,
+            self.server_id,
+        )
+
+    def _stored_response(self, message_id):
+        return jsonify({"message": "Stored successfully", "server": self.server_id, "id": message_id})
+
+    def receive_message(self):
+        payload = request.get_json(silent=True) or {}
+        try:
+            message_id = parse_message_id(payload.get("id"))
+        except MessageIdError as error:
+            return jsonify({"error": str(error)}), 400
+        field_error = invalid_text_field(payload)
+        if field_error:
+            return jsonify({"error": field_error}), 400
+
+        row = self._message_row(message_id, payload)
+        try:
+            if self.settings.group_commit:
+                stored = self.group_committer.submit(message_id, row)
+            else:
+                stored = str(message_id) in self.store.insert_messages([row])
+        except ROW_ERRORS as error:
+            return jsonify({"error": "Invalid message", "details": str(error)}), 400
+        except Exception as error:
+            return jsonify({"error": "Database unavailable", "details": str(error)}), 503
+
+        if not stored:
+            return jsonify({"error": "Message id already exists"}), 400
+        return self._stored_response(message_id)
+
+    def receive_batch(self):
+        payload = request.get_json(silent=True) or {}
+        messages = payload.get("messages") if isinstance(payload, dict) else payload
+        if not isinstance(messages, list):
+            return jsonify({"error": "messages must be a list"}), 400
+
+        results = []
+        rows = []
+        pending_ids = set()
+        for message in messages:
+            message = message if isinstance(message, dict) else {}
+            try:
+                message_id = parse_message_id(message.get("id"))
+            except MessageIdError as error:
+                results.append({"id": message.get("id"), "status": "rejected", "error": str(error)})
+                continue
+            field_error = invalid_text_field(message)
+            if field_error:
+                results.append({"id": message_id, "status": "rejected", "error": field_error})
+                continue
+            if str(message_id) in pending_ids:
+                results.append({"id": message_id, "status": "rejected", "error": "Message id already exists"})
+                continue
+
+            pending_ids.add(str(message_id))
+            rows.append(self._message_row(message_id, message))
+            results.append({"id": message_id, "status": "pending"})
+
+        stored_ids, row_errors = self._insert_isolated(rows)
+
+        for result in results:
+            if result["status"] != "pending":
+                continue
+            if str(result["id"]) in stored_ids:
+                result["status"] = "stored"
+            elif str(result["id"]) in row_errors:
+                result["status"] = "rejected"
+                result["error"] = f"Invalid message: {row_errors[str(result['id'])]}"
+            else:
+                result["status"] = "rejected"
+                result["error"] = "Message id already exists"
+
+        return jsonify(
+            {
+                "server": self.server_id,
+                "stored": sum(1 for result in results if result["status"] == "stored"),
+                "results": results,
+            }
+        )
+
+    def _insert_isolated(self, rows):
+        """Insert ``rows`` in one transaction, or one at a time if a row's data breaks the batch.
+
+        Returns the stored ids and a dict of id -> error for the rows that
+        could not be inserted.
+        """
+        if not rows:
+            return set(), {}
+        try:
+            return self.store.insert_messages(rows), {}
+        except ROW_ERRORS as error:
+            if len(rows) == 1:
+                return set(), {str(rows[0][0]): str(error)}
+
+        stored_ids = set()
+        row_errors = {}
+        for row in rows:
+            try:
+                stored_ids |= self.store.insert_messages([row])
+            except ROW_ERRORS as error:
+                row_errors[str(row[0])] = str(error)
+        return stored_ids, row_errors
+
+    def mark_read(self, username):
+        payload = request.get_json(silent=True) or {}
+        message_ids = payload.get("ids") or []
+        if not isinstance(message_ids, list):
+            return jsonify({"error": "ids must be a list"}), 400
+
+        marked = []
+        if message_ids:
+            with self.store.connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        """
+                        UPDATE messages
+                        SET status='READ', timestamp_read=CURRENT_TIMESTAMP
+                        WHERE id = ANY(%s) AND receiver = %s AND server_id = %s AND status='UNREAD'
+                          AND NOT EXISTS (SELECT 1 FROM message_quarantine AS q WHERE q.message_id = messages.id)
+                        RETURNING id, timestamp_read
+                        """,
+                        (message_ids, username, self.server_id),
+                    )
+                    marked = [{"id": row[0], "timestamp_read": row[1]} for row in cursor.fetchall()]
+                connection.commit()
+
+        return jsonify({"marked": marked})
+
+    def edit_message(self, message_id):
+        payload = request.get_json(silent=True) or {}
+        new_content = payload.get("content", "")
+
+        with self.store.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    """
+                    UPDATE messages
+                    SET content = %s, checksum = %s, checksum_algo = %s, verified_at = NULL
+                    WHERE id = %s AND status = 'UNREAD' AND server_id = %s
+                    """,
+                    (
+                        new_content,
+                        self.make_checksum(new_content.encode()),
+                        self.settings.checksum_algorithm,
+                        message_id,
+                        self.server_id,
+                    ),
+                )
+                updated_count = cursor.rowcount
+                if updated_count:
+                    cursor.execute("DELETE FROM message_quarantine WHERE message_id = %s", (message_id,))
+                else:
+                    cursor.execute(
+                        "SELECT 1 FROM messages WHERE id = %s AND server_id = %s",
+                        (message_id, self.server_id),
+                    )
+                    exists = cursor.fetchone() is not None
+            connection.commit()
+
+            if updated_count == 0:
+                # 404 tells the load balancer to look on the other servers.
+                if not exists:
+                    return jsonify({"error": "Message not found"}), 404
+                return jsonify({"error": "Message already read and locked"}), 400
+
+        return jsonify({"message": "Updated successfully", "id": message_id})
+
+    def delete_message(self, message_id):
+        with self.store.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT status FROM messages WHERE id = %s AND server_id = %s",
+                    (message_id, self.server_id),
+                )
+                existing_row = cursor.fetchone()
+
+            if existing_row is None:
+                return jsonify({"error": "Message not found"}), 404
+
+            if existing_row[0] == "READ":
+                return jsonify({"error": "Message already read and locked"}), 400
+
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM messages WHERE id = %s AND server_id = %s",
+                    (message_id, self.server_id),
+                )
+            connection.commit()
+
+        return jsonify({"message": "Deleted successfully", "id": message_id})
+
+    def corrupt_message(self, message_id):
+        # A write that bypasses the checksum, so it also drops the verified mark.
+        with self.store.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE messages SET content='corrupted data', verified_at = NULL WHERE id = %s AND server_id = %s",
+                    (message_id, self.server_id),
+                )
+                updated_count = cursor.rowcount
+            connection.commit()
+
+            if updated_count == 0:
+                return jsonify({"error": "Message not found"}), 404
+
+        return jsonify({"message": "Message corrupted for testing", "id": message_id})
+
+    def _clear_history(self, column, username):
+        """Delete the user's rows; returns the deleted ids so the load balancer can drop their locations."""
+        with self.store.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM messages WHERE {column} = %s AND server_id = %s RETURNING id",
+                    (username, self.server_id),
+                )
+                deleted_ids = [str(row[0]) for row in cursor.fetchall()]
+            connection.commit()
+        return deleted_ids
+
+    def clear_sent_history(self, username):
+        deleted_ids = self._clear_history("sender", username)
+        return jsonify({"message": "Sent history cleared", "deleted": len(deleted_ids), "ids": deleted_ids})
+
+    def clear_inbox_history(self, username):
+        deleted_ids = self._clear_history("receiver", username)
+        return jsonify({"message": "Inbox history cleared", "deleted": len(deleted_ids), "ids": deleted_ids})
+
+    # Reads ---------------------------------------------------------------
+
+    def _page_args(self):
+        limit = parse_limit(request.args.get("limit"), self.settings.max_page_size)
+        before = request.args.get("before")
+        return limit, decode_cursor(before) if before else None
+
+    def get_messages(self, username):
+        limit, before = self._page_args()
+        peek = request.args.get("peek") == "1"
+        on_corrupt = self.settings.on_corrupt
+        store = self.store
+
+        with store.connection() as connection:
+            rows = store.read_inbox(connection, username, limit=limit, before=before, peek=peek)
+            corrupted, newly_verified = store.verify_rows(rows)
+            if corrupted:
+                # Quarantine what this read found, then read again so the rows
+                # are skipped or flagged, and left UNREAD, like known ones.
+                connection.rollback()
+                with connection.cursor() as cursor:
+                    quarantine_messages(cursor, self.server_id, corrupted, "read")
+                connection.commit()
+                if on_corrupt != "fail":
+                    rows = store.read_inbox(connection, username, limit=limit, before=before, peek=peek)
+                    corrupted, newly_verified = store.verify_rows(rows)
+
+            quarantined_ids = [row[0] for row in rows if row[11]]
+            if corrupted or (quarantined_ids and on_corrupt == "fail"):
+                connection.rollback()
+                corrupted_id = corrupted[0][0] if corrupted else quarantined_ids[0]
+                return jsonify({"error": "Message corrupted", "message_id": corrupted_id}), 400
+
+            with connection.cursor() as cursor:
+                mark_verified(cursor, self.server_id, newly_verified)
+            connection.commit()
+
+        if on_corrupt == "skip" and quarantined_ids:
+            rows = [row for row in rows if not row[11]]
+
+        if limit is not None:
+            return _page_response(rows, limit)
+        return jsonify([_row_to_message(row) for row in rows])
+
+    def get_sent_messages(self, username):
+        limit, before = self._page_args()
+        rows = self.store.read_sent(username, limit=limit, before=before)
+        if limit is not None:
+            return _page_response(rows, limit)
+        return jsonify([_row_to_message(row) for row in rows])
+
+    # Status --------------------------------------------------------------
+
+    def home(self):
+        return jsonify(
+            {
+                "message": f"{self.settings.display_name()} is running",
+                "server_id": self.server_id,
+                "port": str(self.settings.port),
+            }
+        )
+
+    def health(self):
+        settings = self.settings
+        health = {
+            "status": "ok",
+            "db_pool": self.store.db_pool.stats(),
+            "integrity": dict(
+                self.verify_policy.describe(),
+                checksum_algorithm=settings.checksum_algorithm,
+                on_corrupt=settings.on_corrupt,
+            ),
+        }
+        if settings.group_commit:
+            health["group_commit"] = self.group_committer.stats()
+        return health, 200
+
+    def get_stats(self):
+        with self.store.connection() as connection:
+            message_count = read_message_count(connection, self.server_id)
+
+        return jsonify({"server_id": self.server_id, "message_count": message_count})
+
+    def scrub_status(self):
+        with self.store.connection() as connection:
+            quarantine = quarantine_summary(connection, self.server_id)
+
+        return jsonify({"server_id": self.server_id, "scrubber": self.scrubber.status(), "quarantine": quarantine})
+
+    def reconcile_stats(self):
+        with self.store.connection() as connection:
+            message_count, drift = reconcile_message_count(connection, self.server_id)
+
+        return jsonify({"server_id": self.server_id, "message_count": message_count, "drift": drift})
@@ -0,0 +1,84 @@
+import os
+
+
+ON_CORRUPT_MODES = ("fail", "skip", "flag")
+
+
+def _env(name, default, convert=str):
+    return convert(os.getenv(name, default))
+
+
+class ServerSettings:
+    """Everything one storage server process is configured with.
+
+    ``from_env`` reads the environment variables the servers have always
+    used; any keyword given to it that is not None wins over the
+    environment, which is how the command line overrides them.
+    """
+
+    def __init__(
+        self,
+        server_id,
+        port=8080,
+        database_url="",
+        pool=None,
+        checksum_algorithm="md5",
+        verify_mode="full",
+        sample_rate=0.05,
+        on_corrupt="fail",
+        scrub_interval=60.0,
+        scrub_batch=500,
+        scrub_rate=1000.0,
+        group_commit=False,
+        group_commit_max_delay=0.002,
+        group_commit_max_batch=64,
+        stats_reconcile_interval=300.0,
+        max_page_size=500,
+    ):
+        if not server_id:
+            raise ValueError("server_id is required")
+        if on_corrupt not in ON_CORRUPT_MODES:
+            raise ValueError(f"Unknown INTEGRITY_ON_CORRUPT {on_corrupt!r}; expected fail, skip or flag")
+        self.server_id = server_id
+        self.port = port
+        self.database_url = database_url
+        self.pool = pool or {}
+        self.checksum_algorithm = checksum_algorithm
+        self.verify_mode = verify_mode
+        self.sample_rate = sample_rate
+        self.on_corrupt = on_corrupt
+        self.scrub_interval = scrub_interval
+        self.scrub_batch = scrub_batch
+        self.scrub_rate = scrub_rate
+        self.group_commit = group_commit
+        self.group_commit_max_delay = group_commit_max_delay
+        self.group_commit_max_batch = group_commit_max_batch
+        self.stats_reconcile_interval = stats_reconcile_interval
+        self.max_page_size = max_page_size
+
+    @classmethod
+    def from_env(cls, server_id=None, **overrides):
+        settings = {
+            "server_id": server_id or os.getenv("SERVER_ID", ""),
+            "port": _env("PORT", "8080", int),
+            "database_url": (os.getenv("DATABASE_URL") or "").strip(),
+            "checksum_algorithm": _env("CHECKSUM_ALGORITHM", "md5"),
+            "verify_mode": _env("INTEGRITY_VERIFY", "full"),
+            "sample_rate": _env("INTEGRITY_SAMPLE_RATE", "0.05", float),
+            "on_corrupt": _env("INTEGRITY_ON_CORRUPT", "fail"),
+            "scrub_interval": _env("INTEGRITY_SCRUB_INTERVAL", "60", float),
+            "scrub_batch": _env("INTEGRITY_SCRUB_BATCH", "500", int),
+            "scrub_rate": _env("INTEGRITY_SCRUB_RATE", "1000", float),
+            "group_commit": os.getenv("GROUP_COMMIT", "0") == "1",
+            "group_commit_max_delay": _env("GROUP_COMMIT_MAX_DELAY_MS", "2", float) / 1000,
+            "group_commit_max_batch": _env("GROUP_COMMIT_MAX_BATCH", "64", int),
+            "stats_reconcile_interval": _env("STATS_RECONCILE_INTERVAL", "300", float),
+            "max_page_size": _env("MAX_PAGE_SIZE", "500", int),
+        }
+        settings.update((name, value) for name, value in overrides.items() if value is not None)
+        return cls(**settings)
+
+    def display_name(self):
+        """``Server 2`` for S2; ids not of the form S<n> are used as they are."""
+        number = self.server_id[1:]
+        return f"Server {number}" if self.server_id[:1] == "S" and number.isdigit() else self.server_id
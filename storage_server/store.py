@@ -0,0 +1,165 @@
+import psycopg2
+import psycopg2.extras
+
+from db_pool import DatabaseConnectionError, LazyPool
+from integrity import checksum_matches
+
+
+MESSAGE_COLUMNS = """
+    SELECT id, sender, receiver, content, status, timestamp_sent, timestamp_read, checksum, server_id,
+           checksum_algo, verified_at IS NOT NULL AS verified,
+           EXISTS (SELECT 1 FROM message_quarantine AS q WHERE q.message_id = messages.id) AS quarantined
+    FROM messages
+"""
+
+# Rows that already exist are skipped, not raised: RETURNING lists only the
+# ids actually stored, so duplicate ids are told apart from database errors
+# without matching error text.
+INSERT_MESSAGES_SQL = """
+    INSERT INTO messages
+    (id, sender, receiver, content, status, checksum, checksum_algo, server_id)
+    VALUES %s
+    ON CONFLICT (id) DO NOTHING
+    RETURNING id
+"""
+
+# Marks the user's UNREAD rows READ and returns the whole mailbox with the
+# post-update status in one round trip. Both halves of the statement share
+# one snapshot, so the join overlays the UPDATE's results onto the rows the
+# SELECT saw.
+INBOX_READ_SQL = """
+    WITH updated AS (
+        UPDATE messages
+        SET status='READ', timestamp_read=CURRENT_TIMESTAMP
+        WHERE receiver = %s AND server_id = %s AND status='UNREAD'
+          AND NOT EXISTS (SELECT 1 FROM message_quarantine AS q WHERE q.message_id = messages.id)
+        RETURNING id, status, timestamp_read
+    )
+    SELECT m.id, m.sender, m.receiver, m.content, COALESCE(u.status, m.status),
+           m.timestamp_sent, COALESCE(u.timestamp_read, m.timestamp_read), m.checksum, m.server_id,
+           m.checksum_algo, m.verified_at IS NOT NULL,
+           EXISTS (SELECT 1 FROM message_quarantine AS q WHERE q.message_id = m.id)
+    FROM messages AS m
+    LEFT JOIN updated AS u ON u.id = m.id
+    WHERE m.receiver = %s AND m.server_id = %s
+    ORDER BY m.timestamp_sent DESC
+"""
+
+INBOX_PAGE_READ_SQL = """
+    WITH page AS ({page_query}),
+    updated AS (
+        UPDATE messages AS m
+        SET status='READ', timestamp_read=CURRENT_TIMESTAMP
+        FROM page
+        WHERE m.id = page.id AND m.server_id = page.server_id AND m.status='UNREAD' AND NOT page.quarantined
+        RETURNING m.id, m.status, m.timestamp_read
+    )
+    SELECT page.id, page.sender, page.receiver, page.content, COALESCE(u.status, page.status),
+           page.timestamp_sent, COALESCE(u.timestamp_read, page.timestamp_read), page.checksum, page.server_id,
+           page.checksum_algo, page.verified, page.quarantined
+    FROM page
+    LEFT JOIN updated AS u ON u.id = page.id
+    ORDER BY page.timestamp_sent DESC, page.id DESC
+"""
+
+SENT_SQL = MESSAGE_COLUMNS + """
+    WHERE sender = %s AND server_id = %s
+    ORDER BY timestamp_sent DESC
+"""
+
+
+def connect_to(database_url):
+    """psycopg2 connect function for ``database_url``; TLS is required unless the URL says otherwise."""
+
+    def connect():
+        url = database_url
+        if not url:
+            raise DatabaseConnectionError("DATABASE_URL not set")
+        if "sslmode" not in url:
+            url += "&sslmode=require" if "?" in url else "?sslmode=require"
+        try:
+            return psycopg2.connect(url, connect_timeout=5)
+        except Exception as error:
+            raise DatabaseConnectionError(str(error)) from error
+
+    return connect
+
+
+class MessageStore:
+    """The messages table as seen by one storage server.
+
+    Every query is scoped to ``server_id``. Rows are returned as tuples
+    in MESSAGE_COLUMNS order: index 9 is the checksum algorithm, 10 the
+    verified flag and 11 the quarantined flag.
+    """
+
+    def __init__(self, server_id, database_url, verify_policy, pool_settings=None):
+        self.server_id = server_id
+        self.verify_policy = verify_policy
+        self.db_pool = LazyPool(connect_to(database_url), **(pool_settings or {}))
+
+    def connection(self):
+        return self.db_pool.connection()
+
+    def insert_messages(self, rows):
+        """Insert message rows in one transaction; returns the ids actually stored, as strings."""
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                inserted = psycopg2.extras.execute_values(
+                    cursor, INSERT_MESSAGES_SQL, rows, page_size=len(rows), fetch=True
+                )
+            connection.commit()
+        return {str(row[0]) for row in inserted}
+
+    def page_query(self, column, username, limit, before):
+        query = MESSAGE_COLUMNS + f" WHERE {column} = %s AND server_id = %s"
+        params = [username, self.server_id]
+        if before is not None:
+            query += " AND (timestamp_sent, id) < (%s, %s)"
+            params.extend(before)
+        query += " ORDER BY timestamp_sent DESC, id DESC LIMIT %s"
+        params.append(limit)
+        return query, params
+
+    def read_inbox(self, connection, username, limit=None, before=None, peek=False):
+        """Fetch (and unless ``peek``, mark READ) the user's inbox in one statement.
+
+        The caller owns the transaction: commit to keep the READ marks, or roll
+        back when a corrupted row means the inbox must not be marked read.
+        """
+        with connection.cursor() as cursor:
+            if limit is None:
+                cursor.execute(INBOX_READ_SQL, (username, self.server_id, username, self.server_id))
+            else:
+                page_query, params = self.page_query("receiver", username, limit, before)
+                if peek:
+                    cursor.execute(page_query, params)
+                else:
+                    cursor.execute(INBOX_PAGE_READ_SQL.format(page_query=page_query), params)
+            return cursor.fetchall()
+
+    def read_sent(self, username, limit=None, before=None):
+        if limit is None:
+            query, params = SENT_SQL, (username, self.server_id)
+        else:
+            query, params = self.page_query("sender", username, limit, before)
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+
+    def verify_rows(self, rows):
+        """Re-hash the rows ``verify_policy`` selects; quarantined rows are known bad and skipped.
+
+        Returns ``(corrupted, newly_verified)``, both lists of ``(id, checksum)``.
+        """
+        corrupted = []
+        newly_verified = []
+        for row in rows:
+            if row[11] or not self.verify_policy.should_verify(row[10]):
+                continue
+            if not checksum_matches(row[3], row[7], row[9]):
+                corrupted.append((row[0], row[7]))
+            elif not row[10]:
+                newly_verified.append((row[0], row[7]))
+        return corrupted, newly_verified
@@ -1,7 +1,7 @@
 $ErrorActionPreference = "Stop"
 
 function Get-Counts {
-    $data = Invoke-RestMethod http://127.0.0.1:5000/dashboard-data
+    $data = Invoke-RestMethod "http://127.0.0.1:5000/dashboard-data?fresh=1"
     return [pscustomobject]@{
         S1 = [int]$data.server_load.S1
         S2 = [int]$data.server_load.S2
@@ -0,0 +1,176 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserExistenceCache:
+    """Bounded TTL cache of "does this username exist" answers.
+
+    Positive and negative answers expire separately: a user rarely stops
+    existing, but a missing user can register at any moment (possibly via
+    another worker), so negative entries should be short-lived.
+    """
+
+    def __init__(self, positive_ttl=300.0, negative_ttl=5.0, max_entries=50_000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            exists, expires_at = entry
+            if expires_at <= now:
+                del self._entries[username]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return exists
+
+    def put(self, username, exists):
+        ttl = self.positive_ttl if exists else self.negative_ttl
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[username] = (exists, time.monotonic() + ttl)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings.
+
+    ``might_contain`` never returns False for an added item, so a miss means
+    the item was definitely never added to this filter.
+    """
+
+    def __init__(self, expected_items, false_positive_rate=0.01):
+        expected_items = max(1, expected_items)
+        size = -expected_items * math.log(false_positive_rate) / (math.log(2) ** 2)
+        self.size = max(8, int(size))
+        self.hash_count = max(1, round(self.size / expected_items * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def might_contain(self, item):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class UserBloomFilter:
+    """A Bloom filter of every username, rebuilt by a background thread.
+
+    ``load_usernames()`` returns all usernames. The first build starts with
+    the thread and later ones run every ``refresh_interval`` seconds, so a
+    request never waits for one; until the first build finishes
+    ``current()`` is None and callers ask the database. Names passed to
+    ``add`` while a build is running are added again to the new filter
+    before it replaces the old one, so a registration is never lost.
+    """
+
+    def __init__(self, load_usernames, refresh_interval=60.0):
+        self._load_usernames = load_usernames
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._bloom = None
+        self._added_during_build = None
+        self._thread = None
+        self._pid = None
+        self.builds = 0
+        self.built_at = None
+
+    def ensure_started(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == pid:
+                return
+            self._pid = pid
+            self._thread = threading.Thread(target=self._run, name="user-bloom", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.rebuild()
+            except Exception as error:
+                print(f"User Bloom filter rebuild failed: {error}", flush=True)
+            time.sleep(self.refresh_interval)
+
+    def rebuild(self):
+        with self._build_lock:
+            with self._lock:
+                self._added_during_build = []
+            try:
+                usernames = self._load_usernames()
+            except Exception:
+                with self._lock:
+                    self._added_during_build = None
+                raise
+
+            # Leave headroom for registrations until the next rebuild.
+            bloom = BloomFilter(expected_items=len(usernames) * 2 + 1000)
+            for username in usernames:
+                bloom.add(username)
+
+            with self._lock:
+                for username in self._added_during_build:
+                    bloom.add(username)
+                self._added_during_build = None
+                self._bloom = bloom
+                self.builds += 1
+                self.built_at = time.time()
+
+    def add(self, username):
+        with self._lock:
+            if self._bloom is not None:
+                self._bloom.add(username)
+            if self._added_during_build is not None:
+                self._added_during_build.append(username)
+
+    def current(self):
+        return self._bloom